@@ -0,0 +1,61 @@
+"""Сравнение двух отчетов `benchmarks.run` (например, до и после коммита).
+
+    python -m benchmarks.compare before.json after.json
+"""
+
+import argparse
+import json
+from pathlib import Path
+from typing import Optional
+
+
+def _delta(before: Optional[float], after: Optional[float]) -> str:
+    if not before or after is None:
+        return "n/a"
+    return f"{(after - before) / before * 100:+.1f}%"
+
+
+def _row(name: str, before, after) -> str:
+    return f"  {name:<18}{before!s:>14}{after!s:>14}{_delta(before, after):>10}"
+
+
+def compare(before: dict, after: dict) -> str:
+    lines = [
+        f"before: {before['meta'].get('git_commit')}",
+        f"after:  {after['meta'].get('git_commit')}",
+    ]
+    for phase, old in before["phases"].items():
+        new = after["phases"].get(phase)
+        if new is None:
+            continue
+        lines.append(f"{phase}:")
+        lines.append(_row("throughput_rps", old["throughput_rps"], new["throughput_rps"]))
+        lines.append(
+            _row("throughput_mib_s", old["throughput_mib_s"], new["throughput_mib_s"])
+        )
+        for q in ("p50", "p99"):
+            lines.append(
+                _row(
+                    f"{q}_ms",
+                    old.get("latency_ms", {}).get(q),
+                    new.get("latency_ms", {}).get(q),
+                )
+            )
+        lines.append(_row("errors", old["errors"], new["errors"]))
+    for key in ("import_s", "startup_s", "peak_rss_bytes"):
+        lines.append(_row(key, before["server"].get(key), after["server"].get(key)))
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("before")
+    parser.add_argument("after")
+    args = parser.parse_args()
+    before = json.loads(Path(args.before).read_text(encoding="utf-8"))
+    after = json.loads(Path(args.after).read_text(encoding="utf-8"))
+    print(compare(before, after))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Минимальная in-memory замена HTTP API Vault (KV v2) для бенчмарков.
+
+Реализует ровно то, что вызывает `cypher_cloud.vault_client` через hvac:
+проверку токена, запись, чтение и удаление секрета. Запуск:
+
+    uvicorn benchmarks.fake_vault:app --port 8200
+
+Токен задается переменной `FAKE_VAULT_TOKEN` (по умолчанию `bench-token`).
+"""
+
+import os
+import time
+from typing import Dict, Optional
+
+from fastapi import FastAPI, Header, HTTPException, Request
+
+app = FastAPI(title="Fake Vault", docs_url=None, redoc_url=None)
+
+TOKEN = os.environ.get("FAKE_VAULT_TOKEN", "bench-token")
+
+# (mount, path) -> {"version": int, "data": dict, "created_time": str}
+secrets: Dict[tuple, dict] = {}
+
+
+def _check_token(token: Optional[str]) -> None:
+    if token != TOKEN:
+        raise HTTPException(status_code=403, detail={"errors": ["permission denied"]})
+
+
+def _metadata(entry: dict) -> dict:
+    return {
+        "created_time": entry["created_time"],
+        "custom_metadata": None,
+        "deletion_time": "",
+        "destroyed": False,
+        "version": entry["version"],
+    }
+
+
+@app.get("/v1/auth/token/lookup-self")
+async def lookup_self(x_vault_token: Optional[str] = Header(None)):
+    _check_token(x_vault_token)
+    return {"data": {"id": x_vault_token, "policies": ["root"], "ttl": 0}}
+
+
+@app.api_route("/v1/{mount}/data/{path:path}", methods=["POST", "PUT"])
+async def write_secret(
+    mount: str,
+    path: str,
+    request: Request,
+    x_vault_token: Optional[str] = Header(None),
+):
+    _check_token(x_vault_token)
+    body = await request.json()
+    previous = secrets.get((mount, path))
+    cas = (body.get("options") or {}).get("cas")
+    if cas is not None and cas != (previous["version"] if previous else 0):
+        raise HTTPException(
+            status_code=400,
+            detail={"errors": ["check-and-set parameter did not match the current version"]},
+        )
+    entry = {
+        "version": previous["version"] + 1 if previous else 1,
+        "data": body.get("data", {}),
+        "created_time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    }
+    secrets[(mount, path)] = entry
+    return {"data": _metadata(entry)}
+
+
+@app.get("/v1/{mount}/data/{path:path}")
+async def read_secret(
+    mount: str, path: str, x_vault_token: Optional[str] = Header(None)
+):
+    _check_token(x_vault_token)
+    entry = secrets.get((mount, path))
+    if entry is None:
+        raise HTTPException(status_code=404, detail={"errors": []})
+    return {"data": {"data": entry["data"], "metadata": _metadata(entry)}}
+
+
+@app.delete("/v1/{mount}/metadata/{path:path}", status_code=204)
+async def delete_secret(
+    mount: str, path: str, x_vault_token: Optional[str] = Header(None)
+):
+    _check_token(x_vault_token)
+    secrets.pop((mount, path), None)
@@ -1,12 +1,12 @@
 import base64
 import json
 import time
-from typing import Dict, Optional
+from functools import lru_cache
+from typing import TYPE_CHECKING, Dict, Optional
 from urllib.parse import urlparse
 
 import pyotp
-from fastapi import APIRouter, Cookie, Depends, Header, HTTPException, Response
-from fastapi_mail import ConnectionConfig, FastMail, MessageSchema, MessageType
+from fastapi import APIRouter, Cookie, Depends, Header, HTTPException, Request, Response
 from jose import jwt
 from jose.exceptions import JWTError
 from passlib.hash import bcrypt
@@ -14,8 +14,10 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 
 from cypher_cloud.config import settings
-from cypher_cloud.database import get_db
+from cypher_cloud.database import get_db, read_session
 from cypher_cloud.models import Passkey, User
+from cypher_cloud.profiling import span
+from cypher_cloud.ratelimit import enforce
 from cypher_cloud.schemas import (
     ChangePasswordRequest,
     ConfirmEmailRequest,
@@ -34,48 +36,45 @@ from cypher_cloud.schemas import (
     PasskeyLoginOptionsResponse,
     PasskeyLoginVerifyRequest,
 )
-from webauthn import (
-    generate_authentication_options,
-    generate_registration_options,
-    verify_authentication_response,
-    verify_registration_response,
-    options_to_json,
-)
-from webauthn.helpers.structs import (
-    AuthenticationCredential,
-    AuthenticatorAssertionResponse,
-    AuthenticatorAttestationResponse,
-    AuthenticatorTransport,
-    RegistrationCredential,
-    UserVerificationRequirement,
-    PublicKeyCredentialDescriptor,
-    PublicKeyCredentialType,
-)
+
+# fastapi_mail и webauthn заметно удлиняют импорт (~1 с), а нужны только
+# регистрации, сбросу пароля и passkey — импортируются при первом вызове
+if TYPE_CHECKING:
+    from fastapi_mail import FastMail
+    from webauthn.helpers.structs import (
+        AuthenticationCredential,
+        RegistrationCredential,
+    )
 
 router = APIRouter()
 
-# Настройка SMTP для FastMail
-mail_conf = ConnectionConfig(
-    MAIL_USERNAME=settings.MAIL_USERNAME,
-    MAIL_PASSWORD=settings.MAIL_PASSWORD,
-    MAIL_FROM=settings.MAIL_FROM,
-    MAIL_SERVER=settings.MAIL_SERVER,
-    MAIL_PORT=settings.MAIL_PORT,
-    MAIL_STARTTLS=settings.MAIL_STARTTLS,
-    MAIL_SSL_TLS=settings.MAIL_SSL_TLS,
-    USE_CREDENTIALS=True,
-    VALIDATE_CERTS=True,
-)
-fm = FastMail(mail_conf)
-
-# JWT-настройки
-SECRET_KEY = settings.SECRET_KEY
-ALGORITHM = settings.ALGORITHM
-ACCESS_TOKEN_EXPIRE_SECONDS = settings.ACCESS_TOKEN_EXPIRE_SECONDS
-ISSUER_NAME = settings.ISSUER_NAME
-RP_ID = urlparse(settings.site_url).hostname or settings.site_url
+
+@lru_cache
+def get_mailer() -> "FastMail":
+    """FastMail с настройками SMTP; создается при первом письме."""
+    from fastapi_mail import ConnectionConfig, FastMail
+
+    return FastMail(
+        ConnectionConfig(
+            MAIL_USERNAME=settings.MAIL_USERNAME,
+            MAIL_PASSWORD=settings.MAIL_PASSWORD,
+            MAIL_FROM=settings.MAIL_FROM,
+            MAIL_SERVER=settings.MAIL_SERVER,
+            MAIL_PORT=settings.MAIL_PORT,
+            MAIL_STARTTLS=settings.MAIL_STARTTLS,
+            MAIL_SSL_TLS=settings.MAIL_SSL_TLS,
+            USE_CREDENTIALS=True,
+            VALIDATE_CERTS=True,
+        )
+    )
+
+
 RP_NAME = "Cypher Cloud"
-ORIGIN = settings.site_url
+
+
+def _rp_id() -> str:
+    return urlparse(settings.site_url).hostname or settings.site_url
+
 
 registration_challenges: Dict[int, bytes] = {}
 authentication_challenges: Dict[int, bytes] = {}
@@ -94,19 +93,25 @@ def set_session_cookie(response: Response, user: User):
     now = int(time.time())
     payload = {
         "sub": str(user.id),
-        "exp": now + ACCESS_TOKEN_EXPIRE_SECONDS,
-        "iss": ISSUER_NAME,
+        "exp": now + settings.ACCESS_TOKEN_EXPIRE_SECONDS,
+        "iss": settings.ISSUER_NAME,
     }
-    token = jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
+    token = jwt.encode(payload, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
     response.set_cookie(
         key="access_token",
         value=token,
         httponly=True,
-        expires=ACCESS_TOKEN_EXPIRE_SECONDS,
+        expires=settings.ACCESS_TOKEN_EXPIRE_SECONDS,
     )
 
 
-def build_registration_credential(payload: dict) -> RegistrationCredential:
+def build_registration_credential(payload: dict) -> "RegistrationCredential":
+    from webauthn.helpers.structs import (
+        AuthenticatorAttestationResponse,
+        PublicKeyCredentialType,
+        RegistrationCredential,
+    )
+
     # rawId из payload - это base64url-encoded string
     raw_id_str = payload.get("rawId") or payload.get("id")
     if not raw_id_str:
@@ -126,7 +131,13 @@ def build_registration_credential(payload: dict) -> RegistrationCredential:
     )
 
 
-def build_authentication_credential(payload: dict) -> AuthenticationCredential:
+def build_authentication_credential(payload: dict) -> "AuthenticationCredential":
+    from webauthn.helpers.structs import (
+        AuthenticationCredential,
+        AuthenticatorAssertionResponse,
+        PublicKeyCredentialType,
+    )
+
     response = payload["response"]
     # Получаем rawId - это base64url-encoded string
     raw_id_str = payload.get("rawId") or payload.get("id")
@@ -149,33 +160,38 @@ def build_authentication_credential(payload: dict) -> AuthenticationCredential:
 
 
 async def get_user_by_email(session: AsyncSession, email: str) -> Optional[User]:
-    result = await session.execute(select(User).where(User.email == email))
-    return result.scalars().first()
+    with span("db"):
+        result = await session.execute(select(User).where(User.email == email))
+        return result.scalars().first()
 
 
 async def get_user_by_id(session: AsyncSession, user_id: int) -> Optional[User]:
-    result = await session.execute(select(User).where(User.id == user_id))
-    return result.scalars().first()
+    with span("db"):
+        result = await session.execute(select(User).where(User.id == user_id))
+        return result.scalars().first()
 
 
 async def get_passkeys_for_user(session: AsyncSession, user_id: int) -> list[Passkey]:
-    result = await session.execute(select(Passkey).where(Passkey.user_id == user_id))
-    return list(result.scalars().all())
+    with span("db"):
+        result = await session.execute(
+            select(Passkey).where(Passkey.user_id == user_id)
+        )
+        return list(result.scalars().all())
 
 
 async def get_passkey_by_credential_id(
     session: AsyncSession, credential_id: str
 ) -> Optional[Passkey]:
-    result = await session.execute(
-        select(Passkey).where(Passkey.credential_id == credential_id)
-    )
-    return result.scalars().first()
+    with span("db"):
+        result = await session.execute(
+            select(Passkey).where(Passkey.credential_id == credential_id)
+        )
+        return result.scalars().first()
 
 
 async def get_current_user(
     authorization: Optional[str] = Header(None),
     access_token: Optional[str] = Cookie(None),
-    db: AsyncSession = Depends(get_db),
 ) -> User:
     # Выбираем токен из куки или заголовка
     token = access_token
@@ -190,12 +206,16 @@ async def get_current_user(
 
     # Декодируем JWT
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        with span("auth"):
+            payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
     user_id = int(payload.get("sub"))
-    user = await get_user_by_id(db, user_id)
+    # Отдельная короткая сессия на реплике: соединение сразу возвращается в пул,
+    # а отсоединенный объект можно добавить в сессию эндпоинта для записи
+    async with read_session() as session:
+        user = await get_user_by_id(session, user_id)
     if not user or not user.is_active:
         raise HTTPException(status_code=401, detail="User not active or not found")
     return user
@@ -204,8 +224,13 @@ async def get_current_user(
 @router.post("/register")
 async def register_user(
     req: RegisterRequest,
+    request: Request,
     db: AsyncSession = Depends(get_db),
 ):
+    from fastapi_mail import MessageSchema, MessageType
+
+    # Лимит и по адресу: регистрация шлет письмо на чужой email
+    await enforce(request, "register", req.email)
     # Проверяем уникальность email
     if await get_user_by_email(db, req.email):
         raise HTTPException(
@@ -213,11 +238,13 @@ async def register_user(
         )
 
     # Создаём пользователя
-    hashed = bcrypt.hash(req.password)
+    with span("auth"):
+        hashed = bcrypt.hash(req.password)
     new_user = User(email=req.email, hashed_password=hashed)
     db.add(new_user)
-    await db.commit()
-    await db.refresh(new_user)
+    with span("db"):
+        await db.commit()
+        await db.refresh(new_user)
 
     # Генерируем токен подтверждения email
     now = int(time.time())
@@ -227,8 +254,8 @@ async def register_user(
             "exp": now + settings.EMAIL_CONFIRM_EXPIRE_SECONDS,
             "type": "email_confirm",
         },
-        SECRET_KEY,
-        algorithm=ALGORITHM,
+        settings.SECRET_KEY,
+        algorithm=settings.ALGORITHM,
     )
     confirm_url = f"{settings.NEXT_PUBLIC_BASE_URL.rstrip('/api/v1')}/confirm-email?token={token}"
     message = MessageSchema(
@@ -237,7 +264,8 @@ async def register_user(
         body=f"Перейдите по ссылке, чтобы подтвердить регистрацию:\n\n{confirm_url}",
         subtype=MessageType.plain,
     )
-    await fm.send_message(message)
+    with span("mail"):
+        await get_mailer().send_message(message)
 
     return {
         "status": "ok",
@@ -251,7 +279,7 @@ async def confirm_email(
     db: AsyncSession = Depends(get_db),
 ):
     try:
-        payload = jwt.decode(req.token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(req.token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
         if payload.get("type") != "email_confirm":
             raise JWTError()
     except JWTError:
@@ -266,18 +294,25 @@ async def confirm_email(
 
     user.email_confirmed = True
     db.add(user)
-    await db.commit()
+    with span("db"):
+        await db.commit()
     return {"status": "ok", "message": "Email confirmed"}
 
 
 @router.post("/login")
 async def login_user(
     req: LoginRequest,
+    request: Request,
     response: Response,
     db: AsyncSession = Depends(get_db),
 ):
+    await enforce(request, "login", req.email)
     user = await get_user_by_email(db, req.email)
-    if not user or not bcrypt.verify(req.password, user.hashed_password):
+    with span("auth"):
+        verified = user is not None and bcrypt.verify(
+            req.password, user.hashed_password
+        )
+    if not verified:
         raise HTTPException(status_code=401, detail="Invalid credentials")
 
     if not user.email_confirmed:
@@ -298,9 +333,18 @@ async def login_user(
 
 @router.get("/passkey/register-options", response_model=PasskeyRegistrationOptionsResponse)
 async def get_passkey_registration_options(
+    request: Request,
     db: AsyncSession = Depends(get_db),
     user: User = Depends(get_current_user),
 ):
+    from webauthn import generate_registration_options, options_to_json
+    from webauthn.helpers.structs import (
+        AuthenticatorTransport,
+        PublicKeyCredentialDescriptor,
+        PublicKeyCredentialType,
+    )
+
+    await enforce(request, "passkey", user.id)
     existing = await get_passkeys_for_user(db, user.id)
     exclude_credentials = [
         PublicKeyCredentialDescriptor(
@@ -313,7 +357,7 @@ async def get_passkey_registration_options(
 
     options = generate_registration_options(
         rp_name=RP_NAME,
-        rp_id=RP_ID,
+        rp_id=_rp_id(),
         user_id=str(user.id).encode(),
         user_name=user.email,
         user_display_name=user.email,
@@ -326,21 +370,26 @@ async def get_passkey_registration_options(
 @router.post("/passkey/register-verify")
 async def verify_passkey_registration(
     req: PasskeyVerifyRegistrationRequest,
+    request: Request,
     db: AsyncSession = Depends(get_db),
     user: User = Depends(get_current_user),
 ):
+    from webauthn import verify_registration_response
+
+    await enforce(request, "passkey", user.id)
     expected_challenge = registration_challenges.get(user.id)
     if not expected_challenge:
         raise HTTPException(status_code=400, detail="Registration challenge not found")
 
     try:
         credential_obj = build_registration_credential(req.credential)
-        verification = verify_registration_response(
-            credential=credential_obj,
-            expected_challenge=expected_challenge,
-            expected_origin=ORIGIN,
-            expected_rp_id=RP_ID,
-        )
+        with span("auth"):
+            verification = verify_registration_response(
+                credential=credential_obj,
+                expected_challenge=expected_challenge,
+                expected_origin=settings.site_url,
+                expected_rp_id=_rp_id(),
+            )
     except Exception as exc:  # pylint: disable=broad-except
         raise HTTPException(status_code=400, detail=f"Passkey verify failed: {exc}")
 
@@ -356,7 +405,8 @@ async def verify_passkey_registration(
         ),
     )
     db.add(new_passkey)
-    await db.commit()
+    with span("db"):
+        await db.commit()
     if user.id in registration_challenges:
         registration_challenges.pop(user.id)
     return {"status": "ok"}
@@ -365,8 +415,18 @@ async def verify_passkey_registration(
 @router.post("/passkey/login-options", response_model=PasskeyLoginOptionsResponse)
 async def get_passkey_login_options(
     req: PasskeyLoginOptionsRequest,
+    request: Request,
     db: AsyncSession = Depends(get_db),
 ):
+    from webauthn import generate_authentication_options, options_to_json
+    from webauthn.helpers.structs import (
+        AuthenticatorTransport,
+        PublicKeyCredentialDescriptor,
+        PublicKeyCredentialType,
+        UserVerificationRequirement,
+    )
+
+    await enforce(request, "login", req.email)
     user = await get_user_by_email(db, req.email)
     if not user or not user.email_confirmed:
         raise HTTPException(status_code=404, detail="User not found or not confirmed")
@@ -385,7 +445,7 @@ async def get_passkey_login_options(
     ]
 
     options = generate_authentication_options(
-        rp_id=RP_ID,
+        rp_id=_rp_id(),
         user_verification=UserVerificationRequirement.PREFERRED,
         allow_credentials=allow_credentials,
     )
@@ -396,9 +456,13 @@ async def get_passkey_login_options(
 @router.post("/passkey/login-verify")
 async def verify_passkey_login(
     req: PasskeyLoginVerifyRequest,
+    request: Request,
     response: Response,
     db: AsyncSession = Depends(get_db),
 ):
+    from webauthn import verify_authentication_response
+
+    await enforce(request, "login", req.email)
     user = await get_user_by_email(db, req.email)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -418,20 +482,22 @@ async def verify_passkey_login(
 
     try:
         credential_obj = build_authentication_credential(req.credential)
-        verification = verify_authentication_response(
-            credential=credential_obj,
-            expected_challenge=expected_challenge,
-            expected_rp_id=RP_ID,
-            expected_origin=ORIGIN,
-            credential_public_key=b64decode(passkey.public_key),
-            credential_current_sign_count=passkey.sign_count,
-        )
+        with span("auth"):
+            verification = verify_authentication_response(
+                credential=credential_obj,
+                expected_challenge=expected_challenge,
+                expected_rp_id=_rp_id(),
+                expected_origin=settings.site_url,
+                credential_public_key=b64decode(passkey.public_key),
+                credential_current_sign_count=passkey.sign_count,
+            )
     except Exception as exc:  # pylint: disable=broad-except
         raise HTTPException(status_code=400, detail=f"Passkey login failed: {exc}")
 
     passkey.sign_count = verification.new_sign_count
     db.add(passkey)
-    await db.commit()
+    with span("db"):
+        await db.commit()
     if user.id in authentication_challenges:
         authentication_challenges.pop(user.id)
     set_session_cookie(response, user)
@@ -446,11 +512,12 @@ async def setup_2fa(
     secret = pyotp.random_base32()
     user.totp_secret = secret
     db.add(user)
-    await db.commit()
-    await db.refresh(user)
+    with span("db"):
+        await db.commit()
+        await db.refresh(user)
 
     otpauth_url = pyotp.TOTP(secret).provisioning_uri(
-        user.email, issuer_name=ISSUER_NAME
+        user.email, issuer_name=settings.ISSUER_NAME
     )
     return Setup2FAResponse(otpauth_url=otpauth_url)
 
@@ -458,9 +525,11 @@ async def setup_2fa(
 @router.post("/verify-2fa")
 async def verify_2fa(
     req: Verify2FARequest,
+    request: Request,
     db: AsyncSession = Depends(get_db),
     user: User = Depends(get_current_user),
 ):
+    await enforce(request, "login", user.id)
     if not user.totp_secret:
         raise HTTPException(status_code=400, detail="2FA не включен")
 
@@ -474,8 +543,12 @@ async def verify_2fa(
 @router.post("/request-password-reset")
 async def request_password_reset(
     req: PasswordResetRequest,
+    request: Request,
     db: AsyncSession = Depends(get_db),
 ):
+    from fastapi_mail import MessageSchema
+
+    await enforce(request, "mail", req.email)
     user = await get_user_by_email(db, req.email)
     if user:
         now = int(time.time())
@@ -485,8 +558,8 @@ async def request_password_reset(
                 "exp": now + settings.PASSWORD_RESET_EXPIRE_SECONDS,
                 "type": "password_reset",
             },
-            SECRET_KEY,
-            algorithm=ALGORITHM,
+            settings.SECRET_KEY,
+            algorithm=settings.ALGORITHM,
         )
         reset_url = f"{settings.NEXT_PUBLIC_BASE_URL.rstrip('/api/v1')}/reset-password?token={token}"
         message = MessageSchema(
@@ -495,7 +568,8 @@ async def request_password_reset(
             body=f"Чтобы сбросить пароль, перейдите по ссылке:\n\n{reset_url}",
             subtype="plain",
         )
-        await fm.send_message(message)
+        with span("mail"):
+            await get_mailer().send_message(message)
 
     # Независимо от результата скрываем факт существования email
     return {"status": "ok", "message": "If this email is registered, check your inbox"}
@@ -507,7 +581,7 @@ async def reset_password(
     db: AsyncSession = Depends(get_db),
 ):
     try:
-        payload = jwt.decode(req.token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(req.token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
         if payload.get("type") != "password_reset":
             raise JWTError()
     except JWTError:
@@ -518,33 +592,41 @@ async def reset_password(
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    user.hashed_password = bcrypt.hash(req.new_password)
+    with span("auth"):
+        user.hashed_password = bcrypt.hash(req.new_password)
     db.add(user)
-    await db.commit()
+    with span("db"):
+        await db.commit()
     return {"status": "ok", "message": "Password has been reset"}
 
 
 @router.post("/change-password")
 async def change_password(
     req: ChangePasswordRequest,
+    request: Request,
     db: AsyncSession = Depends(get_db),
     user: User = Depends(get_current_user),
 ):
-    if not bcrypt.verify(req.old_password, user.hashed_password):
-        raise HTTPException(status_code=400, detail="Invalid current password")
+    await enforce(request, "login", user.id)
+    with span("auth"):
+        if not bcrypt.verify(req.old_password, user.hashed_password):
+            raise HTTPException(status_code=400, detail="Invalid current password")
 
-    user.hashed_password = bcrypt.hash(req.new_password)
+        user.hashed_password = bcrypt.hash(req.new_password)
     db.add(user)
-    await db.commit()
+    with span("db"):
+        await db.commit()
     return {"status": "ok", "message": "Password changed successfully"}
 
 
 @router.post("/disable-2fa")
 async def disable_2fa(
     req: Disable2FARequest,
+    request: Request,
     db: AsyncSession = Depends(get_db),
     user: User = Depends(get_current_user),
 ):
+    await enforce(request, "login", user.id)
     if not user.totp_secret:
         raise HTTPException(status_code=400, detail="2FA не включен")
 
@@ -554,7 +636,8 @@ async def disable_2fa(
 
     user.totp_secret = None
     db.add(user)
-    await db.commit()
+    with span("db"):
+        await db.commit()
     return {"status": "ok", "message": "2FA has been disabled"}
 
 
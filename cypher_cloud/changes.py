@@ -0,0 +1,341 @@
+"""Журнал изменений файлов для инкрементальной синхронизации.
+
+У каждого пользователя монотонный счетчик `users.change_seq`. Загрузка,
+удаление, переименование и изменения версий дописывают в `file_changes`
+событие со следующим номером, и клиент забирает только то, что новее его
+курсора: `GET /files/changes?since=<cursor>`.
+
+Номера выдаются прямо перед коммитом: `UPDATE users ... RETURNING` берет
+блокировку строки пользователя до конца транзакции. Поэтому номера одного
+пользователя идут без пропусков и становятся видимы строго по порядку —
+клиент, получивший событие N, уже не пропустит событие с меньшим номером.
+Блокировка держится только на время коммита, загрузки не ждут друг друга.
+
+Ожидание новых событий (long-poll `?wait=` и SSE `/changes/stream`) построено
+на LISTEN/NOTIFY: `pg_notify` отправляется вместе с коммитом, а одно
+выделенное соединение на процесс будит ожидающие запросы. Если уведомление
+потерялось (переподключение), ожидание все равно перепроверяет журнал раз в
+`CHANGES_POLL_SECONDS`.
+
+Старые события удаляются командой
+
+    python -m cypher_cloud.changes prune --days 30
+
+после чего курсор старше удаленной части получает 410 — клиент должен заново
+загрузить `/files/list` и продолжить с `cursor` из ответа `/files/changes`.
+"""
+
+import argparse
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Dict, List, NamedTuple, Optional, Tuple
+
+import asyncpg
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy import insert, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from cypher_cloud.auth import get_current_user
+from cypher_cloud.config import settings
+from cypher_cloud.database import async_session, dispose_engines
+from cypher_cloud.models import FileChange, User
+from cypher_cloud.profiling import span
+from cypher_cloud.schemas import FileChangeItem, FileChangesResponse
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+CHANNEL = "file_changes"
+CHANGES_MAX_WAIT = 60  # сек, верхняя граница ?wait=
+SSE_BATCH_SIZE = 500
+
+_waiters: Dict[int, asyncio.Event] = {}
+_listener: Optional[asyncio.Task] = None
+
+
+class Change(NamedTuple):
+    # upload | delete | rename | move | version |
+    # folder_create | folder_update | folder_delete (без file_id)
+    kind: str
+    file_id: Optional[int]
+    filename: Optional[str] = None
+    version: Optional[int] = None
+    folder_id: Optional[int] = None
+
+
+async def record_changes(db: AsyncSession, owner_id: int, changes: List[Change]) -> int:
+    """Дописываем события в журнал; вызывать непосредственно перед коммитом.
+    Возвращаем номер последнего события."""
+    if not changes:
+        return 0
+    with span("db"):
+        last = await db.scalar(
+            text(
+                "UPDATE users SET change_seq = change_seq + :n "
+                "WHERE id = :id RETURNING change_seq"
+            ),
+            {"n": len(changes), "id": owner_id},
+        )
+        first = last - len(changes) + 1
+        await db.execute(
+            insert(FileChange),
+            [
+                {"owner_id": owner_id, "seq": first + i, **change._asdict()}
+                for i, change in enumerate(changes)
+            ],
+        )
+        await db.execute(
+            text("SELECT pg_notify(:channel, :owner)"),
+            {"channel": CHANNEL, "owner": str(owner_id)},
+        )
+    return last
+
+
+# --- Ожидание новых событий --------------------------------------------------
+
+
+def _notify(connection, pid, channel, payload: str) -> None:
+    event = _waiters.pop(int(payload), None)
+    if event is not None:
+        event.set()
+
+
+def _wake_all() -> None:
+    for event in _waiters.values():
+        event.set()
+    _waiters.clear()
+
+
+async def _listen() -> None:
+    """Одно соединение с LISTEN на процесс; переподключается при обрыве."""
+    while True:
+        connection = None
+        try:
+            connection = await asyncpg.connect(
+                host=settings.db_host,
+                port=settings.db_port,
+                user=settings.db_user,
+                password=settings.db_password,
+                database=settings.db_name,
+            )
+            closed = asyncio.get_running_loop().create_future()
+            connection.add_termination_listener(
+                lambda _: closed.done() or closed.set_result(None)
+            )
+            await connection.add_listener(CHANNEL, _notify)
+            # События между обрывом и новым LISTEN могли потеряться
+            _wake_all()
+            await closed
+            logger.warning("Change feed listener disconnected")
+        except asyncio.CancelledError:
+            raise
+        except Exception:  # noqa: BLE001
+            logger.exception("Change feed listener failed")
+        finally:
+            if connection is not None and not connection.is_closed():
+                await connection.close()
+        await asyncio.sleep(1)
+
+
+def _ensure_listener() -> None:
+    global _listener
+    if _listener is None or _listener.done():
+        _listener = asyncio.create_task(_listen())
+
+
+async def stop_listener() -> None:
+    global _listener
+    if _listener is not None:
+        _listener.cancel()
+        try:
+            await _listener
+        except asyncio.CancelledError:
+            pass
+        _listener = None
+
+
+async def _wait_for_change(event: asyncio.Event, timeout: float) -> None:
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+
+
+# --- Чтение журнала ----------------------------------------------------------
+
+
+def _subscribe(owner_id: int) -> asyncio.Event:
+    """Подписываемся до чтения журнала, чтобы не пропустить событие между ними."""
+    _ensure_listener()
+    return _waiters.setdefault(owner_id, asyncio.Event())
+
+
+async def _position(db: AsyncSession, owner_id: int) -> Tuple[int, int]:
+    """Номер последнего события и граница удаленной части журнала."""
+    result = await db.execute(
+        select(User.change_seq, User.changes_floor).where(User.id == owner_id)
+    )
+    seq, floor = result.one()
+    return seq, floor
+
+
+async def _current(owner_id: int) -> Tuple[int, int]:
+    async with async_session() as db:
+        with span("db"):
+            return await _position(db, owner_id)
+
+
+async def _fetch(
+    owner_id: int, since: int, limit: int
+) -> Tuple[List[FileChange], int, int]:
+    """События после `since`, номер последнего события и граница журнала.
+
+    Читаем с основной БД (реплика может отставать от уведомления), каждый раз
+    короткой сессией: ожидание не держит соединение из пула."""
+    async with async_session() as db:
+        with span("db"):
+            seq, floor = await _position(db, owner_id)
+            if since >= seq:
+                return [], seq, floor
+            result = await db.execute(
+                select(FileChange)
+                .where(FileChange.owner_id == owner_id, FileChange.seq > since)
+                .order_by(FileChange.seq)
+                .limit(limit)
+            )
+            return list(result.scalars().all()), seq, floor
+
+
+def _check_cursor(since: int, seq: int, floor: int) -> None:
+    if since > seq or since < floor:
+        raise HTTPException(
+            status_code=status.HTTP_410_GONE,
+            detail="Курсор устарел, нужна полная синхронизация",
+        )
+
+
+def _item(change: FileChange) -> FileChangeItem:
+    return FileChangeItem.model_validate(change)
+
+
+@router.get("/changes", response_model=FileChangesResponse)
+async def list_changes(
+    since: Optional[int] = Query(None, ge=0),
+    limit: int = Query(500, ge=1, le=1000),
+    wait: int = Query(0, ge=0, le=CHANGES_MAX_WAIT),
+    user: User = Depends(get_current_user),
+):
+    """События после курсора `since`. Без `since` — только текущий курсор:
+    с него клиент продолжает после полной загрузки `/files/list`. С `wait`
+    запрос до `wait` секунд ждет хотя бы одного события."""
+    if since is None:
+        seq, _ = await _current(user.id)
+        return FileChangesResponse(changes=[], cursor=seq, has_more=False)
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + wait
+    while True:
+        event = _subscribe(user.id) if wait else None
+        changes, seq, floor = await _fetch(user.id, since, limit)
+        _check_cursor(since, seq, floor)
+        remaining = deadline - loop.time()
+        if changes or remaining <= 0:
+            break
+        await _wait_for_change(event, min(remaining, settings.CHANGES_POLL_SECONDS))
+
+    cursor = changes[-1].seq if changes else since
+    return FileChangesResponse(
+        changes=[_item(change) for change in changes],
+        cursor=cursor,
+        has_more=cursor < seq,
+    )
+
+
+def _sse(change: FileChange) -> str:
+    data = _item(change).model_dump_json()
+    return f"id: {change.seq}\nevent: change\ndata: {data}\n\n"
+
+
+async def _stream(owner_id: int, cursor: int) -> AsyncIterator[str]:
+    yield "retry: 3000\n\n"
+    while True:
+        event = _subscribe(owner_id)
+        changes, _, floor = await _fetch(owner_id, cursor, SSE_BATCH_SIZE)
+        if cursor < floor:
+            yield "event: reset\ndata: {}\n\n"
+            return
+        if changes:
+            yield "".join(_sse(change) for change in changes)
+            cursor = changes[-1].seq
+            continue
+        await _wait_for_change(event, settings.CHANGES_POLL_SECONDS)
+        if not event.is_set():
+            yield ": ping\n\n"  # не даем прокси закрыть простаивающее соединение
+
+
+@router.get("/changes/stream")
+async def stream_changes(
+    since: Optional[int] = Query(None, ge=0),
+    last_event_id: Optional[str] = Header(None),
+    user: User = Depends(get_current_user),
+):
+    """Server-Sent Events: каждое событие журнала с `id` = его номер.
+    При переподключении браузер сам присылает `Last-Event-ID`. Событие
+    `reset` означает, что курсор устарел и нужна полная синхронизация."""
+    if last_event_id is not None and last_event_id.isdigit():
+        since = int(last_event_id)
+    seq, floor = await _current(user.id)
+    if since is None:
+        since = seq
+    _check_cursor(since, seq, floor)
+    return StreamingResponse(
+        _stream(user.id, since),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# --- Очистка журнала ---------------------------------------------------------
+
+
+async def prune(older_than: timedelta) -> int:
+    """Удаляем старые события и сдвигаем границу журнала пользователей."""
+    cutoff = datetime.now(timezone.utc) - older_than
+    async with async_session() as db:
+        async with db.begin():
+            result = await db.execute(
+                text(
+                    "WITH pruned AS ("
+                    "DELETE FROM file_changes WHERE created_at < :cutoff "
+                    "RETURNING owner_id, seq), "
+                    "floors AS (SELECT owner_id, max(seq) AS seq FROM pruned "
+                    "GROUP BY owner_id) "
+                    "UPDATE users u SET changes_floor = greatest(u.changes_floor, f.seq) "
+                    "FROM floors f WHERE u.id = f.owner_id "
+                    "RETURNING (SELECT count(*) FROM pruned)"
+                ),
+                {"cutoff": cutoff},
+            )
+            counts = result.scalars().all()
+    return counts[0] if counts else 0
+
+
+async def _main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Cypher Cloud change feed")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run = sub.add_parser("prune", help="удалить старые события журнала")
+    run.add_argument("--days", type=int, default=30, help="хранить N дней")
+    args = parser.parse_args(argv)
+    try:
+        print(await prune(timedelta(days=args.days)))
+    finally:
+        await dispose_engines()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    asyncio.run(_main())
@@ -0,0 +1,48 @@
+"""Разбиение содержимого на чанки по содержимому (content-defined chunking).
+
+Граница чанка зависит только от последних `bits` байт перед ней, поэтому
+вставка или удаление в середине файла сдвигает лишь соседние границы, а
+остальные чанки новой версии совпадают с чанками предыдущей.
+
+Каждый байт через фиксированную таблицу дает один бит (ровно половина
+значений байта — единицы). Граница ставится там, где последние `bits` бит
+совпадают с фиксированным шаблоном: для случайных данных это происходит в
+среднем раз в 2**bits байт. И отображение (`bytes.translate`), и поиск
+шаблона (`bytes.find`) выполняются в C, без цикла по байтам в Python.
+"""
+
+import hashlib
+from typing import Iterator, Tuple
+
+
+def _bit_table() -> bytes:
+    # Детерминированная перестановка байтов: первые 128 дают b"1", остальные b"0"
+    order = sorted(range(256), key=lambda b: hashlib.sha256(b"cdc:%d" % b).digest())
+    table = bytearray(b"0" * 256)
+    for value in order[:128]:
+        table[value] = ord("1")
+    return bytes(table)
+
+
+_TABLE = _bit_table()
+# Чередование нулей и единиц не встречается в однородных данных (нули, пробелы)
+_PATTERN = b"0110" * 16
+
+
+def chunk_boundaries(
+    data: bytes, min_size: int, avg_size: int, max_size: int
+) -> Iterator[Tuple[int, int]]:
+    """Возвращает (start, end) чанков, покрывающих `data` целиком."""
+    bits = max(1, min((avg_size - min_size).bit_length() - 1, len(_PATTERN)))
+    pattern = _PATTERN[:bits]
+    signature = data.translate(_TABLE)
+    start, length = 0, len(data)
+    while start < length:
+        if length - start <= min_size:
+            yield start, length
+            return
+        limit = min(start + max_size, length)
+        found = signature.find(pattern, start + min_size - bits, limit)
+        end = found + bits if found != -1 else limit
+        yield start, end
+        start = end
@@ -0,0 +1,598 @@
+"""Асинхронный клиент API Cypher Cloud и CLI для массовых передач.
+
+Сессия — один `httpx.AsyncClient`: общий пул соединений (HTTP/2 поверх TLS,
+если установлен `h2`) и cookie сессии после `login`. Загрузки и скачивания
+идут параллельно, не больше `concurrency` запросов одновременно. Файлы
+читаются и пишутся потоково, целиком в память не попадают. Запросы
+повторяются с экспоненциальной задержкой (или по `Retry-After`):
+
+- любой запрос — если соединение не установилось или сервер ответил 429
+  (запрос отклонен до обработки);
+- идемпотентный (GET, PUT, DELETE) — еще и при сетевых ошибках и 502/503/504.
+
+CLI (`pip install 'cypher-cloud[client]'`):
+
+    export CYPHER_URL=https://cloud.example.com/api/v1 CYPHER_EMAIL=me@example.com
+    python -m cypher_cloud.client push backup/*.tar --folder-id 3
+    python -m cypher_cloud.client pull ./restore --folder-id 3
+    python -m cypher_cloud.client sync ./documents
+
+Пароль берется из `CYPHER_PASSWORD` или спрашивается, код 2FA — `--code`.
+Каждая команда печатает число файлов, объем и пропускную способность.
+"""
+
+import argparse
+import asyncio
+import getpass
+import json
+import os
+import random
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import httpx
+
+# Мелкие файлы загружаются пачками: накладные расходы на запрос заметнее
+# самой передачи. Не больше MAX_FILES_COUNT сервера (files.py)
+BATCH_MAX_FILES = 10
+BATCH_MAX_BYTES = 8 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+RETRY_STATUSES = {429, 502, 503, 504}
+MANIFEST_NAME = ".cypher-sync.json"
+# Без фильтра по папке: folder_id=None означает корень, а не «все папки»
+ALL_FOLDERS = -1
+
+
+class ClientError(Exception):
+    def __init__(self, status_code: int, detail: str) -> None:
+        super().__init__(f"{status_code}: {detail}")
+        self.status_code = status_code
+        self.detail = detail
+
+
+class UploadResult(NamedTuple):
+    path: Path
+    file_id: Optional[int]
+    size: int
+    error: Optional[str] = None
+
+
+class DownloadResult(NamedTuple):
+    file_id: int
+    path: Path
+    size: int
+    # None — не изменился (304), файл на диске не трогали
+    etag: Optional[str]
+    error: Optional[str] = None
+
+
+class TransferStats:
+    """Счетчики одной команды для отчета о пропускной способности."""
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.files = 0
+        self.bytes = 0
+        self.unchanged = 0
+        self.failed = 0
+
+    def add(self, size: int) -> None:
+        self.files += 1
+        self.bytes += size
+
+    def summary(self, name: str) -> str:
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        mib = self.bytes / 1024**2
+        return (
+            f"{name}: {self.files} files, {mib:.1f} MiB in {elapsed:.1f} s "
+            f"({mib / elapsed:.1f} MiB/s, {self.files / elapsed:.1f} files/s), "
+            f"unchanged {self.unchanged}, failed {self.failed}"
+        )
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _batches(paths: Sequence[Path]) -> List[List[Path]]:
+    """Крупные файлы — по одному на запрос, мелкие — пачками."""
+    batches: List[List[Path]] = []
+    batch: List[Path] = []
+    batch_bytes = 0
+    for path in paths:
+        size = path.stat().st_size
+        if size >= BATCH_MAX_BYTES:
+            batches.append([path])
+            continue
+        if batch and (
+            len(batch) >= BATCH_MAX_FILES or batch_bytes + size > BATCH_MAX_BYTES
+        ):
+            batches.append(batch)
+            batch, batch_bytes = [], 0
+        batch.append(path)
+        batch_bytes += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class CypherClient:
+    """Клиент API: `async with CypherClient(url) as client: ...`."""
+
+    def __init__(
+        self,
+        base_url: str,
+        concurrency: int = 8,
+        retries: int = 4,
+        timeout: float = 300.0,
+        http2: bool = True,
+    ) -> None:
+        self.concurrency = max(1, concurrency)
+        self.retries = retries
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._http = httpx.AsyncClient(
+            base_url=base_url.rstrip("/"),
+            http2=http2 and _http2_available(),
+            limits=httpx.Limits(
+                max_connections=self.concurrency,
+                max_keepalive_connections=self.concurrency,
+            ),
+            timeout=httpx.Timeout(timeout, connect=10.0),
+        )
+
+    async def __aenter__(self) -> "CypherClient":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        await self._http.aclose()
+
+    # --- Запросы с повторами ----------------------------------------------
+
+    def _delay(self, attempt: int, response: Optional[httpx.Response]) -> float:
+        if response is not None:
+            retry_after = response.headers.get("retry-after", "")
+            if retry_after.isdigit():
+                return float(retry_after)
+        return min(30.0, 0.5 * 2**attempt) * random.uniform(0.5, 1.0)
+
+    async def _send(
+        self,
+        build: Callable[[], httpx.Request],
+        idempotent: bool,
+        stream: bool = False,
+    ) -> httpx.Response:
+        """Отправляем запрос, собирая его заново на каждую попытку (тело
+        из файлов читается с начала)."""
+        attempt = 0
+        while True:
+            response = None
+            try:
+                response = await self._http.send(build(), stream=stream)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout):
+                # Запрос не ушел на сервер
+                if attempt >= self.retries:
+                    raise
+            except httpx.TransportError:
+                if not idempotent or attempt >= self.retries:
+                    raise
+            else:
+                retryable = response.status_code == 429 or (
+                    idempotent and response.status_code in RETRY_STATUSES
+                )
+                if not retryable or attempt >= self.retries:
+                    return response
+                await response.aclose()
+            await asyncio.sleep(self._delay(attempt, response))
+            attempt += 1
+
+    async def _request(
+        self, method: str, url: str, idempotent: bool, **kwargs
+    ) -> httpx.Response:
+        response = await self._send(
+            lambda: self._http.build_request(method, url, **kwargs), idempotent
+        )
+        _raise_for_status(response)
+        return response
+
+    # --- Аутентификация ---------------------------------------------------
+
+    async def login(
+        self, email: str, password: str, code: Optional[str] = None
+    ) -> None:
+        """Вход; cookie сессии дальше отправляется с каждым запросом."""
+        payload = {"email": email, "password": password}
+        if code:
+            payload["code"] = code
+        await self._request("POST", "/auth/login", False, json=payload)
+
+    async def logout(self) -> None:
+        await self._request("POST", "/auth/logout", True)
+
+    async def me(self) -> dict:
+        return (await self._request("GET", "/auth/get-me", True)).json()
+
+    # --- Файлы ------------------------------------------------------------
+
+    async def list_files(self, folder_id: Optional[int] = ALL_FOLDERS) -> List[dict]:
+        """Файлы пользователя; `folder_id=None` — только корень."""
+        files = (await self._request("GET", "/files/list", True)).json()
+        if folder_id == ALL_FOLDERS:
+            return files
+        return [item for item in files if item.get("folder_id") == folder_id]
+
+    async def delete(self, file_id: int) -> None:
+        await self._request("DELETE", f"/files/{file_id}", True)
+
+    async def current_etag(self, file_id: int) -> Optional[str]:
+        """ETag текущей версии без передачи содержимого: `If-None-Match: *`
+        совпадает с любым тегом, и сервер отвечает 304."""
+        response = await self._request(
+            "GET",
+            f"/files/download/{file_id}",
+            True,
+            headers={"If-None-Match": "*"},
+        )
+        return response.headers.get("etag")
+
+    async def _upload_batch(
+        self, batch: List[Path], folder_id: Optional[int]
+    ) -> List[UploadResult]:
+        handles: list = []
+
+        def build() -> httpx.Request:
+            # httpx читает файлы кусками по мере отправки
+            _close_all(handles)
+            handles.extend(path.open("rb") for path in batch)
+            return self._http.build_request(
+                "POST",
+                "/files/upload",
+                params={} if folder_id is None else {"folder_id": folder_id},
+                files=[
+                    ("files", (path.name, handle, "application/octet-stream"))
+                    for path, handle in zip(batch, handles)
+                ],
+            )
+
+        try:
+            async with self._slots:
+                response = await self._send(build, idempotent=False)
+        except httpx.HTTPError as exc:
+            return [UploadResult(path, None, 0, repr(exc)) for path in batch]
+        finally:
+            _close_all(handles)
+        if response.status_code >= 400:
+            detail = _detail(response)
+            return [UploadResult(path, None, 0, detail) for path in batch]
+        return [
+            UploadResult(
+                path, item.get("file_id"), item.get("size") or 0, item.get("error")
+            )
+            for path, item in zip(batch, response.json()["results"])
+        ]
+
+    async def upload(
+        self, paths: Sequence[Path], folder_id: Optional[int] = None
+    ) -> List[UploadResult]:
+        """Загружаем файлы параллельно; ошибки — в `UploadResult.error`."""
+        results = await asyncio.gather(
+            *(self._upload_batch(batch, folder_id) for batch in _batches(paths))
+        )
+        return [result for batch in results for result in batch]
+
+    async def upload_version(self, file_id: int, path: Path) -> UploadResult:
+        """Новая версия существующего файла."""
+        handles: list = []
+
+        def build() -> httpx.Request:
+            _close_all(handles)
+            handles.append(path.open("rb"))
+            return self._http.build_request(
+                "POST",
+                f"/files/{file_id}/versions",
+                files={"file": (path.name, handles[0], "application/octet-stream")},
+            )
+
+        try:
+            async with self._slots:
+                response = await self._send(build, idempotent=False)
+            _raise_for_status(response)
+        except (httpx.HTTPError, ClientError) as exc:
+            return UploadResult(path, file_id, 0, str(exc))
+        finally:
+            _close_all(handles)
+        return UploadResult(path, file_id, response.json()["size"])
+
+    async def download(
+        self,
+        file_id: int,
+        dest: Path,
+        version: Optional[int] = None,
+        etag: Optional[str] = None,
+    ) -> DownloadResult:
+        """Скачиваем в `dest` через временный `.part` и rename. С `etag`
+        неизменившийся файл не передается (304, `etag` в ответе — None)."""
+        params = {} if version is None else {"version": version}
+        headers = {"If-None-Match": etag} if etag else {}
+        part = dest.with_name(dest.name + ".part")
+        attempt = 0
+        async with self._slots:
+            while True:
+                try:
+                    response = await self._send(
+                        lambda: self._http.build_request(
+                            "GET",
+                            f"/files/download/{file_id}",
+                            params=params,
+                            headers=headers,
+                        ),
+                        idempotent=True,
+                        stream=True,
+                    )
+                    try:
+                        if response.status_code == 304:
+                            return DownloadResult(file_id, dest, 0, None)
+                        if response.status_code >= 400:
+                            await response.aread()
+                            _raise_for_status(response)
+                        size = await _write_stream(response, part)
+                    finally:
+                        await response.aclose()
+                    break
+                except (httpx.ReadError, httpx.RemoteProtocolError, httpx.ReadTimeout):
+                    # Обрыв посреди тела: скачиваем заново
+                    if attempt >= self.retries:
+                        part.unlink(missing_ok=True)
+                        raise
+                    await asyncio.sleep(self._delay(attempt, None))
+                    attempt += 1
+                except BaseException:
+                    part.unlink(missing_ok=True)
+                    raise
+        os.replace(part, dest)
+        return DownloadResult(file_id, dest, size, response.headers.get("etag"))
+
+    async def download_many(
+        self, items: Sequence[Tuple[int, Path, Optional[str]]]
+    ) -> List[DownloadResult]:
+        """Параллельно скачиваем (file_id, путь, известный ETag или None)."""
+
+        async def one(file_id: int, dest: Path, etag: Optional[str]) -> DownloadResult:
+            try:
+                return await self.download(file_id, dest, etag=etag)
+            except (httpx.HTTPError, ClientError, OSError) as exc:
+                return DownloadResult(file_id, dest, 0, None, str(exc))
+
+        return await asyncio.gather(*(one(*item) for item in items))
+
+
+def _close_all(handles: list) -> None:
+    for handle in handles:
+        handle.close()
+    handles.clear()
+
+
+def _detail(response: httpx.Response) -> str:
+    try:
+        detail = response.json().get("detail")
+    except ValueError:
+        detail = None
+    return str(detail or response.reason_phrase)
+
+
+def _raise_for_status(response: httpx.Response) -> None:
+    # 304 — ответ на условный запрос, а не ошибка
+    if response.status_code >= 400:
+        raise ClientError(response.status_code, _detail(response))
+
+
+async def _write_stream(response: httpx.Response, path: Path) -> int:
+    size = 0
+    with path.open("wb") as f_out:
+        async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+            # Запись на диск — вне event loop, пока идут соседние передачи
+            await asyncio.to_thread(f_out.write, chunk)
+            size += len(chunk)
+    return size
+
+
+# --- CLI ---------------------------------------------------------------------
+
+
+def _expand(paths: Sequence[str]) -> List[Path]:
+    """Файлы из аргументов; каталоги — все файлы внутри (без структуры)."""
+    result: List[Path] = []
+    for value in paths:
+        path = Path(value)
+        if path.is_dir():
+            result.extend(sorted(p for p in path.rglob("*") if p.is_file()))
+        elif path.is_file():
+            result.append(path)
+        else:
+            raise SystemExit(f"No such file: {value}")
+    return result
+
+
+def _by_name(files: List[dict]) -> Dict[str, dict]:
+    """Имя -> файл; при одинаковых именах берем самый новый (больший id)."""
+    named: Dict[str, dict] = {}
+    for item in sorted(files, key=lambda item: item["id"]):
+        named[item["filename"]] = item
+    return named
+
+
+def _report_uploads(results: List[UploadResult], stats: TransferStats) -> None:
+    for result in results:
+        if result.error:
+            stats.failed += 1
+            print(f"failed {result.path}: {result.error}", file=sys.stderr)
+        else:
+            stats.add(result.size)
+
+
+def _report_downloads(results: List[DownloadResult], stats: TransferStats) -> None:
+    for result in results:
+        if result.error:
+            stats.failed += 1
+            print(f"failed {result.path}: {result.error}", file=sys.stderr)
+        elif result.etag is None:
+            stats.unchanged += 1
+        else:
+            stats.add(result.size)
+
+
+async def push(client: CypherClient, paths: List[Path], folder_id: Optional[int]):
+    stats = TransferStats()
+    _report_uploads(await client.upload(paths, folder_id), stats)
+    return stats
+
+
+async def pull(client: CypherClient, dest: Path, folder_id: Optional[int]):
+    stats = TransferStats()
+    dest.mkdir(parents=True, exist_ok=True)
+    remote = _by_name(await client.list_files(folder_id))
+    items = [(item["id"], dest / name, None) for name, item in remote.items()]
+    _report_downloads(await client.download_many(items), stats)
+    return stats
+
+
+def _local_state(path: Path) -> Dict[str, int]:
+    stat = path.stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+async def sync(client: CypherClient, directory: Path, folder_id: Optional[int]):
+    """Двусторонняя синхронизация каталога (без подкаталогов) с папкой.
+
+    Состояние прошлого прогона — в `.cypher-sync.json`: id, ETag и размер с
+    mtime локальной копии. Измененный локально файл уходит новой версией
+    (прежняя остается в истории версий), измененный на сервере скачивается;
+    неизменившиеся сверяются по ETag и стоят один ответ 304. Удаления не
+    переносятся ни в одну сторону.
+    """
+    stats = TransferStats()
+    directory.mkdir(parents=True, exist_ok=True)
+    manifest_path = directory / MANIFEST_NAME
+    manifest = {"folder_id": folder_id, "files": {}}
+    if manifest_path.exists():
+        manifest = json.loads(manifest_path.read_text())
+        if manifest.get("folder_id") != folder_id:
+            raise SystemExit(
+                f"{directory} is synced with folder {manifest.get('folder_id')}"
+            )
+    entries: Dict[str, dict] = manifest["files"]
+    remote = _by_name(await client.list_files(folder_id))
+    local = {
+        path.name: path
+        for path in directory.iterdir()
+        if path.is_file()
+        and path.name != MANIFEST_NAME
+        and not path.name.endswith(".part")
+    }
+
+    new_files: List[Path] = []
+    changed: List[Tuple[int, Path]] = []
+    downloads: List[Tuple[int, Path, Optional[str]]] = []
+    for name, path in local.items():
+        entry = entries.get(name)
+        item = remote.get(name)
+        if item is None:
+            new_files.append(path)
+        elif entry is None or entry.get("id") != item["id"]:
+            # Впервые видим пару: сервер сохранит прежнее содержимое в истории
+            changed.append((item["id"], path))
+        elif {k: entry.get(k) for k in ("size", "mtime_ns")} != _local_state(path):
+            changed.append((item["id"], path))
+        else:
+            downloads.append((item["id"], path, entry.get("etag")))
+    for name, item in remote.items():
+        if name not in local:
+            downloads.append((item["id"], directory / name, None))
+
+    uploaded = await client.upload(new_files, folder_id)
+    versions = await asyncio.gather(
+        *(client.upload_version(file_id, path) for file_id, path in changed)
+    )
+    _report_uploads(uploaded + list(versions), stats)
+    fetched = await client.download_many(downloads)
+    _report_downloads(fetched, stats)
+
+    async def remember(file_id: int, path: Path, etag: Optional[str]) -> None:
+        if etag is None:
+            try:
+                etag = await client.current_etag(file_id)
+            except (httpx.HTTPError, ClientError):
+                pass  # без тега следующий прогон скачает файл заново
+        entries[path.name] = {"id": file_id, "etag": etag, **_local_state(path)}
+
+    await asyncio.gather(
+        *(
+            remember(result.file_id, result.path, None)
+            for result in uploaded + list(versions)
+            if result.error is None and result.file_id is not None
+        ),
+        *(
+            remember(result.file_id, result.path, result.etag)
+            for result in fetched
+            if result.error is None and result.etag is not None
+        ),
+    )
+    tmp_path = manifest_path.with_name(MANIFEST_NAME + ".tmp")
+    tmp_path.write_text(json.dumps(manifest, indent=2, sort_keys=True))
+    os.replace(tmp_path, manifest_path)
+    return stats
+
+
+async def _main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Cypher Cloud bulk transfer client")
+    parser.add_argument("--url", default=os.environ.get("CYPHER_URL"))
+    parser.add_argument("--email", default=os.environ.get("CYPHER_EMAIL"))
+    parser.add_argument("--code", help="код 2FA")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--retries", type=int, default=4)
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--no-http2", action="store_true")
+    sub = parser.add_subparsers(dest="command", required=True)
+    push_parser = sub.add_parser("push", help="загрузить файлы и каталоги")
+    push_parser.add_argument("paths", nargs="+")
+    pull_parser = sub.add_parser("pull", help="скачать все файлы папки")
+    pull_parser.add_argument("dest")
+    sync_parser = sub.add_parser("sync", help="синхронизировать каталог с папкой")
+    sync_parser.add_argument("directory")
+    for command in (push_parser, pull_parser, sync_parser):
+        command.add_argument(
+            "--folder-id", type=int, default=None, help="папка (по умолчанию корень)"
+        )
+    args = parser.parse_args(argv)
+    if not args.url or not args.email:
+        parser.error("--url and --email (or CYPHER_URL, CYPHER_EMAIL) are required")
+    password = os.environ.get("CYPHER_PASSWORD") or getpass.getpass()
+
+    async with CypherClient(
+        args.url,
+        concurrency=args.concurrency,
+        retries=args.retries,
+        timeout=args.timeout,
+        http2=not args.no_http2,
+    ) as client:
+        await client.login(args.email, password, args.code)
+        if args.command == "push":
+            stats = await push(client, _expand(args.paths), args.folder_id)
+        elif args.command == "pull":
+            stats = await pull(client, Path(args.dest), args.folder_id)
+        else:
+            stats = await sync(client, Path(args.directory), args.folder_id)
+    print(stats.summary(args.command))
+    return 1 if stats.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_main()))
@@ -1,4 +1,5 @@
 from functools import lru_cache
+from typing import Literal
 
 from pydantic import EmailStr
 from pydantic_settings import BaseSettings, SettingsConfigDict
@@ -12,6 +13,17 @@ class Settings(BaseSettings):
     db_password: str
     db_name: str
 
+    # Пул соединений и реплика для чтения
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: float = 30.0  # ожидание свободного соединения, сек
+    DB_POOL_RECYCLE: int = -1  # пересоздавать соединения старше N сек (-1 — никогда)
+    DB_POOL_PRE_PING: bool = False
+    DB_STATEMENT_CACHE_SIZE: int = 100  # кэш prepared statements asyncpg (0 для pgbouncer)
+    DB_REPLICA_URL: str | None = None  # postgresql://... реплики для read-only запросов
+    MIGRATIONS_ON_STARTUP: bool = True  # иначе: python -m cypher_cloud.migrations upgrade
+    STARTUP_PREWARM: bool = True  # открыть пул БД и сессию Vault до готовности воркера
+
     # URLs и JWT
     site_url: str
     NEXT_PUBLIC_BASE_URL: str
@@ -33,6 +45,90 @@ class Settings(BaseSettings):
     vault_addr: str
     vault_token: str
     vault_kv_mount: str = "secret"
+    # Таймаут, предохранитель и очередь запросов к Vault (см. vault_client.py)
+    VAULT_TIMEOUT_SECONDS: float = 5.0  # на один запрос
+    VAULT_MAX_CONCURRENCY: int = 16  # потоков с запросами к Vault
+    VAULT_MAX_WAITING: int = 64  # ждущих свободного потока; сверх — сразу 503
+    VAULT_BREAKER_FAILURES: int = 5  # отказов подряд до размыкания
+    VAULT_BREAKER_RESET_SECONDS: float = 30.0  # через сколько пробный запрос
+
+    # Версии файлов: размеры чанков, границы которых зависят от содержимого
+    CHUNK_MIN_SIZE: int = 256 * 1024
+    CHUNK_AVG_SIZE: int = 1024 * 1024
+    CHUNK_MAX_SIZE: int = 4 * 1024 * 1024
+
+    # Упаковка мелких файлов в append-only сегменты
+    PACK_MAX_SIZE: int = 64 * 1024  # файлы до N байт упаковываются (0 — выключено)
+    SEGMENT_MAX_SIZE: int = 64 * 1024 * 1024
+    COMPACT_INTERVAL_SECONDS: int = 3600  # период компактора (0 — только вручную)
+    COMPACT_MIN_LIVE_RATIO: float = 0.5  # компактировать сегменты с меньшей долей живых байт
+    COMPACT_GRACE_SECONDS: int = 300  # через сколько удалять прежний файл сегмента
+
+    # Импорт архивов (ZIP/TAR)
+    IMPORT_DIR: str = "imports"  # временные файлы принятых архивов
+    IMPORT_MAX_ARCHIVE_SIZE: int = 10 * 1024 * 1024 * 1024
+    IMPORT_MAX_MEMBERS: int = 100_000
+    IMPORT_WORKERS: int = 4  # сколько файлов архива шифруется одновременно
+    IMPORT_BATCH_SIZE: int = 100  # файлов на один коммит
+    IMPORT_STALE_SECONDS: int = 600  # задача без обновлений дольше — брошена
+
+    # Квоты (переопределяются для пользователя: python -m cypher_cloud.quotas set)
+    QUOTA_BYTES: int = 10 * 1024 * 1024 * 1024
+    QUOTA_OBJECTS: int = 100_000
+    QUOTA_RESERVATION_SECONDS: int = 3600  # резерв упавшей загрузки истекает
+    QUOTA_RECOUNT_INTERVAL_SECONDS: int = 24 * 3600  # пересчет расхождений (0 — вручную)
+
+    # Надежность записи шифротекста: none | batch | always (см. storage.py)
+    STORAGE_DURABILITY: Literal["none", "batch", "always"] = "batch"
+    FSYNC_BATCH_DELAY_MS: int = 0  # подождать перед общим сбросом, чтобы набрать пачку
+    # Скачивание: сколько блоков шифротекста (чанков) читать и расшифровывать
+    # наперед, пока предыдущие уходят в сокет
+    DOWNLOAD_READ_AHEAD: int = 4
+
+    # Проверка целостности шифротекста (см. scrub.py)
+    SCRUB_INTERVAL_SECONDS: int = 7 * 24 * 3600  # период полных проходов (0 — вручную)
+    SCRUB_BYTES_PER_SECOND: int = 64 * 1024 * 1024  # лимит чтения (0 — без лимита)
+    SCRUB_BATCH_SIZE: int = 100  # объектов между сохранениями позиции
+
+    # Ротация ключей (python -m cypher_cloud.rotate)
+    ROTATION_CONCURRENCY: int = 4  # объектов перешифровывается одновременно
+    ROTATION_BYTES_PER_SECOND: int = 32 * 1024 * 1024  # лимит чтения (0 — без лимита)
+    ROTATION_BATCH_SIZE: int = 100  # объектов между контрольными точками
+    ROTATION_GRACE_SECONDS: int = 600  # сколько хранить прежний шифротекст и ключ
+
+    # Ограничение частоты запросов (см. ratelimit.py): запросов в минуту с
+    # одного IP и на один аккаунт, 0 — без лимита
+    RATE_LIMIT_BACKEND: Literal["memory", "postgres"] = "memory"
+    RATE_LIMIT_LOGIN_PER_MINUTE: int = 10  # вход, passkey-вход, 2FA, смена пароля
+    RATE_LIMIT_REGISTER_PER_MINUTE: int = 5
+    RATE_LIMIT_MAIL_PER_MINUTE: int = 3  # письма сброса пароля
+    RATE_LIMIT_PASSKEY_PER_MINUTE: int = 10  # регистрация passkey
+    RATE_LIMIT_TRANSFER_PER_MINUTE: int = 0  # загрузки и скачивания пользователя
+    RATE_LIMIT_TRUSTED_PROXIES: int = 0  # прокси перед приложением (X-Forwarded-For)
+    RATE_LIMIT_MAX_KEYS: int = 100_000  # ведер в памяти процесса
+
+    # Метрики: если задан, /metrics требует Authorization: Bearer <токен>
+    METRICS_TOKEN: str = ""
+
+    # Журнал изменений
+    CHANGES_POLL_SECONDS: int = 5  # перепроверка журнала при ожидании без уведомления
+
+    # Публичные ссылки
+    SHARE_DEFAULT_TTL_SECONDS: int = 7 * 24 * 3600
+    SHARE_MAX_TTL_SECONDS: int = 30 * 24 * 3600
+    SHARE_KEY_ROTATION_SECONDS: int = 7 * 24 * 3600  # смена ключа подписи
+    SHARE_KEY_REFRESH_SECONDS: int = 300  # перечитывать набор ключей из Vault
+    SHARE_DENYLIST_REFRESH_SECONDS: int = 30  # задержка отзыва на других воркерах
+    SHARE_CACHE_SECONDS: int = 60  # кэш пути к содержимому и ключа файла
+    SHARE_CACHE_SIZE: int = 1024
+
+    # Диагностика: Server-Timing и выборочное профилирование запросов
+    SERVER_TIMING_ENABLED: bool = True
+    PROFILE_SAMPLE_RATE: int = 0  # профилировать каждый N-й запрос (0 — выключено)
+    PROFILE_SLOW_MS: int = 0  # профилировать запросы дольше N мс (0 — выключено)
+    PROFILE_INTERVAL_MS: int = 5  # период снятия стеков
+    PROFILE_DIR: str = "profiles"
+    PROFILE_KEEP: int = 200  # сколько последних профилей хранить
 
     # Время жизни токенов (в секундах)
     EMAIL_CONFIRM_EXPIRE_SECONDS: int = 3600  # 1 час
@@ -45,12 +141,18 @@ class Settings(BaseSettings):
 
 @lru_cache
 def get_settings() -> Settings:
-    print("Loading settings")
-    print(Settings())
     return Settings()  # type: ignore
 
 
-settings: Settings = get_settings()
+class _LazySettings:
+    """Settings читаются из окружения и .env при первом обращении к полю, а
+    не при импорте модуля."""
+
+    def __getattr__(self, name: str):
+        return getattr(get_settings(), name)
+
+
+settings: Settings = _LazySettings()  # type: ignore[assignment]
 
 
 @lru_cache
@@ -61,3 +163,14 @@ def get_db_url(engine: str | None = "asyncpg") -> str:
         f"{settings.db_host}:{settings.db_port}/"
         f"{settings.db_name}"
     )
+
+
+@lru_cache
+def get_replica_db_url(engine: str | None = "asyncpg") -> str | None:
+    url = settings.DB_REPLICA_URL
+    if not url:
+        return None
+    scheme, _, rest = url.partition("://")
+    if "+" not in scheme:
+        scheme = f"{scheme}+{engine}"
+    return f"{scheme.replace('postgres+', 'postgresql+')}://{rest}"
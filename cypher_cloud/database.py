@@ -1,18 +1,112 @@
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+import asyncio
+from functools import lru_cache
+
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
 from sqlalchemy.orm import declarative_base, sessionmaker
 
-from cypher_cloud.config import get_db_url
+from cypher_cloud.config import get_db_url, get_replica_db_url, settings
+
+
+def _create_engine(url: str) -> AsyncEngine:
+    cache_size = settings.DB_STATEMENT_CACHE_SIZE
+    return create_async_engine(
+        # Кэш prepared statements на стороне SQLAlchemy и самого asyncpg
+        make_url(url).update_query_dict(
+            {"prepared_statement_cache_size": str(cache_size)}
+        ),
+        echo=False,
+        future=True,
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+        pool_pre_ping=settings.DB_POOL_PRE_PING,
+        connect_args={"statement_cache_size": cache_size},
+    )
+
+
+# Движки и фабрики сессий создаются при первом обращении: импорт модуля не
+# читает настройки и не строит пулы
+@lru_cache
+def get_engine() -> AsyncEngine:
+    return _create_engine(get_db_url())
+
+
+@lru_cache
+def get_read_engine() -> AsyncEngine:
+    """Движок реплики, если задан DB_REPLICA_URL, иначе основной."""
+    url = get_replica_db_url()
+    return _create_engine(url) if url else get_engine()
+
+
+@lru_cache
+def _session_factory(read: bool) -> sessionmaker:
+    target = get_read_engine() if read else get_engine()
+    return sessionmaker(target, expire_on_commit=False, class_=AsyncSession)
+
 
-DATABASE_URL = get_db_url()
-print(DATABASE_URL)
+def async_session() -> AsyncSession:
+    return _session_factory(False)()
+
+
+def read_session() -> AsyncSession:
+    return _session_factory(True)()
+
+
+async def dispose_engines() -> None:
+    """Закрывает пулы, которые успели создать; следующее обращение создаст
+    движки заново."""
+    created = {
+        factory()
+        for factory in (get_engine, get_read_engine)
+        if factory.cache_info().currsize
+    }
+    for target in created:
+        await target.dispose()
+    get_read_engine.cache_clear()
+    _session_factory.cache_clear()
+    get_engine.cache_clear()
 
-engine = create_async_engine(DATABASE_URL, echo=False, future=True)
 
 Base = declarative_base()
 
-async_session = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+
+async def warm_up() -> None:
+    """Открываем DB_POOL_SIZE соединений основного пула (и пула реплики)
+    до первого запроса: иначе первые запросы воркера платят за подключение."""
+
+    async def _fill(target: AsyncEngine) -> None:
+        connections = [target.connect() for _ in range(settings.DB_POOL_SIZE)]
+        results = await asyncio.gather(
+            *(conn.start() for conn in connections), return_exceptions=True
+        )
+        # Закрываем только открывшиеся: close() неначатого соединения падает
+        opened = [
+            conn
+            for conn, result in zip(connections, results)
+            if not isinstance(result, BaseException)
+        ]
+        try:
+            await asyncio.gather(*(conn.execute(text("SELECT 1")) for conn in opened))
+        finally:
+            await asyncio.gather(*(conn.close() for conn in opened))
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    await _fill(get_engine())
+    if get_read_engine() is not get_engine():
+        await _fill(get_read_engine())
 
 
 async def get_db():
     async with async_session() as session:
         yield session
+
+
+async def get_read_db():
+    """Сессия для read-only запросов: реплика, если задан DB_REPLICA_URL."""
+    async with read_session() as session:
+        yield session
@@ -0,0 +1,124 @@
+"""Конвергентная дедупликация загрузок в пределах одного владельца.
+
+У каждого пользователя есть секрет в Vault (`users/{id}/dedup`). Из SHA-256
+открытого содержимого и этого секрета выводятся:
+
+* `content_hash` — идентификатор содержимого для поиска Blob (в БД не попадает
+  сам дайджест, поэтому по нему нельзя проверить, хранит ли кто-то известный файл);
+* ключ Fernet — одинаковое содержимое всегда шифруется одним ключом, поэтому
+  параллельные загрузки одной и той же копии не расходятся в ключах.
+
+Повторная загрузка только увеличивает `Blob.ref_count`: без записи на диск и
+без нового секрета в Vault. Удаление файла уменьшает счетчик; шифротекст и
+ключ удаляются вместе с последней ссылкой.
+"""
+
+import base64
+import hashlib
+import hmac
+import secrets
+from typing import Dict, NamedTuple, Optional
+
+from sqlalchemy import delete, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from cypher_cloud.models import Blob
+from cypher_cloud.profiling import span
+from cypher_cloud.vault_client import store_key_once
+
+# Секрет пользователя неизменен после создания, кэшируем его в процессе
+_user_secrets: Dict[int, bytes] = {}
+
+
+class BlobRef(NamedTuple):
+    id: int
+    storage_path: str
+    vault_key_path: str
+
+
+async def get_user_secret(user_id: int) -> bytes:
+    secret = _user_secrets.get(user_id)
+    if secret is None:
+        candidate = base64.urlsafe_b64encode(secrets.token_bytes(32)).decode()
+        stored = await store_key_once(f"users/{user_id}/dedup", candidate)
+        secret = base64.urlsafe_b64decode(stored)
+        _user_secrets[user_id] = secret
+    return secret
+
+
+def content_hash(secret: bytes, digest: bytes) -> str:
+    return hmac.new(secret, b"id:" + digest, hashlib.sha256).hexdigest()
+
+
+def content_key(secret: bytes, digest: bytes) -> bytes:
+    """Ключ Fernet, выведенный из содержимого и секрета владельца."""
+    raw = hmac.new(secret, b"key:" + digest, hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(raw)
+
+
+async def acquire_blob(
+    db: AsyncSession, owner_id: int, hash_: str
+) -> Optional[BlobRef]:
+    """Берем ссылку на существующий Blob (ref_count + 1), если он есть."""
+    with span("db"):
+        result = await db.execute(
+            update(Blob)
+            .where(Blob.owner_id == owner_id, Blob.content_hash == hash_)
+            .values(ref_count=Blob.ref_count + 1)
+            .returning(Blob.id, Blob.storage_path, Blob.vault_key_path)
+        )
+        row = result.first()
+    return BlobRef(*row) if row else None
+
+
+async def insert_blob(
+    db: AsyncSession,
+    owner_id: int,
+    hash_: str,
+    storage_path: str,
+    size: int,
+    ciphertext_sha256: str,
+) -> Optional[int]:
+    """Создаем Blob с одной ссылкой. None — параллельная загрузка того же
+    содержимого успела первой, тогда нужно повторить `acquire_blob`."""
+    with span("db"):
+        result = await db.execute(
+            insert(Blob)
+            .values(
+                owner_id=owner_id,
+                content_hash=hash_,
+                storage_path=storage_path,
+                vault_key_path="",
+                size=size,
+                ref_count=1,
+                ciphertext_sha256=ciphertext_sha256,
+            )
+            .on_conflict_do_nothing(index_elements=["owner_id", "content_hash"])
+            .returning(Blob.id)
+        )
+        return result.scalar()
+
+
+async def set_blob_key_path(db: AsyncSession, blob_id: int, vault_key_path: str) -> None:
+    with span("db"):
+        await db.execute(
+            update(Blob).where(Blob.id == blob_id).values(vault_key_path=vault_key_path)
+        )
+
+
+async def release_blob(db: AsyncSession, blob_id: int) -> Optional[BlobRef]:
+    """Снимаем одну ссылку. Возвращаем Blob, если ссылок не осталось и его
+    шифротекст и ключ нужно удалить после коммита."""
+    with span("db"):
+        result = await db.execute(
+            update(Blob)
+            .where(Blob.id == blob_id)
+            .values(ref_count=Blob.ref_count - 1)
+            .returning(Blob.ref_count, Blob.storage_path, Blob.vault_key_path)
+        )
+        row = result.first()
+        if row is None or row.ref_count > 0:
+            return None
+        await db.execute(delete(Blob).where(Blob.id == blob_id))
+    return BlobRef(blob_id, row.storage_path, row.vault_key_path)
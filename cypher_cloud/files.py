@@ -1,51 +1,236 @@
+import hashlib
 import os
-import time
 import urllib.parse
-import uuid
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 
-import aiofiles
 from cryptography.fernet import Fernet
-from fastapi import APIRouter, Depends, File, HTTPException, UploadFile, status
-from fastapi.responses import StreamingResponse
+from fastapi import (
+    APIRouter,
+    Depends,
+    File,
+    HTTPException,
+    Query,
+    Request,
+    UploadFile,
+    status,
+)
+from fastapi.responses import Response, StreamingResponse
+from sqlalchemy import func, literal
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
+from starlette.background import BackgroundTask
 
 from cypher_cloud.auth import get_current_user
-from cypher_cloud.database import get_db
+from cypher_cloud.changes import Change, record_changes
+from cypher_cloud.config import settings
+from cypher_cloud.database import get_db, get_read_db
+from cypher_cloud.dedup import (
+    BlobRef,
+    acquire_blob,
+    content_hash,
+    content_key,
+    get_user_secret,
+    insert_blob,
+    set_blob_key_path,
+)
+from cypher_cloud.folders import require_folder
 from cypher_cloud.models import File as FileModel
-from cypher_cloud.models import User
-from cypher_cloud.schemas import FileItem, FileUploadResult
+from cypher_cloud.models import FileVersion, User
+from cypher_cloud.packing import pack, segment_key
+from cypher_cloud.profiling import span
+from cypher_cloud.quotas import (
+    apply_usage,
+    billed_size,
+    release,
+    reserve,
+    stored_bytes,
+)
+from cypher_cloud.ratelimit import enforce
+from cypher_cloud.schemas import (
+    DedupSettings,
+    FileItem,
+    FileUpdate,
+    FileSearchItem,
+    FileSearchResponse,
+    FileUploadResult,
+    FileVersionItem,
+    FileVersionUploadResult,
+)
+from cypher_cloud.storage import (
+    FILES_DIR,
+    Block,
+    new_storage_path,
+    remove_stored,
+    stream_decrypted,
+    sync_writes,
+    write_encrypted,
+)
 from cypher_cloud.vault_client import (
     delete_file_key,
     fetch_file_key,
     store_file_key,
 )
+from cypher_cloud.versions import (
+    Orphans,
+    add_version,
+    delete_file_content,
+    delete_version,
+    get_version,
+    list_versions,
+    lock_file,
+    resolve_content,
+)
 
 router = APIRouter()
 
-FILES_DIR = "files"
-os.makedirs(FILES_DIR, exist_ok=True)
+# Ограничения
+MAX_FILES_COUNT = 10
+MAX_TOTAL_SIZE = 500 * 1024 * 1024  # 500MB общий размер
+MAX_FILE_SIZE = 100 * 1024 * 1024  # 100MB на файл
+
+DEDUP_RETRIES = 3
+
+
+async def _store_key(vault_path: str, key: bytes, storage_path: Path) -> None:
+    try:
+        await store_file_key(vault_path, key.decode())
+    except Exception as vault_exc:  # noqa: BLE001
+        if storage_path.exists():
+            storage_path.unlink()
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Ошибка при сохранении ключа шифрования",
+        ) from vault_exc
+
+
+async def _store_deduplicated(
+    db: AsyncSession,
+    user: User,
+    filename: str,
+    content: bytes,
+    folder_id: Optional[int],
+    durable: bool,
+) -> FileModel:
+    secret = await get_user_secret(user.id)
+    with span("crypto"):
+        digest = hashlib.sha256(content).digest()
+        hash_ = content_hash(secret, digest)
+
+    blob = await acquire_blob(db, user.id, hash_)
+    for _ in range(DEDUP_RETRIES):
+        if blob is not None:
+            break
+        key = content_key(secret, digest)
+        storage_path = new_storage_path(user.id, Path(filename).suffix)
+        ciphertext_sha256 = await write_encrypted(storage_path, key, content, durable)
+        blob_id = await insert_blob(
+            db, user.id, hash_, str(storage_path), len(content), ciphertext_sha256
+        )
+        if blob_id is None:
+            # Ту же копию только что сохранил параллельный запрос
+            storage_path.unlink(missing_ok=True)
+            blob = await acquire_blob(db, user.id, hash_)
+            continue
+        vault_path = f"blobs/{user.id}/{blob_id}"
+        await _store_key(vault_path, key, storage_path)
+        await set_blob_key_path(db, blob_id, vault_path)
+        blob = BlobRef(blob_id, str(storage_path), vault_path)
+    if blob is None:
+        raise RuntimeError("Не удалось сохранить содержимое для дедупликации")
+
+    new_file = FileModel(
+        owner_id=user.id,
+        filename=filename,
+        vault_key_path=blob.vault_key_path,
+        storage_path=blob.storage_path,
+        blob_id=blob.id,
+        folder_id=folder_id,
+        size=len(content),
+    )
+    db.add(new_file)
+    with span("db"):
+        await db.flush()
+    return new_file
+
+
+async def store_file(
+    db: AsyncSession,
+    user: User,
+    filename: str,
+    content: bytes,
+    folder_id: Optional[int] = None,
+    durable: bool = True,
+) -> FileModel:
+    """Шифруем и сохраняем содержимое, ключ кладем в Vault. Возвращаем
+    записанную в сессию (flush), но еще не закоммиченную запись File.
+    С `durable=False` перед коммитом нужно дождаться `sync_writes()`."""
+    if user.dedup_enabled:
+        return await _store_deduplicated(
+            db, user, filename, content, folder_id, durable
+        )
+
+    if settings.PACK_MAX_SIZE and len(content) <= settings.PACK_MAX_SIZE:
+        # Мелкий файл — запись в сегменте, без своего файла и секрета в Vault
+        slot = await pack(user.id, content, durable)
+        new_file = FileModel(
+            owner_id=user.id,
+            filename=filename,
+            vault_key_path=slot.vault_key_path,
+            storage_path=slot.storage_path,
+            segment_id=slot.segment_id,
+            segment_offset=slot.offset,
+            segment_length=slot.length,
+            folder_id=folder_id,
+            size=len(content),
+            ciphertext_sha256=slot.ciphertext_sha256,
+        )
+        db.add(new_file)
+        with span("db"):
+            await db.flush()
+        return new_file
+
+    # Генерация ключа шифрования
+    key = Fernet.generate_key()
+    storage_path = new_storage_path(user.id, Path(filename).suffix)
+    digest = await write_encrypted(storage_path, key, content, durable)
+
+    new_file = FileModel(
+        owner_id=user.id,
+        filename=filename,
+        vault_key_path="",
+        storage_path=str(storage_path),
+        folder_id=folder_id,
+        size=len(content),
+        ciphertext_sha256=digest,
+    )
+    db.add(new_file)
+    with span("db"):
+        await db.flush()
+
+    vault_path = f"files/{user.id}/{new_file.id}"
+    await _store_key(vault_path, key, storage_path)
+    new_file.vault_key_path = vault_path
+    return new_file
 
 
 @router.post("/upload")
 async def upload_multiple_files(
+    request: Request,
     files: List[UploadFile] = File(...),
+    folder_id: Optional[int] = Query(None),
     db: AsyncSession = Depends(get_db),
     user: User = Depends(get_current_user),
 ):
+    await enforce(request, "transfer", user.id, by_ip=False)
     if not files:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Не выбраны файлы для загрузки",
         )
 
-    # Ограничения
-    MAX_FILES_COUNT = 10
-    MAX_TOTAL_SIZE = 500 * 1024 * 1024  # 500MB общий размер
-    MAX_FILE_SIZE = 100 * 1024 * 1024  # 100MB на файл
-
     if len(files) > MAX_FILES_COUNT:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -55,6 +240,7 @@ async def upload_multiple_files(
     results = []
     total_size = 0
     successful_files = []
+    reservations = []
 
     try:
         # Создание директории если её нет
@@ -75,7 +261,8 @@ async def upload_multiple_files(
                 )
                 continue
 
-            content = await file.read()
+            with span("io"):
+                content = await file.read()
             file_size = len(content)
 
             if file_size > MAX_FILE_SIZE:
@@ -103,6 +290,17 @@ async def upload_multiple_files(
 
             file_data.append({"file": file, "content": content, "size": file_size})
 
+        # Резервируем место под все прошедшие проверку файлы (или 413). До
+        # первого запроса в db: reserve берет свое соединение, и у запроса не
+        # должно быть в этот момент ни соединения, ни блокировок
+        if file_data:
+            reservations.append(
+                await reserve(
+                    user.id, sum(data["size"] for data in file_data), len(file_data)
+                )
+            )
+        await require_folder(db, user.id, folder_id)
+
         # Обработка файлов
         for data in file_data:
             try:
@@ -110,46 +308,12 @@ async def upload_multiple_files(
                 content = data["content"]
                 file_size = data["size"]
 
-                # Генерация ключа шифрования
-                key = Fernet.generate_key()
-                f = Fernet(key)
-                encrypted_content = f.encrypt(content)
-
-                # Создание безопасного имени файла
-                timestamp = int(time.time())
-                file_extension = Path(file.filename).suffix
-                safe_filename = (
-                    f"{user.id}_{timestamp}_{uuid.uuid4().hex[:8]}{file_extension}"
-                )
-                storage_path = files_dir / safe_filename
-
-                # Сохранение файла
-                async with aiofiles.open(storage_path, "wb") as f_out:
-                    await f_out.write(encrypted_content)
-
-                os.chmod(storage_path, 0o644)
-
-                new_file = FileModel(
-                    owner_id=user.id,
-                    filename=file.filename,
-                    vault_key_path="",
-                    storage_path=str(storage_path),
-                )
-                db.add(new_file)
-                await db.flush()
-
-                vault_path = f"files/{user.id}/{new_file.id}"
-                try:
-                    await store_file_key(vault_path, key.decode())
-                except Exception as vault_exc:  # noqa: BLE001
-                    if storage_path.exists():
-                        storage_path.unlink()
-                    raise HTTPException(
-                        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                        detail="Ошибка при сохранении ключа шифрования",
-                    ) from vault_exc
-
-                new_file.vault_key_path = vault_path
+                # SAVEPOINT: ошибка одного файла не оставляет в транзакции
+                # его частично созданные записи
+                async with db.begin_nested():
+                    new_file = await store_file(
+                        db, user, file.filename, content, folder_id, durable=False
+                    )
                 successful_files.append(new_file)
 
                 results.append(
@@ -173,15 +337,42 @@ async def upload_multiple_files(
 
         # Сохранение в базу данных
         if successful_files:
-            await db.commit()
-
-            # Обновление ID файлов в результатах
-            success_index = 0
-            for i, result in enumerate(results):
-                if result.status == "success":
-                    await db.refresh(successful_files[success_index])
-                    result.file_id = successful_files[success_index].id
-                    success_index += 1
+            # Один сброс на диск на все файлы запроса, строго до коммита
+            await sync_writes()
+            await apply_usage(
+                db,
+                user.id,
+                sum(new_file.size for new_file in successful_files),
+                len(successful_files),
+                reservations,
+            )
+            await record_changes(
+                db,
+                user.id,
+                [
+                    Change(
+                        "upload",
+                        new_file.id,
+                        new_file.filename,
+                        new_file.version,
+                        new_file.folder_id,
+                    )
+                    for new_file in successful_files
+                ],
+            )
+            with span("db"):
+                await db.commit()
+
+                # Обновление ID файлов в результатах
+                success_index = 0
+                for i, result in enumerate(results):
+                    if result.status == "success":
+                        await db.refresh(successful_files[success_index])
+                        result.file_id = successful_files[success_index].id
+                        success_index += 1
+        else:
+            await db.rollback()
+            await release(reservations)
 
         return {
             "status": "completed",
@@ -193,9 +384,11 @@ async def upload_multiple_files(
 
     except HTTPException:
         await db.rollback()
+        await release(reservations)
         raise
     except Exception as e:
         await db.rollback()
+        await release(reservations)
         print(f"Критическая ошибка при загрузке файлов: {e}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -205,75 +398,374 @@ async def upload_multiple_files(
 
 @router.get("/list", response_model=List[FileItem])
 async def list_files(
-    db: AsyncSession = Depends(get_db), user: User = Depends(get_current_user)
+    db: AsyncSession = Depends(get_read_db), user: User = Depends(get_current_user)
 ):
-    result = await db.execute(select(FileModel).where(FileModel.owner_id == user.id))
-    files = result.scalars().all()
+    with span("db"):
+        result = await db.execute(
+            select(FileModel).where(FileModel.owner_id == user.id)
+        )
+        files = result.scalars().all()
     return files
 
 
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+@router.get("/search", response_model=FileSearchResponse)
+async def search_files(
+    q: str = Query(..., min_length=1, max_length=255),
+    limit: int = Query(50, ge=1, le=200),
+    offset: int = Query(0, ge=0, le=10_000),
+    db: AsyncSession = Depends(get_read_db),
+    user: User = Depends(get_current_user),
+):
+    # Подстрока (ILIKE) и нечеткое совпадение по словам (pg_trgm `<%`) —
+    # оба условия обслуживает GIN-индекс (owner_id, filename gin_trgm_ops)
+    substring = FileModel.filename.ilike(f"%{_escape_like(q)}%", escape="\\")
+    fuzzy = literal(q).op("<%")(FileModel.filename)
+    score = func.word_similarity(q, FileModel.filename)
+
+    with span("db"):
+        result = await db.execute(
+            select(FileModel.id, FileModel.filename, score.label("score"))
+            .where(FileModel.owner_id == user.id, substring | fuzzy)
+            .order_by(substring.desc(), score.desc(), FileModel.id.desc())
+            .limit(limit + 1)
+            .offset(offset)
+        )
+        rows = result.all()
+
+    return FileSearchResponse(
+        items=[
+            FileSearchItem(id=row.id, filename=row.filename, score=row.score)
+            for row in rows[:limit]
+        ],
+        limit=limit,
+        offset=offset,
+        has_more=len(rows) > limit,
+    )
+
+
+def _cache_headers(
+    file_id: int, version: int, modified_at: Optional[datetime]
+) -> dict:
+    """ETag и Last-Modified из метаданных: ротация ключей и компакция
+    меняют шифротекст, но не содержимое, поэтому в тег не входят."""
+    stamp = modified_at.isoformat() if modified_at is not None else ""
+    tag = hashlib.sha256(f"{file_id}:{version}:{stamp}".encode()).hexdigest()[:32]
+    headers = {"ETag": f'"{tag}"', "Cache-Control": "private, no-cache"}
+    if modified_at is not None:
+        headers["Last-Modified"] = format_datetime(
+            modified_at.astimezone(timezone.utc), usegmt=True
+        )
+    return headers
+
+
+def _not_modified(
+    request: Request, cache_headers: dict, modified_at: Optional[datetime]
+) -> bool:
+    """If-None-Match, а без него If-Modified-Since (RFC 9110, 13.2.2)."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        # Для GET сравнение слабое: W/"x" совпадает с "x"
+        return "*" in tags or cache_headers["ETag"] in (
+            tag[2:] if tag.startswith("W/") else tag for tag in tags
+        )
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is None or modified_at is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        return False
+    # В HTTP-дате нет долей секунды
+    return modified_at.replace(microsecond=0) <= since
+
+
+def _not_modified_response(cache_headers: dict) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=cache_headers)
+
+
 @router.get("/download/{file_id}")
 async def download_file(
     file_id: int,
+    request: Request,
+    version: Optional[int] = Query(None, ge=1),
     db: AsyncSession = Depends(get_db),
     user: User = Depends(get_current_user),
 ):
-    result = await db.execute(
-        select(FileModel).where(FileModel.id == file_id, FileModel.owner_id == user.id)
-    )
-    db_file = result.scalars().first()
+    await enforce(request, "transfer", user.id, by_ip=False)
+    with span("db"):
+        result = await db.execute(
+            select(FileModel).where(
+                FileModel.id == file_id, FileModel.owner_id == user.id
+            )
+        )
+        db_file = result.scalars().first()
     if not db_file:
         raise HTTPException(404, "File not found")
 
-    key = await fetch_file_key(db_file.vault_key_path)
-    f = Fernet(key.encode())
-
-    # Читаем и декриптируем весь файл
-    async with aiofiles.open(db_file.storage_path, "rb") as f_in:
-        encrypted_content = await f_in.read()
-
-    decrypted_content = f.decrypt(encrypted_content)
-
-    # Создаем генератор для отправки данных чанками
-    async def content_iterator(data: bytes, chunk_size: int = 1024 * 1024):
-        for i in range(0, len(data), chunk_size):
-            yield data[i : i + chunk_size]
-
+    number = db_file.version if version is None else version
+    if number == db_file.version:
+        # Текущая версия: валидаторы есть в самой строке файла, 304 отдаем
+        # без чтения версий и чанков
+        cache_headers = _cache_headers(db_file.id, number, db_file.modified_at)
+        if _not_modified(request, cache_headers, db_file.modified_at):
+            return _not_modified_response(cache_headers)
+
+    content = await resolve_content(db, db_file, version)
+    if content is None:
+        raise HTTPException(404, "Version not found")
+    if number != db_file.version:
+        cache_headers = _cache_headers(db_file.id, number, content.modified_at)
+        if _not_modified(request, cache_headers, content.modified_at):
+            return _not_modified_response(cache_headers)
+
+    if content.segment_offset is not None:
+        key = await segment_key(content.vault_key_path)
+    else:
+        key = (await fetch_file_key(content.vault_key_path)).encode()
     safe_filename = urllib.parse.quote(db_file.filename)
-
+    headers = {
+        "Content-Disposition": f"attachment; filename*=UTF-8''{safe_filename}",
+        **cache_headers,
+    }
+
+    if content.chunk_paths is not None:
+        blocks = [Block(path) for path in content.chunk_paths]
+    else:
+        blocks = [
+            Block(content.storage_path, content.segment_offset, content.segment_length)
+        ]
+    decrypted = await stream_decrypted(blocks, key, settings.DOWNLOAD_READ_AHEAD)
+    # Content-Length только точный: цельный шифротекст уже расшифрован
+    # целиком, размер чанковой версии записан при загрузке. Старые строки с
+    # оценкой размера уходят chunked-кодированием
+    size = decrypted.size if content.chunk_paths is None else content.size
+    if size is not None:
+        headers["Content-Length"] = str(size)
+    # Starlette при обрыве клиента не закрывает генератор тела — закрываем
+    # его фоновой задачей ответа, она выполняется и после обрыва
     return StreamingResponse(
-        content_iterator(decrypted_content),
+        decrypted.body,
         media_type="application/octet-stream",
-        headers={
-            "Content-Disposition": f"attachment; filename*=UTF-8''{safe_filename}",
-            "Content-Length": str(len(decrypted_content)),
-        },
+        headers=headers,
+        background=BackgroundTask(decrypted.body.aclose),
     )
 
 
+async def _remove_orphans(orphans: Orphans) -> None:
+    for vault_path in orphans.vault_key_paths:
+        await delete_file_key(vault_path)
+    remove_stored(orphans.storage_paths)
+
+
 @router.delete("/{file_id}")
 async def delete_file(
     file_id: int,
     db: AsyncSession = Depends(get_db),
     user: User = Depends(get_current_user),
 ):
-    result = await db.execute(
-        select(FileModel).where(FileModel.id == file_id, FileModel.owner_id == user.id)
+    db_file = await lock_file(db, user.id, file_id)
+    if not db_file:
+        raise HTTPException(404, "File not found")
+
+    # Удаляем записи из БД; общий шифротекст — только вместе с последней ссылкой
+    freed = await stored_bytes(db, db_file)
+    orphans = await delete_file_content(db, db_file)
+    await apply_usage(db, user.id, -freed, -1)
+    await record_changes(db, user.id, [Change("delete", file_id, db_file.filename)])
+    with span("db"):
+        await db.commit()
+
+    await _remove_orphans(orphans)
+    return {"status": "ok"}
+
+
+@router.patch("/{file_id}", response_model=FileItem)
+async def update_file(
+    file_id: int,
+    req: FileUpdate,
+    db: AsyncSession = Depends(get_db),
+    user: User = Depends(get_current_user),
+):
+    """Переименование и перенос в другую папку; содержимое не трогается."""
+    db_file = await lock_file(db, user.id, file_id)
+    if not db_file:
+        raise HTTPException(404, "File not found")
+    changes = []
+    if req.filename is not None and req.filename != db_file.filename:
+        db_file.filename = req.filename
+        changes.append("rename")
+    if "folder_id" in req.model_fields_set and req.folder_id != db_file.folder_id:
+        await require_folder(db, user.id, req.folder_id)
+        db_file.folder_id = req.folder_id
+        changes.append("move")
+    if changes:
+        await record_changes(
+            db,
+            user.id,
+            [
+                Change(
+                    kind, file_id, db_file.filename, db_file.version, db_file.folder_id
+                )
+                for kind in changes
+            ],
+        )
+        with span("db"):
+            await db.commit()
+    return db_file
+
+
+def _version_item(version: FileVersion, current: int) -> FileVersionItem:
+    return FileVersionItem(
+        version=version.version,
+        size=version.size,
+        created_at=version.created_at,
+        current=version.version == current,
     )
-    db_file = result.scalars().first()
+
+
+@router.post("/{file_id}/versions", response_model=FileVersionUploadResult)
+async def upload_file_version(
+    file_id: int,
+    request: Request,
+    file: UploadFile = File(...),
+    db: AsyncSession = Depends(get_db),
+    user: User = Depends(get_current_user),
+):
+    await enforce(request, "transfer", user.id, by_ip=False)
+    with span("io"):
+        content = await file.read()
+    if len(content) > MAX_FILE_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Файл слишком большой (макс. {MAX_FILE_SIZE // (1024*1024)}MB)",
+        )
+
+    # Резерв — до lock_file: иначе запрос ждал бы второе соединение, держа
+    # блокировку файла, которую может ждать пересчет квот
+    reservation = await reserve(user.id, len(content), 0)
+    try:
+        db_file = await lock_file(db, user.id, file_id)
+        if not db_file:
+            raise HTTPException(404, "File not found")
+        stats = await add_version(db, db_file, content)
+        await apply_usage(db, user.id, len(content), 0, [reservation])
+        await record_changes(
+            db, user.id, [Change("version", file_id, db_file.filename, stats.version)]
+        )
+        with span("db"):
+            await db.commit()
+    except Exception:
+        await db.rollback()
+        await release([reservation])
+        raise
+    return FileVersionUploadResult(**stats._asdict())
+
+
+@router.get("/{file_id}/versions", response_model=List[FileVersionItem])
+async def list_file_versions(
+    file_id: int,
+    db: AsyncSession = Depends(get_read_db),
+    user: User = Depends(get_current_user),
+):
+    with span("db"):
+        result = await db.execute(
+            select(FileModel).where(
+                FileModel.id == file_id, FileModel.owner_id == user.id
+            )
+        )
+        db_file = result.scalars().first()
     if not db_file:
         raise HTTPException(404, "File not found")
+    if db_file.storage_path:
+        # Файл еще не версионировался: единственная версия — текущая
+        return [FileVersionItem(version=db_file.version, current=True)]
+    return [
+        _version_item(version, db_file.version)
+        for version in await list_versions(db, db_file)
+    ]
 
-    vault_path = db_file.vault_key_path
 
-    # Удаляем запись из БД
-    await db.delete(db_file)
-    await db.commit()
+@router.post(
+    "/{file_id}/versions/{version}/restore", response_model=FileVersionItem
+)
+async def restore_file_version(
+    file_id: int,
+    version: int,
+    db: AsyncSession = Depends(get_db),
+    user: User = Depends(get_current_user),
+):
+    """Делаем версию текущей; новые версии получают следующий свободный номер."""
+    db_file = await lock_file(db, user.id, file_id)
+    if not db_file:
+        raise HTTPException(404, "File not found")
+    if db_file.storage_path:
+        if version != db_file.version:
+            raise HTTPException(404, "Version not found")
+        return FileVersionItem(version=version, current=True)
+    db_version = await get_version(db, db_file, version)
+    if db_version is None:
+        raise HTTPException(404, "Version not found")
+    db_file.version = version
+    db_file.size = db_version.size
+    db_file.modified_at = func.now()
+    await record_changes(
+        db, user.id, [Change("version", file_id, db_file.filename, version)]
+    )
+    with span("db"):
+        await db.commit()
+    return _version_item(db_version, version)
 
-    await delete_file_key(vault_path)
 
-    # Удаляем файл с диска
-    if os.path.exists(db_file.storage_path):
-        os.remove(db_file.storage_path)
+@router.delete("/{file_id}/versions/{version}")
+async def delete_file_version(
+    file_id: int,
+    version: int,
+    db: AsyncSession = Depends(get_db),
+    user: User = Depends(get_current_user),
+):
+    db_file = await lock_file(db, user.id, file_id)
+    if not db_file:
+        raise HTTPException(404, "File not found")
+    if version == db_file.version:
+        raise HTTPException(409, "Нельзя удалить текущую версию")
+    db_version = None if db_file.storage_path else await get_version(db, db_file, version)
+    if db_version is None:
+        raise HTTPException(404, "Version not found")
+
+    freed = billed_size(db_version)
+    orphans = await delete_version(db, db_version)
+    await apply_usage(db, user.id, -freed, 0)
+    await record_changes(
+        db, user.id, [Change("version", file_id, db_file.filename, db_file.version)]
+    )
+    with span("db"):
+        await db.commit()
 
+    await _remove_orphans(orphans)
     return {"status": "ok"}
+
+
+@router.get("/dedup", response_model=DedupSettings)
+async def get_dedup_settings(user: User = Depends(get_current_user)):
+    return DedupSettings(enabled=user.dedup_enabled)
+
+
+@router.put("/dedup", response_model=DedupSettings)
+async def update_dedup_settings(
+    req: DedupSettings,
+    db: AsyncSession = Depends(get_db),
+    user: User = Depends(get_current_user),
+):
+    """Включение влияет только на новые загрузки, уже сохраненные файлы не меняются."""
+    user.dedup_enabled = req.enabled
+    db.add(user)
+    with span("db"):
+        await db.commit()
+    return DedupSettings(enabled=req.enabled)
@@ -0,0 +1,243 @@
+"""Папки с материализованным путем.
+
+`Folder.path` — id предков и самой папки: `/1/5/9/`. Содержимое папки —
+это прямые потомки по `parent_id` и файлы по `files.folder_id`, оба запроса
+идут по индексам `(owner_id, ...)`, так что листинг стоит O(детей).
+Переименование меняет одну строку. Перенос папки переписывает пути ее
+поддерева одним UPDATE по префиксу (`ix_folders_owner_id_path`); файлы,
+шифротекст и ключи в Vault при этом не меняются — файл ссылается на папку
+по id.
+
+Изменения дерева одного пользователя сериализуются advisory-блокировкой
+транзакции: иначе два встречных переноса могли бы образовать цикл.
+"""
+
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from sqlalchemy import exists, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from cypher_cloud.auth import get_current_user
+from cypher_cloud.changes import Change, record_changes
+from cypher_cloud.database import get_db, get_read_db
+from cypher_cloud.models import File as FileModel
+from cypher_cloud.models import Folder, User
+from cypher_cloud.profiling import span
+from cypher_cloud.schemas import (
+    FolderCreate,
+    FolderItem,
+    FolderListing,
+    FolderUpdate,
+)
+
+router = APIRouter()
+
+FOLDERS_LOCK_KEY = 0x666F6C64  # "fold"
+
+
+async def get_folder(
+    db: AsyncSession, owner_id: int, folder_id: int
+) -> Optional[Folder]:
+    with span("db"):
+        result = await db.execute(
+            select(Folder).where(Folder.owner_id == owner_id, Folder.id == folder_id)
+        )
+        return result.scalars().first()
+
+
+async def require_folder(
+    db: AsyncSession, owner_id: int, folder_id: Optional[int]
+) -> Optional[Folder]:
+    """Папка владельца или 404; `None` — корень."""
+    if folder_id is None:
+        return None
+    folder = await get_folder(db, owner_id, folder_id)
+    if folder is None:
+        raise HTTPException(404, "Folder not found")
+    return folder
+
+
+async def _lock_tree(db: AsyncSession, owner_id: int) -> None:
+    with span("db"):
+        await db.execute(
+            text("SELECT pg_advisory_xact_lock(:key, :owner)"),
+            {"key": FOLDERS_LOCK_KEY, "owner": owner_id},
+        )
+
+
+def _child_path(parent: Optional[Folder], folder_id: int) -> str:
+    return f"{parent.path if parent else '/'}{folder_id}/"
+
+
+async def _flush_unique(db: AsyncSession) -> None:
+    try:
+        with span("db"):
+            await db.flush()
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Папка с таким именем уже есть",
+        )
+
+
+@router.post("", response_model=FolderItem, status_code=status.HTTP_201_CREATED)
+async def create_folder(
+    req: FolderCreate,
+    db: AsyncSession = Depends(get_db),
+    user: User = Depends(get_current_user),
+):
+    await _lock_tree(db, user.id)
+    parent = await require_folder(db, user.id, req.parent_id)
+    folder = Folder(owner_id=user.id, parent_id=req.parent_id, name=req.name, path="")
+    db.add(folder)
+    await _flush_unique(db)
+    folder.path = _child_path(parent, folder.id)
+    await record_changes(
+        db, user.id, [Change("folder_create", None, folder.name, folder_id=folder.id)]
+    )
+    with span("db"):
+        await db.commit()
+    return folder
+
+
+@router.get("", response_model=List[FolderItem])
+async def list_folders(
+    db: AsyncSession = Depends(get_read_db),
+    user: User = Depends(get_current_user),
+):
+    """Все папки пользователя — для построения дерева на клиенте."""
+    with span("db"):
+        result = await db.execute(
+            select(Folder).where(Folder.owner_id == user.id).order_by(Folder.path)
+        )
+        return result.scalars().all()
+
+
+@router.get("/contents", response_model=FolderListing)
+async def list_folder_contents(
+    folder_id: Optional[int] = Query(None),
+    db: AsyncSession = Depends(get_read_db),
+    user: User = Depends(get_current_user),
+):
+    """Прямые потомки папки (без `folder_id` — корня) и путь к ней."""
+    folder = await require_folder(db, user.id, folder_id)
+    with span("db"):
+        breadcrumbs = []
+        if folder is not None:
+            ancestor_ids = [int(part) for part in folder.path.strip("/").split("/")[:-1]]
+            if ancestor_ids:
+                result = await db.execute(
+                    select(Folder).where(
+                        Folder.owner_id == user.id, Folder.id.in_(ancestor_ids)
+                    )
+                )
+                by_id = {ancestor.id: ancestor for ancestor in result.scalars()}
+                breadcrumbs = [by_id[id_] for id_ in ancestor_ids if id_ in by_id]
+        result = await db.execute(
+            select(Folder)
+            .where(Folder.owner_id == user.id, Folder.parent_id == folder_id)
+            .order_by(Folder.name)
+        )
+        folders = result.scalars().all()
+        result = await db.execute(
+            select(FileModel)
+            .where(FileModel.owner_id == user.id, FileModel.folder_id == folder_id)
+            .order_by(FileModel.filename)
+        )
+        files = result.scalars().all()
+    return FolderListing(
+        folder=folder, breadcrumbs=breadcrumbs, folders=folders, files=files
+    )
+
+
+@router.patch("/{folder_id}", response_model=FolderItem)
+async def update_folder(
+    folder_id: int,
+    req: FolderUpdate,
+    db: AsyncSession = Depends(get_db),
+    user: User = Depends(get_current_user),
+):
+    await _lock_tree(db, user.id)
+    folder = await require_folder(db, user.id, folder_id)
+    changed = False
+
+    if "parent_id" in req.model_fields_set and req.parent_id != folder.parent_id:
+        parent = await require_folder(db, user.id, req.parent_id)
+        if parent is not None and parent.path.startswith(folder.path):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Нельзя перенести папку в саму себя",
+            )
+        new_path = _child_path(parent, folder.id)
+        # Пути всего поддерева (включая саму папку) одним UPDATE по префиксу;
+        # в пути только цифры и "/", экранировать LIKE не нужно
+        with span("db"):
+            await db.execute(
+                text(
+                    "UPDATE folders SET path = :new || substr(path, :old_length + 1) "
+                    "WHERE owner_id = :owner AND path LIKE :old || '%'"
+                ),
+                {
+                    "new": new_path,
+                    "old": folder.path,
+                    "old_length": len(folder.path),
+                    "owner": user.id,
+                },
+            )
+        folder.path = new_path
+        folder.parent_id = req.parent_id
+        changed = True
+
+    if req.name is not None and req.name != folder.name:
+        folder.name = req.name
+        changed = True
+
+    if changed:
+        await _flush_unique(db)
+        await record_changes(
+            db, user.id, [Change("folder_update", None, folder.name, folder_id=folder.id)]
+        )
+        with span("db"):
+            await db.commit()
+    return folder
+
+
+@router.delete("/{folder_id}")
+async def delete_folder(
+    folder_id: int,
+    db: AsyncSession = Depends(get_db),
+    user: User = Depends(get_current_user),
+):
+    """Удаляется только пустая папка."""
+    await _lock_tree(db, user.id)
+    folder = await require_folder(db, user.id, folder_id)
+    with span("db"):
+        not_empty = await db.scalar(
+            select(
+                exists().where(Folder.owner_id == user.id, Folder.parent_id == folder_id)
+                | exists().where(
+                    FileModel.owner_id == user.id, FileModel.folder_id == folder_id
+                )
+            )
+        )
+    if not_empty:
+        raise HTTPException(status.HTTP_409_CONFLICT, "Папка не пуста")
+
+    try:
+        with span("db"):
+            await db.delete(folder)
+            await db.flush()
+    except IntegrityError:
+        # Файл загрузили в папку между проверкой и удалением
+        await db.rollback()
+        raise HTTPException(status.HTTP_409_CONFLICT, "Папка не пуста")
+    await record_changes(
+        db, user.id, [Change("folder_delete", None, folder.name, folder_id=folder_id)]
+    )
+    with span("db"):
+        await db.commit()
+    return {"status": "ok"}
@@ -0,0 +1,460 @@
+"""Импорт ZIP/TAR-архива: распаковка на сервере в отдельные файлы.
+
+Тело запроса потоком пишется во временный файл (`IMPORT_DIR`), после чего
+фоновая задача читает архив по одному элементу. Под каждый элемент
+резервируется квота, затем элементы передаются через ограниченную очередь в
+`IMPORT_WORKERS` обработчиков, которые шифруют и сохраняют их тем же путем,
+что и обычная загрузка. У каждого обработчика своя
+сессия, коммит — раз в `IMPORT_BATCH_SIZE` файлов вместе с обновлением
+прогресса задачи. Память ограничена размером очереди и не зависит от размера
+архива.
+
+Задача живет в памяти процесса. Если процесс перезапустится посреди импорта,
+уже закоммиченные файлы сохранятся, а задачу пометит `failed`
+`fail_stale_imports` при старте приложения.
+"""
+
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os
+import tarfile
+import uuid
+import zipfile
+from pathlib import Path
+from typing import Iterator, List, Optional, Set, Tuple
+
+import aiofiles
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from sqlalchemy import func, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from cypher_cloud.auth import get_current_user
+from cypher_cloud.changes import Change, record_changes
+from cypher_cloud.config import settings
+from cypher_cloud.database import async_session, get_db, get_read_db
+from cypher_cloud.files import MAX_FILE_SIZE, store_file
+from cypher_cloud.models import ImportJob, User
+from cypher_cloud.profiling import span
+from cypher_cloud.quotas import Reservation, apply_usage, release, reserve
+from cypher_cloud.ratelimit import enforce
+from cypher_cloud.schemas import ImportJobStatus
+from cypher_cloud.storage import sync_writes
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+IMPORT_MAX_ERRORS = 100
+
+# Ссылки на запущенные задачи, чтобы их не собрал GC
+_running: Set[asyncio.Task] = set()
+
+Member = Tuple[str, Optional[bytes], Optional[str]]  # имя, содержимое, ошибка
+
+
+def _member_name(name: str) -> str:
+    return name.replace("\\", "/").lstrip("/")
+
+
+def _read_zip(path: Path) -> Iterator[Member]:
+    with zipfile.ZipFile(path) as archive:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            name = _member_name(info.filename)
+            if info.file_size > MAX_FILE_SIZE:
+                yield name, None, "Файл слишком большой"
+                continue
+            with archive.open(info) as member:
+                # Не доверяем заголовку: читаем не больше лимита
+                content = member.read(MAX_FILE_SIZE + 1)
+            if len(content) > MAX_FILE_SIZE:
+                yield name, None, "Файл слишком большой"
+                continue
+            yield name, content, None
+
+
+def _read_tar(path: Path) -> Iterator[Member]:
+    # Потоковый режим: элементы читаются строго по порядку, без поиска по архиву
+    with tarfile.open(path, "r|*") as archive:
+        for info in archive:
+            if not info.isfile():
+                continue
+            name = _member_name(info.name)
+            if info.size > MAX_FILE_SIZE:
+                yield name, None, "Файл слишком большой"
+                continue
+            member = archive.extractfile(info)
+            yield name, member.read() if member else b"", None
+
+
+def _zip_total(path: Path) -> int:
+    with zipfile.ZipFile(path) as archive:
+        return sum(1 for info in archive.infolist() if not info.is_dir())
+
+
+def _detect_format(path: Path) -> Optional[str]:
+    if zipfile.is_zipfile(path):
+        return "zip"
+    if tarfile.is_tarfile(path):
+        return "tar"
+    return None
+
+
+def _produce(
+    path: Path,
+    archive_format: str,
+    queue: asyncio.Queue,
+    loop: asyncio.AbstractEventLoop,
+    stop: List[bool],
+) -> int:
+    """Читаем архив в отдельном потоке; put блокируется, пока очередь полна."""
+    reader = _read_zip if archive_format == "zip" else _read_tar
+    count = 0
+    for item in reader(path):
+        if stop[0]:
+            break
+        count += 1
+        if count > settings.IMPORT_MAX_MEMBERS:
+            raise ValueError(
+                f"В архиве больше {settings.IMPORT_MAX_MEMBERS} файлов"
+            )
+        future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+        while True:
+            try:
+                future.result(timeout=1)
+                break
+            except concurrent.futures.TimeoutError:
+                if stop[0]:
+                    future.cancel()
+                    return count
+    return count
+
+
+class _Batch:
+    """Несохраненная пачка обработчика: счетчики, ошибки и резервы до коммита."""
+
+    def __init__(self) -> None:
+        self.counters = {"processed": 0, "succeeded": 0, "failed": 0, "bytes": 0}
+        self.errors: List[dict] = []
+        self.changes: List[Change] = []
+        self.reservations: List[Reservation] = []
+        self.stored: List[str] = []  # имена файлов, записанных в транзакцию
+
+    def clear(self) -> None:
+        for key in self.counters:
+            self.counters[key] = 0
+        self.errors.clear()
+        self.changes.clear()
+        self.reservations.clear()
+        self.stored.clear()
+
+
+async def _report(db: AsyncSession, user: User, job_id: str, batch: _Batch) -> None:
+    await sync_writes()  # файлы пачки — на диск до коммита
+    counters = batch.counters
+    await apply_usage(
+        db, user.id, counters["bytes"], counters["succeeded"], batch.reservations
+    )
+    await record_changes(db, user.id, batch.changes)
+    await db.execute(
+        text(
+            "UPDATE import_jobs SET "
+            "processed = processed + :processed, "
+            "succeeded = succeeded + :succeeded, "
+            "failed = failed + :failed, "
+            "bytes = bytes + :bytes, "
+            "errors = CASE WHEN jsonb_array_length(errors) < :max_errors "
+            "THEN errors || CAST(:errors AS jsonb) ELSE errors END, "
+            "updated_at = now() WHERE id = :id"
+        ),
+        {
+            **counters,
+            "errors": json.dumps(batch.errors),
+            "max_errors": IMPORT_MAX_ERRORS,
+            "id": job_id,
+        },
+    )
+
+
+async def _flush(db: AsyncSession, user: User, job_id: str, batch: _Batch) -> None:
+    """Коммитим пачку. Если коммит не удался, файлы пачки считаем
+    неудачными и записываем хотя бы прогресс задачи; не удалось и это —
+    обработчик падает, и импорт останавливается."""
+    try:
+        with span("db"):
+            await _report(db, user, job_id, batch)
+            await db.commit()
+    except Exception as exc:  # noqa: BLE001
+        logger.warning("Import %s: failed to commit a batch: %s", job_id, exc)
+        await db.rollback()
+        await release(batch.reservations)
+        counters = batch.counters
+        counters["failed"] += counters["succeeded"]
+        counters["succeeded"] = counters["bytes"] = 0
+        batch.errors.extend(
+            {"filename": name, "error": "Ошибка при сохранении"}
+            for name in batch.stored
+        )
+        batch.changes.clear()
+        batch.reservations.clear()
+        with span("db"):
+            await _report(db, user, job_id, batch)
+            await db.commit()
+    batch.clear()
+
+
+async def _reserve_stage(
+    user: User, members: asyncio.Queue, reserved: asyncio.Queue, workers: int
+) -> None:
+    """Резервируем квоту под элементы по одному, до обработчиков: у
+    обработчика открыта транзакция пачки, и ждать второе соединение под
+    резерв, держа ее, он не должен."""
+    while True:
+        item = await members.get()
+        if item is None:
+            break
+        name, content, error = item
+        reservation = None
+        if error is None:
+            try:
+                reservation = await reserve(user.id, len(content), 1)
+            except HTTPException as exc:
+                error = exc.detail
+            except Exception as exc:  # noqa: BLE001
+                logger.warning("Import: failed to reserve quota for %s: %s", name, exc)
+                error = "Не удалось зарезервировать место"
+        await reserved.put((name, content, error, reservation))
+    for _ in range(workers):
+        await reserved.put(None)
+
+
+async def _worker(user: User, job_id: str, queue: asyncio.Queue) -> None:
+    batch = _Batch()
+    async with async_session() as db:
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            name, content, error, reservation = item
+            if error is None:
+                try:
+                    async with db.begin_nested():
+                        new_file = await store_file(
+                            db, user, name, content, durable=False
+                        )
+                    batch.changes.append(
+                        Change("upload", new_file.id, new_file.filename, new_file.version)
+                    )
+                    batch.reservations.append(reservation)
+                    batch.stored.append(name)
+                    batch.counters["succeeded"] += 1
+                    batch.counters["bytes"] += len(content)
+                except Exception as exc:  # noqa: BLE001
+                    logger.warning("Import %s: failed to store %s: %s", job_id, name, exc)
+                    await release([reservation])
+                    error = "Ошибка при сохранении"
+            if error is not None:
+                batch.counters["failed"] += 1
+                batch.errors.append({"filename": name, "error": error})
+            batch.counters["processed"] += 1
+            if batch.counters["processed"] >= settings.IMPORT_BATCH_SIZE:
+                await _flush(db, user, job_id, batch)
+        if batch.counters["processed"]:
+            await _flush(db, user, job_id, batch)
+
+
+async def _read_archive(
+    path: Path, archive_format: str, members: asyncio.Queue, stop: List[bool]
+) -> Tuple[Optional[int], Optional[str]]:
+    """Число элементов и ошибка разбора архива; в конце — метка конца очереди."""
+    loop = asyncio.get_running_loop()
+    total, error = None, None
+    try:
+        total = await asyncio.to_thread(
+            _produce, path, archive_format, members, loop, stop
+        )
+    except (ValueError, zipfile.BadZipFile, tarfile.TarError, EOFError) as exc:
+        error = str(exc) or "Поврежденный архив"
+    await members.put(None)
+    return total, error
+
+
+async def _heartbeat(job_id: str) -> None:
+    """Задача жива, пока ее updated_at свежий (см. fail_stale_imports)."""
+    while True:
+        await asyncio.sleep(settings.IMPORT_STALE_SECONDS / 4)
+        try:
+            async with async_session() as db:
+                await db.execute(
+                    text(
+                        "UPDATE import_jobs SET updated_at = now() "
+                        "WHERE id = :id AND status = 'running'"
+                    ),
+                    {"id": job_id},
+                )
+                await db.commit()
+        except Exception as exc:  # noqa: BLE001
+            logger.warning("Import %s: heartbeat failed: %s", job_id, exc)
+
+
+async def _set_status(job_id: str, status_: str, **values) -> None:
+    async with async_session() as db:
+        job = await db.get(ImportJob, job_id)
+        job.status = status_
+        job.updated_at = func.now()
+        for key, value in values.items():
+            setattr(job, key, value)
+        await db.commit()
+
+
+async def fail_stale_imports() -> int:
+    """Задачи импорта живут в памяти процесса: после перезапуска их никто не
+    продолжит. Помечаем failed те, чей updated_at давно не обновлялся, —
+    свежие может вести соседний воркер."""
+    async with async_session() as db:
+        result = await db.execute(
+            text(
+                "UPDATE import_jobs SET status = 'failed', "
+                "error = 'Импорт прерван перезапуском сервера', "
+                "finished_at = now(), updated_at = now() "
+                "WHERE status IN ('queued', 'running') "
+                "AND updated_at < now() - make_interval(secs => :stale)"
+            ),
+            {"stale": settings.IMPORT_STALE_SECONDS},
+        )
+        await db.commit()
+    if result.rowcount:
+        logger.warning("Marked %d interrupted imports as failed", result.rowcount)
+    return result.rowcount
+
+
+async def run_import(user: User, job_id: str, path: Path, archive_format: str) -> None:
+    members: asyncio.Queue = asyncio.Queue(maxsize=settings.IMPORT_WORKERS)
+    queue: asyncio.Queue = asyncio.Queue(maxsize=settings.IMPORT_WORKERS)
+    stop = [False]
+    stages: List[asyncio.Task] = []
+    heartbeat = asyncio.create_task(_heartbeat(job_id))
+    error = None
+    total = None
+    try:
+        if archive_format == "zip":
+            total = await asyncio.to_thread(_zip_total, path)
+            await _set_status(job_id, "running", total=total)
+        else:
+            await _set_status(job_id, "running")
+        stages = [
+            asyncio.create_task(_read_archive(path, archive_format, members, stop)),
+            asyncio.create_task(
+                _reserve_stage(user, members, queue, settings.IMPORT_WORKERS)
+            ),
+            *(
+                asyncio.create_task(_worker(user, job_id, queue))
+                for _ in range(settings.IMPORT_WORKERS)
+            ),
+        ]
+        # Упавший этап больше не читает свою очередь: ждать остальных нельзя,
+        # иначе чтение архива и соседние этапы повиснут на полной очереди
+        done, _ = await asyncio.wait(stages, return_when=asyncio.FIRST_EXCEPTION)
+        for stage in done:
+            if not stage.cancelled() and stage.exception() is not None:
+                raise stage.exception()
+        produced, error = stages[0].result()
+        if produced is not None and error is None:
+            total = produced
+    except BaseException as exc:
+        logger.exception("Import %s failed", job_id)
+        error = error or "Внутренняя ошибка при импорте"
+        if not isinstance(exc, Exception):
+            raise
+    finally:
+        # Поток чтения архива выходит по stop, этапы — по отмене
+        stop[0] = True
+        heartbeat.cancel()
+        for stage in stages:
+            stage.cancel()
+        if stages:
+            await asyncio.wait(stages)
+        await asyncio.to_thread(path.unlink, True)
+        await _set_status(
+            job_id,
+            "failed" if error else "completed",
+            total=total,
+            error=error,
+            finished_at=func.now(),
+        )
+
+
+def _job_status(job: ImportJob) -> ImportJobStatus:
+    return ImportJobStatus.model_validate(job)
+
+
+@router.post(
+    "/import",
+    response_model=ImportJobStatus,
+    status_code=status.HTTP_202_ACCEPTED,
+)
+async def import_archive(
+    request: Request,
+    db: AsyncSession = Depends(get_db),
+    user: User = Depends(get_current_user),
+):
+    """Тело запроса — сам архив (ZIP или TAR, в том числе .tar.gz/.tar.bz2/.tar.xz)."""
+    await enforce(request, "transfer", user.id, by_ip=False)
+    import_dir = Path(settings.IMPORT_DIR)
+    import_dir.mkdir(parents=True, exist_ok=True)
+    job_id = uuid.uuid4().hex
+    path = import_dir / f"{user.id}_{job_id}.archive"
+
+    size = 0
+    try:
+        with span("io"):
+            async with aiofiles.open(path, "wb") as f_out:
+                async for chunk in request.stream():
+                    size += len(chunk)
+                    if size > settings.IMPORT_MAX_ARCHIVE_SIZE:
+                        raise HTTPException(
+                            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail="Архив слишком большой",
+                        )
+                    await f_out.write(chunk)
+        archive_format = await asyncio.to_thread(_detect_format, path)
+        if archive_format is None:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Ожидается ZIP или TAR архив",
+            )
+    except BaseException:
+        if path.exists():
+            os.remove(path)
+        raise
+
+    job = ImportJob(id=job_id, owner_id=user.id, format=archive_format, errors=[])
+    db.add(job)
+    with span("db"):
+        await db.commit()
+        await db.refresh(job)
+
+    task = asyncio.create_task(run_import(user, job_id, path, archive_format))
+    _running.add(task)
+    task.add_done_callback(_running.discard)
+    return _job_status(job)
+
+
+@router.get("/import/{job_id}", response_model=ImportJobStatus)
+async def get_import_status(
+    job_id: str,
+    db: AsyncSession = Depends(get_read_db),
+    user: User = Depends(get_current_user),
+):
+    with span("db"):
+        result = await db.execute(
+            select(ImportJob).where(ImportJob.id == job_id, ImportJob.owner_id == user.id)
+        )
+        job = result.scalars().first()
+    if not job:
+        raise HTTPException(404, "Import job not found")
+    return _job_status(job)
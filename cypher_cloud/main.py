@@ -1,13 +1,76 @@
-import os
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, Request
+from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
 
+from cypher_cloud import database, vault_client
 from cypher_cloud.auth import router as auth_router
+from cypher_cloud.changes import router as changes_router
+from cypher_cloud.changes import stop_listener
 from cypher_cloud.config import settings
-from cypher_cloud.database import Base, engine
+from cypher_cloud.database import Base, dispose_engines, get_engine
 from cypher_cloud.files import router as files_router
+from cypher_cloud.folders import router as folders_router
+from cypher_cloud.imports import fail_stale_imports
+from cypher_cloud.imports import router as imports_router
+from cypher_cloud.metrics import router as metrics_router
+from cypher_cloud.migrations import run_migrations
+from cypher_cloud.packing import compaction_loop
+from cypher_cloud.profiling import ServerTimingMiddleware, build_profiler
+from cypher_cloud.quotas import recount_loop
+from cypher_cloud.quotas import router as quotas_router
+from cypher_cloud.scrub import scrub_loop
+from cypher_cloud.sharing import public_router as share_public_router
+from cypher_cloud.sharing import router as share_router
+from cypher_cloud.storage import prepare_storage, remove_stale_tmp
+
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Все, что трогает диск, БД и Vault, — здесь, а не при импорте модулей.
+    uvicorn начинает принимать запросы (и воркер считается готовым) только
+    после выхода из этой секции."""
+    started = time.perf_counter()
+    prepare_storage()
+    # Каталог может быть большим: обходим его в потоке, не задерживая старт
+    app.state.tmp_sweep = asyncio.create_task(asyncio.to_thread(remove_stale_tmp))
+    # Недостающие таблицы создаются всегда, как и до lifespan; флаг
+    # отключает только версионированные миграции
+    async with get_engine().begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    if settings.MIGRATIONS_ON_STARTUP:
+        await run_migrations(get_engine())
+    await fail_stale_imports()
+    if settings.STARTUP_PREWARM:
+        # Прогрев только ускоряет первые запросы: без него воркер работает
+        results = await asyncio.gather(
+            database.warm_up(), vault_client.warm_up(), return_exceptions=True
+        )
+        for name, result in zip(("Database", "Vault"), results):
+            if isinstance(result, Exception):
+                logger.warning("%s warm-up failed: %s", name, result)
+    if settings.COMPACT_INTERVAL_SECONDS > 0:
+        app.state.compactor = asyncio.create_task(compaction_loop())
+    if settings.QUOTA_RECOUNT_INTERVAL_SECONDS > 0:
+        app.state.usage_recount = asyncio.create_task(recount_loop())
+    if settings.SCRUB_INTERVAL_SECONDS > 0:
+        app.state.scrubber = asyncio.create_task(scrub_loop())
+    logger.info("Startup finished in %.3f s", time.perf_counter() - started)
+    try:
+        yield
+    finally:
+        for name in ("tmp_sweep", "compactor", "usage_recount", "scrubber"):
+            task = getattr(app.state, name, None)
+            if task is not None:
+                task.cancel()
+        await stop_listener()
+        await dispose_engines()
+
 
 app = FastAPI(  # Создаем экземпляр FastAPI
     title="Cypher Cloud",
@@ -15,6 +78,7 @@ app = FastAPI(  # Создаем экземпляр FastAPI
     version="0.1",
     root_path="/api/v1",
     docs_url="/docs",
+    lifespan=lifespan,
 )
 
 app.add_middleware(
@@ -25,12 +89,22 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Server-Timing и выборочные профили для роутеров auth и files
+app.add_middleware(
+    ServerTimingMiddleware,
+    prefixes=("/auth", "/files", "/folders", "/share"),
+    emit_header=settings.SERVER_TIMING_ENABLED,
+    profiler=build_profiler(),
+)
+
 # Подключаем роутеры
 app.include_router(auth_router, prefix="/auth", tags=["auth"])
+app.include_router(changes_router, prefix="/files", tags=["files"])
+app.include_router(quotas_router, prefix="/files", tags=["files"])
 app.include_router(files_router, prefix="/files", tags=["files"])
+app.include_router(imports_router, prefix="/files", tags=["files"])
+app.include_router(folders_router, prefix="/folders", tags=["folders"])
+app.include_router(share_router, prefix="/files", tags=["share"])
+app.include_router(share_public_router, prefix="/share", tags=["share"])
+app.include_router(metrics_router, tags=["metrics"])
 
-
-@app.on_event("startup")
-async def startup_event():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
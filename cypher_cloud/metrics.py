@@ -0,0 +1,86 @@
+"""Метрики в текстовом формате Prometheus: `GET /metrics`.
+
+Модули регистрируют асинхронные сборщики через `register`; значения
+собираются в момент запроса, отдельного реестра с состоянием нет. Если задан
+`METRICS_TOKEN`, запрос должен нести `Authorization: Bearer <токен>`.
+"""
+
+import asyncio
+import hmac
+import logging
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from fastapi import APIRouter, Header, HTTPException, status
+from fastapi.responses import PlainTextResponse
+
+from cypher_cloud.config import settings
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Metric(NamedTuple):
+    name: str
+    help: str
+    type: str  # gauge | counter
+    samples: List[Tuple[Dict[str, str], float]]
+
+
+Collector = Callable[[], Awaitable[List[Metric]]]
+
+_collectors: List[Collector] = []
+
+
+def register(collector: Collector) -> Collector:
+    _collectors.append(collector)
+    return collector
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format(value: float) -> str:
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def render(metrics: List[Metric]) -> str:
+    lines = []
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for labels, value in metric.samples:
+            label_text = ",".join(
+                f'{name}="{_escape(str(label))}"' for name, label in labels.items()
+            )
+            name = f"{metric.name}{{{label_text}}}" if label_text else metric.name
+            lines.append(f"{name} {_format(value)}")
+    return "\n".join(lines) + "\n"
+
+
+async def collect() -> List[Metric]:
+    results = await asyncio.gather(
+        *(collector() for collector in _collectors), return_exceptions=True
+    )
+    metrics: List[Metric] = []
+    for collector, result in zip(_collectors, results):
+        if isinstance(result, BaseException):
+            logger.error(
+                "Metrics collector %s failed", collector.__qualname__, exc_info=result
+            )
+            continue
+        metrics.extend(result)
+    return metrics
+
+
+@router.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def get_metrics(authorization: Optional[str] = Header(None)):
+    if settings.METRICS_TOKEN and not hmac.compare_digest(
+        authorization or "", f"Bearer {settings.METRICS_TOKEN}"
+    ):
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Invalid metrics token")
+    return PlainTextResponse(render(await collect()), media_type=CONTENT_TYPE)
@@ -0,0 +1,566 @@
+"""Версионированные миграции схемы поверх `Base.metadata.create_all`.
+
+`create_all` по-прежнему создает недостающие таблицы (в том числе на пустой
+БД сразу в актуальном виде), а миграции доводят существующую базу до той же
+схемы. Поэтому каждая миграция обязана быть идемпотентной: `IF NOT EXISTS`,
+`IF EXISTS` и т.п. Примененные версии хранятся в таблице `schema_migrations`.
+
+Индексы на больших таблицах строятся `CONCURRENTLY` (вне транзакции, без
+блокировки записи), остальные DDL выполняются в транзакции с коротким
+`lock_timeout`, чтобы не выстраивать очередь из запросов за блокировкой.
+
+Запуск вне старта приложения:
+
+    python -m cypher_cloud.migrations upgrade
+    python -m cypher_cloud.migrations status
+    python -m cypher_cloud.migrations partition-files --partitions 16
+"""
+
+import argparse
+import asyncio
+import logging
+import re
+from typing import List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+logger = logging.getLogger(__name__)
+
+# Ключ advisory lock: несколько воркеров не применяют миграции одновременно
+MIGRATIONS_LOCK_KEY = 0x63797068  # "cyph"
+LOCK_TIMEOUT = "5s"
+LOCK_RETRIES = 20
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    statements: Tuple[str, ...]
+    # CREATE/DROP INDEX CONCURRENTLY нельзя выполнять внутри транзакции
+    transactional: bool = True
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(
+        1,
+        "owner-scoped indexes on files",
+        (
+            "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ix_files_owner_id_id "
+            "ON files (owner_id, id)",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_files_owner_id_filename "
+            "ON files (owner_id, filename)",
+            "DROP INDEX CONCURRENTLY IF EXISTS ix_files_filename",
+            "DROP INDEX CONCURRENTLY IF EXISTS ix_files_id",
+        ),
+        transactional=False,
+    ),
+    Migration(
+        2,
+        "pg_trgm and btree_gin extensions",
+        (
+            "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+            "CREATE EXTENSION IF NOT EXISTS btree_gin",
+        ),
+    ),
+    Migration(
+        3,
+        "trigram index for owner-scoped filename search",
+        (
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_files_owner_id_filename_trgm "
+            "ON files USING gin (owner_id, filename gin_trgm_ops)",
+        ),
+        transactional=False,
+    ),
+    Migration(
+        4,
+        "per-user deduplication: users.dedup_enabled, files.blob_id",
+        (
+            "ALTER TABLE users ADD COLUMN IF NOT EXISTS dedup_enabled boolean "
+            "NOT NULL DEFAULT false",
+            "ALTER TABLE files ADD COLUMN IF NOT EXISTS blob_id integer",
+            # NOT VALID: без сканирования files под блокировкой
+            "DO $$ BEGIN "
+            "IF NOT EXISTS (SELECT 1 FROM pg_constraint "
+            "WHERE conname = 'files_blob_id_fkey') THEN "
+            "ALTER TABLE files ADD CONSTRAINT files_blob_id_fkey "
+            "FOREIGN KEY (blob_id) REFERENCES blobs (id) NOT VALID; "
+            "END IF; END $$",
+        ),
+    ),
+    Migration(
+        5,
+        "validate files.blob_id foreign key",
+        ("ALTER TABLE files VALIDATE CONSTRAINT files_blob_id_fkey",),
+    ),
+    Migration(
+        6,
+        "index on files.blob_id",
+        (
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_files_blob_id "
+            "ON files (blob_id) WHERE blob_id IS NOT NULL",
+        ),
+        transactional=False,
+    ),
+    Migration(
+        7,
+        "file versions: files.version",
+        (
+            "ALTER TABLE files ADD COLUMN IF NOT EXISTS version integer "
+            "NOT NULL DEFAULT 1",
+        ),
+    ),
+    Migration(
+        8,
+        "small-file segments: segment columns on files and file_versions",
+        tuple(
+            statement
+            for table in ("files", "file_versions")
+            for statement in (
+                f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS segment_id integer",
+                f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS segment_offset bigint",
+                f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS segment_length integer",
+                "DO $$ BEGIN "
+                "IF NOT EXISTS (SELECT 1 FROM pg_constraint "
+                f"WHERE conname = '{table}_segment_id_fkey') THEN "
+                f"ALTER TABLE {table} ADD CONSTRAINT {table}_segment_id_fkey "
+                "FOREIGN KEY (segment_id) REFERENCES segments (id) NOT VALID; "
+                "END IF; END $$",
+            )
+        ),
+    ),
+    Migration(
+        9,
+        "validate segment foreign keys",
+        (
+            "ALTER TABLE files VALIDATE CONSTRAINT files_segment_id_fkey",
+            "ALTER TABLE file_versions VALIDATE CONSTRAINT file_versions_segment_id_fkey",
+        ),
+    ),
+    Migration(
+        10,
+        "segment indexes on files and file_versions",
+        (
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_files_segment_id "
+            "ON files (segment_id) WHERE segment_id IS NOT NULL",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_file_versions_segment_id "
+            "ON file_versions (segment_id) WHERE segment_id IS NOT NULL",
+        ),
+        transactional=False,
+    ),
+    Migration(
+        11,
+        "change feed: users.change_seq, users.changes_floor",
+        (
+            "ALTER TABLE users ADD COLUMN IF NOT EXISTS change_seq bigint "
+            "NOT NULL DEFAULT 0",
+            "ALTER TABLE users ADD COLUMN IF NOT EXISTS changes_floor bigint "
+            "NOT NULL DEFAULT 0",
+        ),
+    ),
+    Migration(
+        12,
+        "folders: files.folder_id, folder events in file_changes",
+        (
+            "ALTER TABLE files ADD COLUMN IF NOT EXISTS folder_id integer",
+            "DO $$ BEGIN "
+            "IF NOT EXISTS (SELECT 1 FROM pg_constraint "
+            "WHERE conname = 'files_folder_id_fkey') THEN "
+            "ALTER TABLE files ADD CONSTRAINT files_folder_id_fkey "
+            "FOREIGN KEY (folder_id) REFERENCES folders (id) NOT VALID; "
+            "END IF; END $$",
+            "ALTER TABLE file_changes ADD COLUMN IF NOT EXISTS folder_id integer",
+            "ALTER TABLE file_changes ALTER COLUMN file_id DROP NOT NULL",
+        ),
+    ),
+    Migration(
+        13,
+        "validate files.folder_id foreign key",
+        ("ALTER TABLE files VALIDATE CONSTRAINT files_folder_id_fkey",),
+    ),
+    Migration(
+        14,
+        "folder index on files",
+        (
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_files_owner_id_folder_id "
+            "ON files (owner_id, folder_id)",
+        ),
+        transactional=False,
+    ),
+    Migration(
+        15,
+        "quotas: files.size",
+        ("ALTER TABLE files ADD COLUMN IF NOT EXISTS size bigint",),
+    ),
+    Migration(
+        16,
+        "scrubber: ciphertext digests",
+        tuple(
+            f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS ciphertext_sha256 "
+            "varchar(64)"
+            for table in ("files", "file_versions", "blobs", "file_chunks")
+        ),
+    ),
+    Migration(
+        17,
+        "conditional downloads: files.modified_at",
+        (
+            # Без значения по умолчанию в ADD COLUMN таблица не
+            # переписывается; старые строки остаются с NULL
+            "ALTER TABLE files ADD COLUMN IF NOT EXISTS modified_at timestamptz",
+            "ALTER TABLE files ALTER COLUMN modified_at SET DEFAULT now()",
+        ),
+    ),
+    Migration(
+        18,
+        "quotas: estimated sizes apart from exact ones",
+        tuple(
+            f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS estimated_size bigint"
+            for table in ("files", "file_versions")
+        ),
+    ),
+]
+
+_CONCURRENT_INDEX = re.compile(
+    r"CREATE (?P<unique>UNIQUE )?INDEX CONCURRENTLY IF NOT EXISTS (?P<name>\w+) "
+    r"ON (?P<table>\w+) (?P<rest>.+)",
+    re.IGNORECASE | re.DOTALL,
+)
+
+
+async def _drop_invalid_index(conn: AsyncConnection, name: str) -> None:
+    """Прерванный CREATE INDEX CONCURRENTLY оставляет INVALID-индекс,
+    который `IF NOT EXISTS` молча пропустил бы. Удаляем его перед повтором."""
+    result = await conn.execute(
+        text(
+            "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE c.relname = :name AND NOT i.indisvalid"
+        ),
+        {"name": name},
+    )
+    if result.first():
+        logger.warning("Dropping invalid index %s before rebuilding", name)
+        await conn.exec_driver_sql(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+
+async def _partitions_of(conn: AsyncConnection, table: str) -> List[str]:
+    result = await conn.execute(
+        text(
+            "SELECT i.inhrelid::regclass::text FROM pg_inherits i "
+            "JOIN pg_partitioned_table p ON p.partrelid = i.inhparent "
+            "WHERE i.inhparent = CAST(:table AS regclass) ORDER BY 1"
+        ),
+        {"table": table},
+    )
+    return [row[0] for row in result]
+
+
+async def _execute_concurrently(conn: AsyncConnection, statement: str) -> None:
+    match = _CONCURRENT_INDEX.match(statement)
+    if not match:
+        await conn.exec_driver_sql(statement)
+        return
+    name, table, rest = match["name"], match["table"], match["rest"]
+    unique = match["unique"] or ""
+    partitions = await _partitions_of(conn, table)
+    if not partitions:
+        await _drop_invalid_index(conn, name)
+        await conn.exec_driver_sql(statement)
+        return
+    # На партиционированной таблице CONCURRENTLY не поддерживается: создаем
+    # пустой индекс на родителе и строим индексы партиций по одной
+    await conn.exec_driver_sql(
+        f"CREATE {unique}INDEX IF NOT EXISTS {name} ON ONLY {table} {rest}"
+    )
+    for partition in partitions:
+        child = f"{name}_{partition}"[:63]
+        await _drop_invalid_index(conn, child)
+        await conn.exec_driver_sql(
+            f"CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS {child} "
+            f"ON {partition} {rest}"
+        )
+        await conn.exec_driver_sql(f"ALTER INDEX {name} ATTACH PARTITION {child}")
+
+
+async def _with_lock_retries(bind: AsyncEngine, statements: List[str]) -> None:
+    """Выполняем DDL в одной транзакции; при lock_timeout повторяем с паузой."""
+    for attempt in range(1, LOCK_RETRIES + 1):
+        try:
+            async with bind.begin() as conn:
+                await conn.exec_driver_sql(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'")
+                for statement in statements:
+                    await conn.exec_driver_sql(statement)
+            return
+        except DBAPIError as exc:
+            if "lock timeout" not in str(exc.orig) or attempt == LOCK_RETRIES:
+                raise
+            logger.warning("Lock timeout, retrying (%s/%s)", attempt, LOCK_RETRIES)
+            await asyncio.sleep(min(attempt, 5))
+
+
+async def applied_versions(conn: AsyncConnection) -> List[int]:
+    await conn.exec_driver_sql(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version integer PRIMARY KEY, "
+        "description text NOT NULL, "
+        "applied_at timestamptz NOT NULL DEFAULT now())"
+    )
+    result = await conn.execute(text("SELECT version FROM schema_migrations"))
+    return sorted(row[0] for row in result)
+
+
+async def run_migrations(bind: AsyncEngine) -> None:
+    """Применяем все еще не примененные миграции по порядку."""
+    async with bind.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.execute(
+            text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATIONS_LOCK_KEY}
+        )
+        try:
+            applied = set(await applied_versions(conn))
+            for migration in MIGRATIONS:
+                if migration.version in applied:
+                    continue
+                logger.info(
+                    "Applying migration %s: %s", migration.version, migration.description
+                )
+                record = (
+                    "INSERT INTO schema_migrations (version, description) "
+                    f"VALUES ({migration.version}, "
+                    f"'{migration.description.replace(chr(39), chr(39) * 2)}')"
+                )
+                if migration.transactional:
+                    await _with_lock_retries(bind, [*migration.statements, record])
+                    continue
+                for statement in migration.statements:
+                    await _execute_concurrently(conn, statement)
+                await conn.exec_driver_sql(record)
+        finally:
+            await conn.execute(
+                text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATIONS_LOCK_KEY}
+            )
+
+
+# --- Hash-партиционирование files по owner_id -------------------------------
+
+
+async def _files_columns(conn: AsyncConnection) -> List[str]:
+    result = await conn.execute(
+        text(
+            "SELECT attname FROM pg_attribute "
+            "WHERE attrelid = 'files'::regclass AND attnum > 0 AND NOT attisdropped "
+            "ORDER BY attnum"
+        )
+    )
+    return [row[0] for row in result]
+
+
+async def _is_partitioned(conn: AsyncConnection) -> bool:
+    result = await conn.execute(
+        text("SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'files'::regclass")
+    )
+    return result.first() is not None
+
+
+async def partition_files(
+    bind: AsyncEngine, partitions: int, batch_size: int, pause: float = 0.0
+) -> None:
+    """Онлайн-перенос `files` в таблицу, партиционированную HASH (owner_id).
+
+    1. Создаем `files_partitioned` с PK (owner_id, id), партициями и копиями
+       всех индексов `files`; триггер на `files` зеркалирует в нее записи.
+    2. Копируем строки пачками по id. Каждая пачка держит SHARE-блокировку
+       (запись ждет только на время одной пачки).
+    3. В короткой транзакции меняем таблицы местами и перевешиваем внешние
+       ключи, ссылающиеся на files. Старая таблица остается как
+       `files_unpartitioned` — удалите ее после проверки.
+    """
+    async with bind.connect() as conn:
+        if await _is_partitioned(conn):
+            logger.info("files is already partitioned")
+            return
+        nulls = await conn.execute(
+            text("SELECT 1 FROM files WHERE owner_id IS NULL LIMIT 1")
+        )
+        if nulls.first():
+            raise RuntimeError("files contains rows without owner_id")
+        columns = await _files_columns(conn)
+        indexes = (
+            await conn.execute(
+                text(
+                    "SELECT c.relname, pg_get_indexdef(i.indexrelid) "
+                    "FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                    "WHERE i.indrelid = 'files'::regclass AND NOT i.indisprimary"
+                )
+            )
+        ).all()
+        foreign_keys = (
+            await conn.execute(
+                text(
+                    "SELECT conrelid::regclass::text, conname, "
+                    "pg_get_constraintdef(oid) FROM pg_constraint "
+                    "WHERE contype = 'f' AND confrelid = 'files'::regclass"
+                )
+            )
+        ).all()
+        outbound_keys = (
+            await conn.execute(
+                text(
+                    "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+                    "WHERE contype = 'f' AND conrelid = 'files'::regclass "
+                    "AND conname <> 'files_owner_id_fkey'"
+                )
+            )
+        ).all()
+        await conn.rollback()
+    for table, constraint, definition in foreign_keys:
+        if "REFERENCES files(owner_id, id)" not in definition:
+            raise RuntimeError(
+                f"{table}.{constraint} must reference files(owner_id, id) "
+                "to survive partitioning"
+            )
+
+    column_list = ", ".join(columns)
+    updates = ", ".join(f"{c} = EXCLUDED.{c}" for c in columns)
+    setup = [
+        "DROP TABLE IF EXISTS files_partitioned",
+        "CREATE TABLE files_partitioned (LIKE files INCLUDING DEFAULTS "
+        "INCLUDING CONSTRAINTS) PARTITION BY HASH (owner_id)",
+        "ALTER TABLE files_partitioned ALTER COLUMN owner_id SET NOT NULL",
+        "ALTER TABLE files_partitioned ADD CONSTRAINT files_partitioned_pkey "
+        "PRIMARY KEY (owner_id, id)",
+        "ALTER TABLE files_partitioned ADD CONSTRAINT files_partitioned_owner_id_fkey "
+        "FOREIGN KEY (owner_id) REFERENCES users (id) ON DELETE CASCADE",
+    ]
+    setup += [
+        f"ALTER TABLE files_partitioned ADD CONSTRAINT {name}_p {definition}"
+        for name, definition in outbound_keys
+    ]
+    setup += [
+        f"CREATE TABLE files_p{i} PARTITION OF files_partitioned "
+        f"FOR VALUES WITH (MODULUS {partitions}, REMAINDER {i})"
+        for i in range(partitions)
+    ]
+    for name, definition in indexes:
+        if name == "ix_files_owner_id_id":
+            continue  # его роль выполняет PK (owner_id, id)
+        setup.append(
+            definition.replace(f"INDEX {name} ON", f"INDEX {name}_p ON", 1).replace(
+                " ON public.files ", " ON files_partitioned ", 1
+            )
+        )
+    setup += [
+        "CREATE OR REPLACE FUNCTION files_partition_sync() RETURNS trigger AS $$ "
+        "BEGIN "
+        "IF TG_OP IN ('DELETE', 'UPDATE') THEN "
+        "DELETE FROM files_partitioned WHERE owner_id = OLD.owner_id AND id = OLD.id; "
+        "END IF; "
+        "IF TG_OP IN ('INSERT', 'UPDATE') THEN "
+        f"INSERT INTO files_partitioned ({column_list}) SELECT (NEW).*; "
+        "END IF; "
+        "RETURN NULL; "
+        "END $$ LANGUAGE plpgsql",
+        "CREATE TRIGGER files_partition_sync AFTER INSERT OR UPDATE OR DELETE "
+        "ON files FOR EACH ROW EXECUTE FUNCTION files_partition_sync()",
+    ]
+    await _with_lock_retries(bind, setup)
+    logger.info("Created files_partitioned with %s partitions", partitions)
+
+    last_id = 0
+    async with bind.connect() as conn:
+        max_id = (await conn.execute(text("SELECT coalesce(max(id), 0) FROM files"))).scalar()
+        await conn.rollback()
+    while last_id < max_id:
+        upper = last_id + batch_size
+        await _with_lock_retries(
+            bind,
+            [
+                "LOCK TABLE files IN SHARE MODE",
+                f"INSERT INTO files_partitioned ({column_list}) "
+                f"SELECT {column_list} FROM files WHERE id > {last_id} AND id <= {upper} "
+                f"ON CONFLICT (owner_id, id) DO UPDATE SET {updates}",
+            ],
+        )
+        last_id = upper
+        logger.info("Copied files up to id %s of %s", min(last_id, max_id), max_id)
+        if pause:
+            await asyncio.sleep(pause)
+
+    swap = [
+        "LOCK TABLE files IN ACCESS EXCLUSIVE MODE",
+        "DROP TRIGGER files_partition_sync ON files",
+        "DROP FUNCTION files_partition_sync()",
+        "ALTER TABLE files RENAME TO files_unpartitioned",
+        "ALTER TABLE files_partitioned RENAME TO files",
+        "ALTER SEQUENCE files_id_seq OWNED BY files.id",
+        "ALTER TABLE files_unpartitioned RENAME CONSTRAINT files_pkey "
+        "TO files_unpartitioned_pkey",
+        "ALTER TABLE files RENAME CONSTRAINT files_partitioned_pkey TO files_pkey",
+    ]
+    for name, _ in indexes:
+        swap.append(f"ALTER INDEX {name} RENAME TO {name}_unpartitioned")
+        if name != "ix_files_owner_id_id":
+            swap.append(f"ALTER INDEX {name}_p RENAME TO {name}")
+    for name, _ in outbound_keys:
+        swap += [
+            f"ALTER TABLE files_unpartitioned RENAME CONSTRAINT {name} "
+            f"TO {name}_unpartitioned",
+            f"ALTER TABLE files RENAME CONSTRAINT {name}_p TO {name}",
+        ]
+    validate = []
+    for table, constraint, definition in foreign_keys:
+        swap += [
+            f"ALTER TABLE {table} DROP CONSTRAINT {constraint}",
+            f"ALTER TABLE {table} ADD CONSTRAINT {constraint} "
+            f"{definition} NOT VALID",
+        ]
+        validate.append(f"ALTER TABLE {table} VALIDATE CONSTRAINT {constraint}")
+    await _with_lock_retries(bind, swap)
+    # VALIDATE берет SHARE UPDATE EXCLUSIVE и не блокирует запись
+    for statement in validate:
+        await _with_lock_retries(bind, [statement])
+    logger.info("files is now hash-partitioned by owner_id; old table: files_unpartitioned")
+
+
+async def _main(argv: Optional[List[str]] = None) -> None:
+    from cypher_cloud.database import Base, dispose_engines, get_engine
+    from cypher_cloud import models  # noqa: F401  регистрируем модели в Base
+
+    parser = argparse.ArgumentParser(description="Cypher Cloud schema migrations")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("upgrade", help="создать таблицы и применить миграции")
+    sub.add_parser("status", help="показать примененные и ожидающие миграции")
+    partition = sub.add_parser(
+        "partition-files", help="онлайн-перенос files в HASH (owner_id)"
+    )
+    partition.add_argument("--partitions", type=int, default=16)
+    partition.add_argument("--batch-size", type=int, default=5000)
+    partition.add_argument(
+        "--pause", type=float, default=0.0, help="пауза между пачками, сек"
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "upgrade":
+            async with get_engine().begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+            await run_migrations(get_engine())
+        elif args.command == "status":
+            async with get_engine().connect() as conn:
+                applied = set(await applied_versions(conn))
+                await conn.commit()
+            for migration in MIGRATIONS:
+                mark = "applied" if migration.version in applied else "pending"
+                print(f"{migration.version:>4}  {mark:<8} {migration.description}")
+        elif args.command == "partition-files":
+            await partition_files(
+                get_engine(), args.partitions, args.batch_size, args.pause
+            )
+    finally:
+        await dispose_engines()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    asyncio.run(_main())
@@ -1,8 +1,33 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String
+from sqlalchemy import (
+    DDL,
+    BigInteger,
+    Boolean,
+    Column,
+    DateTime,
+    Float,
+    ForeignKey,
+    ForeignKeyConstraint,
+    Index,
+    Integer,
+    String,
+    event,
+    func,
+    text,
+)
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
 from sqlalchemy.orm import relationship
 
 from cypher_cloud.database import Base
 
+# Расширения для триграммного поиска по имени файла (см. migrations.py);
+# create_all на пустой БД создает индексы до применения миграций
+for _extension in ("pg_trgm", "btree_gin"):
+    event.listen(
+        Base.metadata,
+        "before_create",
+        DDL(f"CREATE EXTENSION IF NOT EXISTS {_extension}"),
+    )
+
 
 class User(Base):
     __tablename__ = "users"
@@ -13,6 +38,11 @@ class User(Base):
     totp_secret = Column(String, nullable=True)
     is_active = Column(Boolean, default=True)
     email_confirmed = Column(Boolean, default=False)
+    dedup_enabled = Column(Boolean, nullable=False, default=False, server_default="false")
+    # Номер последнего события в журнале изменений (см. changes.py) и
+    # последнего удаленного из журнала
+    change_seq = Column(BigInteger, nullable=False, default=0, server_default="0")
+    changes_floor = Column(BigInteger, nullable=False, default=0, server_default="0")
 
     files = relationship("File", back_populates="owner")
     passkeys = relationship("Passkey", back_populates="owner", cascade="all, delete-orphan")
@@ -20,16 +50,399 @@ class User(Base):
 
 class File(Base):
     __tablename__ = "files"
+    # Все горячие запросы фильтруют по владельцу, поэтому индексы начинаются
+    # с owner_id. Уникальный (owner_id, id) — цель для составных внешних ключей,
+    # которая сохраняется и после hash-партиционирования по owner_id.
+    __table_args__ = (
+        Index("ix_files_owner_id_id", "owner_id", "id", unique=True),
+        Index("ix_files_owner_id_filename", "owner_id", "filename"),
+        Index(
+            "ix_files_owner_id_filename_trgm",
+            "owner_id",
+            "filename",
+            postgresql_using="gin",
+            postgresql_ops={"filename": "gin_trgm_ops"},
+        ),
+        # Проверка внешнего ключа при удалении Blob
+        Index(
+            "ix_files_blob_id",
+            "blob_id",
+            postgresql_where=text("blob_id IS NOT NULL"),
+        ),
+        # Живые записи сегмента для компактора
+        Index(
+            "ix_files_segment_id",
+            "segment_id",
+            postgresql_where=text("segment_id IS NOT NULL"),
+        ),
+        # Содержимое папки (folder_id IS NULL — корень)
+        Index("ix_files_owner_id_folder_id", "owner_id", "folder_id"),
+    )
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     owner_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"))
-    filename = Column(String, index=True, nullable=False)
+    filename = Column(String, nullable=False)
     vault_key_path = Column(String, nullable=False)
+    # Пустой storage_path — содержимое хранится в file_versions, а
+    # vault_key_path указывает на ключ чанков файла
     storage_path = Column(String, nullable=False)
+    # Общий шифротекст при дедупликации; storage_path и vault_key_path
+    # тогда копируют значения из Blob
+    blob_id = Column(Integer, ForeignKey("blobs.id"), nullable=True)
+    # Номер текущей версии
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+    # Точный размер текущей версии; NULL — загружен до появления квот
+    size = Column(BigInteger, nullable=True)
+    # Оценка размера по шифротексту для квот, если size неизвестен
+    # (см. quotas.py); клиентам не отдается
+    estimated_size = Column(BigInteger, nullable=True)
+    # Мелкий файл внутри сегмента: storage_path и vault_key_path — сегмента
+    segment_id = Column(Integer, ForeignKey("segments.id"), nullable=True)
+    segment_offset = Column(BigInteger, nullable=True)
+    segment_length = Column(Integer, nullable=True)
+    # Папка; NULL — корень. Перенос папки не меняет строки files
+    folder_id = Column(Integer, ForeignKey("folders.id"), nullable=True)
+    # SHA-256 шифротекста (записи в сегменте) для проверки scrub.py;
+    # NULL — загружен раньше, дайджест заполнит первый проход
+    ciphertext_sha256 = Column(String(64), nullable=True)
+    # Когда текущая версия стала текущей (загрузка, новая версия, откат);
+    # NULL — не менялся с миграции 17. Основа ETag и Last-Modified
+    modified_at = Column(DateTime(timezone=True), nullable=True, server_default=func.now())
 
     owner = relationship("User", back_populates="files")
 
 
+class Folder(Base):
+    """Папка с материализованным путем из id предков: `/1/5/9/` (включая
+    саму папку). Переименование меняет одну строку, перенос — только пути
+    вложенных папок одним UPDATE по префиксу; файлы не затрагиваются."""
+
+    __tablename__ = "folders"
+    __table_args__ = (
+        # Имена уникальны в пределах родителя; корень — отдельный индекс,
+        # т.к. NULL в уникальном индексе не совпадают
+        Index(
+            "ix_folders_owner_id_parent_id_name",
+            "owner_id",
+            "parent_id",
+            "name",
+            unique=True,
+            postgresql_where=text("parent_id IS NOT NULL"),
+        ),
+        Index(
+            "ix_folders_owner_id_root_name",
+            "owner_id",
+            "name",
+            unique=True,
+            postgresql_where=text("parent_id IS NULL"),
+        ),
+        # Поддерево: path LIKE '/1/5/%'
+        Index(
+            "ix_folders_owner_id_path",
+            "owner_id",
+            "path",
+            postgresql_ops={"path": "text_pattern_ops"},
+        ),
+    )
+
+    id = Column(Integer, primary_key=True)
+    owner_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    parent_id = Column(Integer, ForeignKey("folders.id"), nullable=True)
+    name = Column(String, nullable=False)
+    path = Column(String, nullable=False)
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+
+class Blob(Base):
+    """Шифротекст, разделяемый файлами одного владельца с одинаковым содержимым."""
+
+    __tablename__ = "blobs"
+    __table_args__ = (
+        Index("ix_blobs_owner_id_content_hash", "owner_id", "content_hash", unique=True),
+    )
+
+    id = Column(Integer, primary_key=True)
+    owner_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    # HMAC(секрет пользователя, SHA-256 содержимого), см. dedup.py
+    content_hash = Column(String(64), nullable=False)
+    storage_path = Column(String, nullable=False)
+    vault_key_path = Column(String, nullable=False, default="")
+    size = Column(BigInteger, nullable=False)
+    ref_count = Column(Integer, nullable=False, default=1)
+    ciphertext_sha256 = Column(String(64), nullable=True)
+
+
+class Segment(Base):
+    """Append-only файл с мелкими файлами одного владельца. Каждая запись —
+    отдельный токен Fernet на общем ключе сегмента."""
+
+    __tablename__ = "segments"
+    __table_args__ = (
+        Index(
+            "ix_segments_owner_id_open",
+            "owner_id",
+            postgresql_where=text("sealed_at IS NULL"),
+        ),
+    )
+
+    id = Column(Integer, primary_key=True)
+    owner_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    storage_path = Column(String, nullable=False)
+    vault_key_path = Column(String, nullable=False, default="")
+    # Зарезервировано байт (включая записи откаченных загрузок)
+    size = Column(BigInteger, nullable=False, default=0)
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    # Запечатанный сегмент не дописывается, его обрабатывает компактор
+    sealed_at = Column(DateTime(timezone=True), nullable=True)
+    # Прежний файл после компакции: удаляется, когда дочитают текущие загрузки
+    retired_path = Column(String, nullable=True)
+    retired_at = Column(DateTime(timezone=True), nullable=True)
+
+
+class FileVersion(Base):
+    """Версия файла: цельный шифротекст (содержимое до первой новой версии)
+    либо упорядоченный список чанков из file_chunks."""
+
+    __tablename__ = "file_versions"
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ["owner_id", "file_id"], ["files.owner_id", "files.id"], ondelete="CASCADE"
+        ),
+        Index(
+            "ix_file_versions_owner_id_file_id_version",
+            "owner_id",
+            "file_id",
+            "version",
+            unique=True,
+        ),
+        Index(
+            "ix_file_versions_blob_id",
+            "blob_id",
+            postgresql_where=text("blob_id IS NOT NULL"),
+        ),
+        Index(
+            "ix_file_versions_segment_id",
+            "segment_id",
+            postgresql_where=text("segment_id IS NOT NULL"),
+        ),
+    )
+
+    id = Column(Integer, primary_key=True)
+    owner_id = Column(Integer, nullable=False)
+    file_id = Column(Integer, nullable=False)
+    version = Column(Integer, nullable=False)
+    size = Column(BigInteger, nullable=True)  # неизвестен для перенесенного содержимого
+    estimated_size = Column(BigInteger, nullable=True)  # оценка для квот, см. File
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    vault_key_path = Column(String, nullable=False)
+    storage_path = Column(String, nullable=True)
+    blob_id = Column(Integer, ForeignKey("blobs.id"), nullable=True)
+    segment_id = Column(Integer, ForeignKey("segments.id"), nullable=True)
+    segment_offset = Column(BigInteger, nullable=True)
+    segment_length = Column(Integer, nullable=True)
+    chunk_ids = Column(ARRAY(Integer), nullable=True)
+    ciphertext_sha256 = Column(String(64), nullable=True)
+
+
+class FileChunk(Base):
+    """Чанк версий одного файла; общий для всех версий, где он встречается."""
+
+    __tablename__ = "file_chunks"
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ["owner_id", "file_id"], ["files.owner_id", "files.id"], ondelete="CASCADE"
+        ),
+        Index(
+            "ix_file_chunks_owner_id_file_id_content_hash",
+            "owner_id",
+            "file_id",
+            "content_hash",
+            unique=True,
+        ),
+    )
+
+    id = Column(Integer, primary_key=True)
+    owner_id = Column(Integer, nullable=False)
+    file_id = Column(Integer, nullable=False)
+    # HMAC(ключ чанков файла, SHA-256 чанка)
+    content_hash = Column(String(64), nullable=False)
+    storage_path = Column(String, nullable=False)
+    size = Column(Integer, nullable=False)
+    # Сколько раз чанк встречается во всех версиях файла
+    ref_count = Column(Integer, nullable=False, default=1)
+    ciphertext_sha256 = Column(String(64), nullable=True)
+
+
+class ImportJob(Base):
+    """Фоновая распаковка архива в файлы пользователя."""
+
+    __tablename__ = "import_jobs"
+
+    id = Column(String(32), primary_key=True)
+    owner_id = Column(
+        Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True
+    )
+    # queued -> running -> completed | failed
+    status = Column(String, nullable=False, default="queued")
+    format = Column(String, nullable=False)
+    total = Column(Integer, nullable=True)  # для TAR известно только в конце
+    processed = Column(Integer, nullable=False, default=0)
+    succeeded = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    bytes = Column(BigInteger, nullable=False, default=0)
+    errors = Column(JSONB, nullable=False, default=list)  # первые IMPORT_MAX_ERRORS
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+
+
+class FileChange(Base):
+    """Событие журнала изменений; без внешнего ключа на files — событие
+    удаления переживает сам файл. События папок (`folder_*`) без file_id."""
+
+    __tablename__ = "file_changes"
+
+    owner_id = Column(
+        Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True
+    )
+    seq = Column(BigInteger, primary_key=True)
+    # upload | delete | rename | move | version |
+    # folder_create | folder_update | folder_delete
+    kind = Column(String, nullable=False)
+    file_id = Column(Integer, nullable=True)
+    filename = Column(String, nullable=True)  # для папок — имя папки
+    version = Column(Integer, nullable=True)
+    folder_id = Column(Integer, nullable=True)
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+
+class UserUsage(Base):
+    """Счетчики использования хранилища, меняются вместе с файлами."""
+
+    __tablename__ = "user_usage"
+
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    bytes = Column(BigInteger, nullable=False, default=0)
+    objects = Column(Integer, nullable=False, default=0)
+    # NULL — квоты по умолчанию из настроек
+    quota_bytes = Column(BigInteger, nullable=True)
+    quota_objects = Column(Integer, nullable=True)
+
+
+class UsageReservation(Base):
+    """Место, зарезервированное идущей загрузкой."""
+
+    __tablename__ = "usage_reservations"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(
+        Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True
+    )
+    bytes = Column(BigInteger, nullable=False)
+    objects = Column(Integer, nullable=False)
+    expires_at = Column(DateTime(timezone=True), nullable=False)
+
+
+class ShareRevocation(Base):
+    """Deny-list публичных ссылок: одна ссылка (jti) или все ссылки на файл,
+    выданные не позже revoked_at. Строка нужна, пока не истекут сами ссылки."""
+
+    __tablename__ = "share_revocations"
+
+    id = Column(Integer, primary_key=True)
+    owner_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    jti = Column(String(32), nullable=True)
+    file_id = Column(Integer, nullable=True)
+    revoked_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
+
+
+class ScrubProgress(Base):
+    """Позиция проверки целостности по одному виду объектов (см. scrub.py)."""
+
+    __tablename__ = "scrub_progress"
+
+    kind = Column(String, primary_key=True)  # files | file_versions | blobs | file_chunks
+    # Ключ последнего проверенного объекта; (0, 0) — проход не начат
+    last_owner_id = Column(Integer, nullable=False, default=0)
+    last_id = Column(Integer, nullable=False, default=0)
+    pass_started_at = Column(DateTime(timezone=True), nullable=True)
+    pass_finished_at = Column(DateTime(timezone=True), nullable=True)
+    passes = Column(Integer, nullable=False, default=0)
+    # Счетчики текущего прохода
+    checked_objects = Column(BigInteger, nullable=False, default=0)
+    checked_bytes = Column(BigInteger, nullable=False, default=0)
+
+
+class ScrubFinding(Base):
+    """Поврежденный или пропавший шифротекст. Строка удаляется, когда
+    следующая проверка объекта проходит успешно или объект удален."""
+
+    __tablename__ = "scrub_findings"
+    __table_args__ = (
+        Index("ix_scrub_findings_kind_object_id", "kind", "object_id", unique=True),
+    )
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)
+    object_id = Column(Integer, nullable=False)
+    owner_id = Column(Integer, nullable=False)
+    storage_path = Column(String, nullable=False)
+    status = Column(String, nullable=False)  # corrupt | missing
+    detail = Column(String, nullable=True)
+    detected_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    last_seen_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+
+class KeyRotation(Base):
+    """Задание ротации ключей с контрольной точкой (см. rotate.py)."""
+
+    __tablename__ = "key_rotations"
+
+    id = Column(Integer, primary_key=True)
+    # running -> completed; прерванное задание продолжает `rotate resume`
+    status = Column(String, nullable=False, default="running")
+    phase = Column(String, nullable=False)
+    # Последний обработанный ключ текущей фазы
+    cursor = Column(JSONB, nullable=False, default=dict)
+    rotated = Column(Integer, nullable=False, default=0)
+    skipped = Column(Integer, nullable=False, default=0)  # изменились во время ротации
+    failed = Column(Integer, nullable=False, default=0)
+    bytes = Column(BigInteger, nullable=False, default=0)
+    errors = Column(JSONB, nullable=False, default=list)  # первые ROTATION_MAX_ERRORS
+    started_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+
+
+class RetiredObject(Base):
+    """Шифротекст и ключ, которые удаляются по истечении grace-периода:
+    прежние после ротации (их еще могут дочитывать скачивания) и новые,
+    записанные до коммита (если процесс упал, они ни на что не ссылаются)."""
+
+    __tablename__ = "retired_objects"
+
+    id = Column(Integer, primary_key=True)
+    storage_path = Column(String, nullable=True)
+    vault_key_path = Column(String, nullable=True)
+    retired_at = Column(
+        DateTime(timezone=True), nullable=False, server_default=func.now(), index=True
+    )
+
+
+class RateLimitBucket(Base):
+    """Token bucket общего бэкенда лимитера (см. ratelimit.py). Таблица
+    UNLOGGED: после сбоя ведра просто начинаются заново полными."""
+
+    __tablename__ = "rate_limits"
+    __table_args__ = {"prefixes": ["UNLOGGED"]}
+
+    key = Column(String, primary_key=True)  # класс:ip|account:значение
+    tokens = Column(Float, nullable=False)
+    updated_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+
 class Passkey(Base):
     __tablename__ = "passkeys"
 
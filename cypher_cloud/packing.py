@@ -0,0 +1,409 @@
+"""Упаковка мелких файлов в append-only сегменты.
+
+Файл не больше `PACK_MAX_SIZE` не получает собственного файла на диске и
+секрета в Vault: его токен Fernet дописывается в открытый сегмент владельца
+по зарезервированному смещению, а в строке File хранятся (segment_id,
+offset, length). Все записи сегмента шифруются ключом сегмента
+(`segments/{owner_id}/{segment_id}`), который кэшируется в процессе.
+
+Место резервируется отдельной короткой транзакцией, поэтому параллельные
+загрузки не ждут коммита друг друга. Записи откаченных загрузок и удаленных
+файлов остаются мусором внутри сегмента. Переполненный сегмент запечатывается,
+а компактор переписывает запечатанные сегменты с малой долей живых байт:
+копирует живые записи (без расшифровки — ключ не меняется) в новый файл и
+одной транзакцией переставляет смещения. Прежний файл удаляется спустя
+`COMPACT_GRACE_SECONDS`, когда его дочитают уже начатые загрузки.
+
+Запуск компактора вручную:
+
+    python -m cypher_cloud.packing compact
+"""
+
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import List, NamedTuple, Optional, Tuple
+
+from cryptography.fernet import Fernet
+from sqlalchemy import delete, func, text
+from sqlalchemy.future import select
+
+from cypher_cloud.config import settings
+from cypher_cloud.database import async_session, dispose_engines, get_engine
+from cypher_cloud.models import Segment
+from cypher_cloud.profiling import span
+from cypher_cloud.storage import (
+    fsync_directory,
+    new_storage_path,
+    remove_stored,
+    sync_writes,
+)
+from cypher_cloud.vault_client import delete_file_key, fetch_file_key, store_file_key
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_KEY_CACHE_SIZE = 1024
+# Один компактор на все воркеры
+COMPACT_LOCK_KEY = 0x7061636B  # "pack"
+
+_segment_keys: "OrderedDict[str, bytes]" = OrderedDict()
+
+
+class Slot(NamedTuple):
+    segment_id: int
+    storage_path: str
+    vault_key_path: str
+    offset: int
+    length: int
+    ciphertext_sha256: Optional[str] = None
+
+
+def token_length(size: int) -> int:
+    """Длина токена Fernet для открытого текста размера `size`."""
+    # версия + время + IV (25 байт), шифротекст с PKCS7, HMAC (32), затем base64
+    return 4 * ((57 + (size // 16 + 1) * 16 + 2) // 3)
+
+
+async def segment_key(vault_key_path: str) -> bytes:
+    key = _segment_keys.get(vault_key_path)
+    if key is not None:
+        _segment_keys.move_to_end(vault_key_path)
+        return key
+    key = (await fetch_file_key(vault_key_path)).encode()
+    _segment_keys[vault_key_path] = key
+    if len(_segment_keys) > SEGMENT_KEY_CACHE_SIZE:
+        _segment_keys.popitem(last=False)
+    return key
+
+
+async def _new_segment(session, owner_id: int) -> Segment:
+    storage_path = new_storage_path(owner_id, ".seg")
+    with span("io"):
+        os.close(os.open(storage_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+        if settings.STORAGE_DURABILITY == "always":
+            fsync_directory(str(storage_path.parent))
+    try:
+        segment = Segment(owner_id=owner_id, storage_path=str(storage_path), size=0)
+        session.add(segment)
+        with span("db"):
+            await session.flush()
+        segment.vault_key_path = f"segments/{owner_id}/{segment.id}"
+        key = Fernet.generate_key()
+        await store_file_key(segment.vault_key_path, key.decode())
+    except BaseException:
+        remove_stored([str(storage_path)])
+        raise
+    _segment_keys[segment.vault_key_path] = key
+    return segment
+
+
+async def _reserve(owner_id: int, length: int) -> Slot:
+    """Резервируем место в открытом сегменте владельца."""
+    async with async_session() as session:
+        async with session.begin():
+            with span("db"):
+                result = await session.execute(
+                    select(Segment)
+                    .where(Segment.owner_id == owner_id, Segment.sealed_at.is_(None))
+                    .order_by(Segment.id.desc())
+                    .limit(1)
+                    # NO KEY UPDATE не конфликтует с FOR KEY SHARE, которую
+                    # держат незакоммиченные вставки File с этим segment_id
+                    .with_for_update(key_share=True)
+                )
+                segment = result.scalars().first()
+            if (
+                segment is not None
+                and segment.size > 0
+                and segment.size + length > settings.SEGMENT_MAX_SIZE
+            ):
+                segment.sealed_at = func.now()
+                segment = None
+            if segment is None:
+                segment = await _new_segment(session, owner_id)
+            offset = segment.size
+            segment.size = offset + length
+            return Slot(
+                segment.id, segment.storage_path, segment.vault_key_path, offset, length
+            )
+
+
+def _pwrite(path: str, data: bytes, offset: int) -> None:
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view, offset = view[written:], offset + written
+        if settings.STORAGE_DURABILITY == "always":
+            os.fdatasync(fd)
+    finally:
+        os.close(fd)
+
+
+async def pack(owner_id: int, content: bytes, durable: bool = True) -> Slot:
+    """Шифруем мелкий файл и дописываем его в сегмент владельца."""
+    slot = await _reserve(owner_id, token_length(len(content)))
+    key = await segment_key(slot.vault_key_path)
+    with span("crypto"):
+        token = Fernet(key).encrypt(content)
+        digest = hashlib.sha256(token).hexdigest()
+    with span("io"):
+        await asyncio.to_thread(_pwrite, slot.storage_path, token, slot.offset)
+    if durable:
+        await sync_writes()
+    return slot._replace(ciphertext_sha256=digest)
+
+
+# --- Компактор ---------------------------------------------------------------
+
+_LIVE_ENTRIES = (
+    "SELECT DISTINCT segment_offset, segment_length FROM ("
+    "SELECT segment_offset, segment_length FROM files WHERE segment_id = :id "
+    "UNION ALL "
+    "SELECT segment_offset, segment_length FROM file_versions WHERE segment_id = :id"
+    ") e ORDER BY segment_offset"
+)
+
+_CANDIDATES = (
+    "SELECT s.id FROM segments s "
+    "WHERE s.sealed_at < :sealed_before AND s.retired_path IS NULL "
+    "AND coalesce(("
+    "SELECT sum(segment_length) FROM files WHERE segment_id = s.id), 0) "
+    "+ coalesce(("
+    "SELECT sum(segment_length) FROM file_versions WHERE segment_id = s.id), 0) "
+    "< s.size * CAST(:ratio AS double precision) "
+    "ORDER BY s.id"
+)
+
+
+def _copy_entries(
+    source: str, target: str, entries: List[Tuple[int, int]]
+) -> List[int]:
+    """Копируем записи подряд в новый файл; возвращаем новые смещения."""
+    offsets = []
+    position = 0
+    with open(source, "rb") as src, open(target, "xb") as dst:
+        os.chmod(target, 0o644)
+        for offset, length in entries:
+            src.seek(offset)
+            data = src.read(length)
+            if len(data) != length:
+                raise RuntimeError(f"Segment {source} is truncated at {offset}")
+            dst.write(data)
+            offsets.append(position)
+            position += length
+        dst.flush()
+        os.fsync(dst.fileno())
+    return offsets
+
+
+def reencrypt_entries(
+    source: str,
+    target: str,
+    entries: List[Tuple[int, int]],
+    old_key: bytes,
+    new_key: bytes,
+) -> Tuple[List[int], List[str]]:
+    """Как `_copy_entries`, но каждая запись перешифровывается новым ключом
+    (ротация, см. rotate.py); длина токена при этом не меняется. Возвращаем
+    новые смещения и SHA-256 записей."""
+    old_fernet, new_fernet = Fernet(old_key), Fernet(new_key)
+    offsets, digests = [], []
+    position = 0
+    with open(source, "rb") as src, open(target, "xb") as dst:
+        os.chmod(target, 0o644)
+        for offset, length in entries:
+            src.seek(offset)
+            data = src.read(length)
+            if len(data) != length:
+                raise RuntimeError(f"Segment {source} is truncated at {offset}")
+            token = new_fernet.encrypt(old_fernet.decrypt(data))
+            dst.write(token)
+            offsets.append(position)
+            digests.append(hashlib.sha256(token).hexdigest())
+            position += len(token)
+        dst.flush()
+        os.fsync(dst.fileno())
+    return offsets, digests
+
+
+async def live_entries(segment_id: int) -> List[Tuple[int, int]]:
+    """Смещения и длины записей, на которые ссылаются файлы и версии."""
+    async with async_session() as session:
+        result = await session.execute(text(_LIVE_ENTRIES), {"id": segment_id})
+        return [(row[0], row[1]) for row in result]
+
+
+async def remap_entries(
+    session,
+    segment_id: int,
+    path: str,
+    old_offsets: List[int],
+    new_offsets: List[int],
+    vault_key_path: Optional[str] = None,
+    digests: Optional[List[str]] = None,
+) -> None:
+    """Перевешиваем записи сегмента на новый файл (и ключ). Вызывать под
+    блокировкой строки сегмента."""
+    assignments = "segment_offset = m.new, storage_path = :path"
+    params = {"id": segment_id, "path": path, "old": old_offsets, "new": new_offsets}
+    if vault_key_path is not None:
+        assignments += ", vault_key_path = :key"
+        params["key"] = vault_key_path
+    if digests is not None:
+        assignments += ", ciphertext_sha256 = m.digest"
+    params["digests"] = digests or [None] * len(old_offsets)
+    # files раньше file_versions: перенос файла в историю версий,
+    # закоммиченный во время первого UPDATE, увидит второй
+    for table in ("files", "file_versions"):
+        await session.execute(
+            text(
+                f"UPDATE {table} t SET {assignments} "
+                "FROM unnest(CAST(:old AS bigint[]), CAST(:new AS bigint[]), "
+                "CAST(:digests AS varchar[])) AS m(old, new, digest) "
+                "WHERE t.segment_id = :id AND t.segment_offset = m.old"
+            ),
+            params,
+        )
+
+
+async def _drop_segment(segment: Segment) -> None:
+    async with async_session() as session:
+        async with session.begin():
+            await session.execute(delete(Segment).where(Segment.id == segment.id))
+    await delete_file_key(segment.vault_key_path)
+    _segment_keys.pop(segment.vault_key_path, None)
+    remove_stored([segment.storage_path])
+
+
+async def compact_segment(segment: Segment) -> int:
+    """Переписываем сегмент без мертвых записей; возвращаем освобожденные байты."""
+    entries = await live_entries(segment.id)
+    if not entries:
+        await _drop_segment(segment)
+        return segment.size
+
+    target = str(new_storage_path(segment.owner_id, ".seg"))
+    offsets = await asyncio.to_thread(
+        _copy_entries, segment.storage_path, target, entries
+    )
+    try:
+        async with async_session() as session:
+            async with session.begin():
+                await session.execute(
+                    select(Segment.id).where(Segment.id == segment.id).with_for_update()
+                )
+                await remap_entries(
+                    session,
+                    segment.id,
+                    target,
+                    [offset for offset, _ in entries],
+                    offsets,
+                )
+                await session.execute(
+                    text(
+                        "UPDATE segments SET storage_path = :path, size = :size, "
+                        "retired_path = storage_path, retired_at = now() "
+                        "WHERE id = :id"
+                    ),
+                    {
+                        "id": segment.id,
+                        "path": target,
+                        "size": sum(length for _, length in entries),
+                    },
+                )
+    except BaseException:
+        remove_stored([target])
+        raise
+    return segment.size - sum(length for _, length in entries)
+
+
+async def _remove_retired() -> None:
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=settings.COMPACT_GRACE_SECONDS)
+    async with async_session() as session:
+        async with session.begin():
+            result = await session.execute(
+                select(Segment).where(Segment.retired_at < cutoff).with_for_update()
+            )
+            retired = list(result.scalars().all())
+            for segment in retired:
+                remove_stored([segment.retired_path])
+                segment.retired_path = None
+                segment.retired_at = None
+
+
+async def compact(limit: Optional[int] = None) -> dict:
+    """Один проход компактора. Если проход уже идет в другом воркере — пропускаем."""
+    stats = {"segments": 0, "reclaimed_bytes": 0, "skipped": False}
+    async with get_engine().connect() as lock_conn:
+        locked = await lock_conn.scalar(
+            text("SELECT pg_try_advisory_lock(:key)"), {"key": COMPACT_LOCK_KEY}
+        )
+        await lock_conn.commit()
+        if not locked:
+            stats["skipped"] = True
+            return stats
+        try:
+            await _remove_retired()
+            cutoff = datetime.now(timezone.utc) - timedelta(
+                seconds=settings.COMPACT_GRACE_SECONDS
+            )
+            async with async_session() as session:
+                result = await session.execute(
+                    text(_CANDIDATES),
+                    {"sealed_before": cutoff, "ratio": settings.COMPACT_MIN_LIVE_RATIO},
+                )
+                candidates = [row[0] for row in result]
+            for segment_id in candidates[:limit]:
+                async with async_session() as session:
+                    segment = await session.get(Segment, segment_id)
+                if segment is None:
+                    continue
+                try:
+                    stats["reclaimed_bytes"] += await compact_segment(segment)
+                    stats["segments"] += 1
+                except Exception:  # noqa: BLE001
+                    logger.exception("Failed to compact segment %s", segment_id)
+        finally:
+            await lock_conn.execute(
+                text("SELECT pg_advisory_unlock(:key)"), {"key": COMPACT_LOCK_KEY}
+            )
+            await lock_conn.commit()
+    logger.info(
+        "Compacted %s segments, reclaimed %s bytes",
+        stats["segments"],
+        stats["reclaimed_bytes"],
+    )
+    return stats
+
+
+async def compaction_loop() -> None:
+    """Фоновый компактор, запускается при старте приложения."""
+    while True:
+        await asyncio.sleep(settings.COMPACT_INTERVAL_SECONDS)
+        try:
+            await compact()
+        except Exception:  # noqa: BLE001
+            logger.exception("Segment compaction failed")
+
+
+async def _main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Cypher Cloud segment compactor")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run = sub.add_parser("compact", help="один проход компактора")
+    run.add_argument("--limit", type=int, default=None, help="не больше N сегментов")
+    args = parser.parse_args(argv)
+    try:
+        print(await compact(args.limit))
+    finally:
+        await dispose_engines()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    asyncio.run(_main())
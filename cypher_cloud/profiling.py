@@ -0,0 +1,256 @@
+"""Server-Timing для отдельных запросов и выборочное профилирование.
+
+`span("db")` замеряет участок кода и складывает длительность в таймер
+текущего запроса; `ServerTimingMiddleware` отдает накопленные к началу ответа
+значения в заголовке `Server-Timing` и, если включено, сохраняет статистический профиль
+(folded stacks, совместимы с flamegraph.pl и speedscope) для каждого N-го
+запроса или для запросов дольше порога.
+"""
+
+import asyncio
+import contextvars
+import itertools
+import logging
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Deque, Dict, Iterator, Optional, Sequence, Tuple
+
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from cypher_cloud.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class ServerTiming:
+    """Суммарное время по участкам (auth, db, vault, crypto, io) за один запрос."""
+
+    __slots__ = ("durations",)
+
+    def __init__(self) -> None:
+        self.durations: Dict[str, float] = {}
+
+    def add(self, name: str, seconds: float) -> None:
+        self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+    def header_value(self, total: float) -> str:
+        metrics = [
+            f"{name};dur={seconds * 1000:.1f}"
+            for name, seconds in self.durations.items()
+        ]
+        metrics.append(f"total;dur={total * 1000:.1f}")
+        return ", ".join(metrics)
+
+
+_current_timing: contextvars.ContextVar[Optional[ServerTiming]] = (
+    contextvars.ContextVar("server_timing", default=None)
+)
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """Замеряем участок запроса; вне запроса (или если выключено) — no-op."""
+    timing = _current_timing.get()
+    if timing is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing.add(name, time.perf_counter() - start)
+
+
+class StackSampler:
+    """Фоновый поток, который с интервалом снимает стеки всех потоков процесса.
+
+    Снимки лежат в кольцевом буфере, поэтому профиль медленного запроса можно
+    собрать уже после его завершения — по временному окну запроса. В окно
+    попадает всё, что процесс делал в это время, включая соседние запросы.
+    """
+
+    def __init__(self, interval: float, window: float = 60.0) -> None:
+        self.interval = interval
+        self._samples: Deque[Tuple[float, Tuple[str, ...]]] = deque(
+            maxlen=max(1, int(window / interval))
+        )
+        self._folded: Dict[tuple, str] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="profiling-sampler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def _fold(self, thread_name: str, frame) -> str:
+        codes = []
+        while frame is not None:
+            codes.append(frame.f_code)
+            frame = frame.f_back
+        key = (thread_name, *codes)
+        folded = self._folded.get(key)
+        if folded is None:
+            names = [
+                f"{code.co_name} ({Path(code.co_filename).name})"
+                for code in reversed(codes)
+            ]
+            folded = ";".join([thread_name, *names])
+            if len(self._folded) >= 50_000:
+                self._folded.clear()
+            self._folded[key] = folded
+        return folded
+
+    def _run(self) -> None:
+        own_ident = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            stacks = tuple(
+                self._fold(names.get(ident, str(ident)), frame)
+                for ident, frame in sys._current_frames().items()
+                if ident != own_ident
+            )
+            with self._lock:
+                self._samples.append((time.perf_counter(), stacks))
+
+    def collect(self, start: float, end: float) -> Counter:
+        with self._lock:
+            window = [stacks for ts, stacks in self._samples if start <= ts <= end]
+        counts: Counter = Counter()
+        for stacks in window:
+            counts.update(stacks)
+        return counts
+
+
+class RequestProfiler:
+    """Решает, какие запросы сохранять, и пишет профили в ротируемый каталог."""
+
+    def __init__(
+        self,
+        directory: str,
+        sample_rate: int,
+        slow_ms: int,
+        interval_ms: int,
+        keep: int,
+    ) -> None:
+        self.directory = Path(directory)
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_ms / 1000 if slow_ms > 0 else None
+        self.keep = keep
+        self.sampler = StackSampler(interval_ms / 1000)
+        self._counter = itertools.count(1)
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0 or self.slow_seconds is not None
+
+    def is_sampled(self) -> bool:
+        return self.sample_rate > 0 and next(self._counter) % self.sample_rate == 0
+
+    def should_keep(self, sampled: bool, duration: float) -> bool:
+        return sampled or (
+            self.slow_seconds is not None and duration >= self.slow_seconds
+        )
+
+    async def save(self, method: str, path: str, start: float, end: float) -> None:
+        counts = self.sampler.collect(start, end)
+        if not counts:
+            return
+        slug = path.strip("/").replace("/", "_") or "root"
+        name = f"{time.time_ns()}-{method}-{slug}-{int((end - start) * 1000)}ms.folded"
+        await asyncio.to_thread(self._write, name, counts)
+
+    def _write(self, name: str, counts: Counter) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        lines = [f"{stack} {count}\n" for stack, count in counts.most_common()]
+        (self.directory / name).write_text("".join(lines), encoding="utf-8")
+
+        profiles = sorted(self.directory.glob("*.folded"))
+        for stale in profiles[: max(0, len(profiles) - self.keep)]:
+            try:
+                stale.unlink()
+            except OSError:
+                pass
+
+
+class ServerTimingMiddleware:
+    """ASGI-middleware: Server-Timing и профилирование для роутеров с префиксами."""
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        prefixes: Sequence[str] = ("/auth", "/files"),
+        emit_header: bool = True,
+        profiler: Optional[RequestProfiler] = None,
+    ) -> None:
+        self.app = app
+        self.prefixes = tuple(prefixes)
+        self.emit_header = emit_header
+        self.profiler = profiler if profiler is not None and profiler.enabled else None
+        if self.profiler is not None:
+            self.profiler.sampler.start()
+
+    def _route_path(self, scope: Scope) -> str:
+        path = scope["path"]
+        root_path = scope.get("root_path", "")
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path) :]
+        return path
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not (self.emit_header or self.profiler):
+            await self.app(scope, receive, send)
+            return
+        path = self._route_path(scope)
+        if not path.startswith(self.prefixes):
+            await self.app(scope, receive, send)
+            return
+
+        timing = ServerTiming()
+        token = _current_timing.set(timing)
+        sampled = self.profiler.is_sampled() if self.profiler else False
+        start = time.perf_counter()
+
+        # Заголовок уходит с началом ответа: в нем только работа до первого
+        # байта тела, участки потоковой отдачи (io, crypto) сюда не попадают
+        async def send_with_timing(message: Message) -> None:
+            if self.emit_header and message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                headers.append(
+                    "Server-Timing", timing.header_value(time.perf_counter() - start)
+                )
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current_timing.reset(token)
+            if self.profiler is not None:
+                end = time.perf_counter()
+                if self.profiler.should_keep(sampled, end - start):
+                    try:
+                        await self.profiler.save(scope["method"], path, start, end)
+                    except OSError as exc:
+                        logger.warning("Failed to write request profile: %s", exc)
+
+
+def build_profiler() -> RequestProfiler:
+    return RequestProfiler(
+        directory=settings.PROFILE_DIR,
+        sample_rate=settings.PROFILE_SAMPLE_RATE,
+        slow_ms=settings.PROFILE_SLOW_MS,
+        interval_ms=settings.PROFILE_INTERVAL_MS,
+        keep=settings.PROFILE_KEEP,
+    )
@@ -0,0 +1,438 @@
+"""Квоты пользователей: байты и число файлов.
+
+Использование хранится в строке `user_usage` и меняется в той же
+транзакции, что и загрузка или удаление, поэтому проверка квоты — O(1), без
+подсчета по files. Байты логические: размеры всех хранимых версий, без учета
+дедупликации и общих чанков.
+
+Загрузка сначала резервирует место короткой отдельной транзакцией
+(`reserve`): под блокировкой строки использования проверяется, что
+использованное + активные резервы + запрос укладываются в квоту. Сама
+загрузка в своей транзакции переносит резерв в использование
+(`apply_usage`). Параллельные загрузки не могут вместе превысить квоту, а
+строка использования блокируется только на время коротких транзакций, а не
+на время шифрования. Резерв упавшего процесса истекает через
+`QUOTA_RESERVATION_SECONDS`.
+
+Пересчет расхождений (фоново раз в `QUOTA_RECOUNT_INTERVAL_SECONDS` или
+вручную):
+
+    python -m cypher_cloud.quotas recount [--user ID]
+    python -m cypher_cloud.quotas set --user ID --bytes N --objects N
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import List, NamedTuple, Optional, Sequence
+
+from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy import delete, func, text, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from cypher_cloud.auth import get_current_user
+from cypher_cloud.config import settings
+from cypher_cloud.database import async_session, dispose_engines, get_engine
+from cypher_cloud.models import Blob
+from cypher_cloud.models import File as FileModel
+from cypher_cloud.models import FileVersion, UsageReservation, User, UserUsage
+from cypher_cloud.profiling import span
+from cypher_cloud.schemas import StorageUsage
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+# Один пересчет на все воркеры
+RECOUNT_LOCK_KEY = 0x71756F74  # "quot"
+
+
+class Reservation(NamedTuple):
+    id: int
+    bytes: int
+    objects: int
+
+
+def _limits(usage: UserUsage):
+    quota_bytes = usage.quota_bytes
+    quota_objects = usage.quota_objects
+    return (
+        settings.QUOTA_BYTES if quota_bytes is None else quota_bytes,
+        settings.QUOTA_OBJECTS if quota_objects is None else quota_objects,
+    )
+
+
+# --- Фактическое использование -----------------------------------------------
+
+
+def fernet_plaintext_size(token_length: int) -> int:
+    """Оценка сверху размера открытого текста по длине токена Fernet
+    (точность — блок AES, 16 байт)."""
+    # Токен: base64(57 байт заголовка и HMAC + шифротекст из k блоков)
+    blocks = max((token_length * 3 // 4 - 57) // 16, 1)
+    return blocks * 16 - 1
+
+
+def _estimate_size(
+    storage_path: Optional[str],
+    blob_size: Optional[int],
+    segment_length: Optional[int],
+) -> int:
+    if blob_size is not None:
+        return blob_size
+    if segment_length is not None:
+        return fernet_plaintext_size(segment_length)
+    try:
+        return fernet_plaintext_size(os.stat(storage_path).st_size)
+    except (OSError, TypeError):
+        return 0
+
+
+def billed_size(row) -> int:
+    """Байты квоты строки files или file_versions: точный размер, а если он
+    неизвестен — оценка."""
+    if row.size is not None:
+        return row.size
+    return row.estimated_size or 0
+
+
+async def _backfill_sizes(db: AsyncSession, owner_id: int) -> None:
+    """Оценки размеров содержимого, загруженного до появления квот. Они
+    пишутся в estimated_size: size отдается клиентам и должен быть точным."""
+    for model in (FileModel, FileVersion):
+        result = await db.execute(
+            select(
+                model.id,
+                model.storage_path,
+                Blob.size,
+                model.segment_length,
+            )
+            .outerjoin(Blob, Blob.id == model.blob_id)
+            .where(
+                model.owner_id == owner_id,
+                model.size.is_(None),
+                model.estimated_size.is_(None),
+                model.storage_path.is_not(None),
+                model.storage_path != "",
+            )
+        )
+        rows = result.all()
+        if not rows:
+            continue
+        sizes = await asyncio.to_thread(
+            lambda: [_estimate_size(row[1], row[2], row[3]) for row in rows]
+        )
+        await db.execute(
+            text(
+                # Размер Blob точный — его можно записать в size
+                f"UPDATE {model.__tablename__} t "
+                "SET size = CASE WHEN d.exact THEN d.size END, "
+                "estimated_size = CASE WHEN d.exact THEN NULL ELSE d.size END "
+                "FROM unnest(CAST(:ids AS integer[]), CAST(:sizes AS bigint[]), "
+                "CAST(:exact AS boolean[])) AS d(id, size, exact) WHERE t.id = d.id"
+            ),
+            {
+                "ids": [row[0] for row in rows],
+                "sizes": sizes,
+                "exact": [row[2] is not None for row in rows],
+            },
+        )
+    # Размер текущей версии у версионированных файлов
+    await db.execute(
+        text(
+            "UPDATE files f SET size = v.size FROM file_versions v "
+            "WHERE f.owner_id = :owner AND f.size IS NULL AND f.storage_path = '' "
+            "AND v.owner_id = f.owner_id AND v.file_id = f.id AND v.version = f.version"
+        ),
+        {"owner": owner_id},
+    )
+
+
+_ACTUAL_USAGE = (
+    "SELECT "
+    "coalesce((SELECT sum(coalesce(size, estimated_size)) FROM files "
+    "WHERE owner_id = :owner AND storage_path <> ''), 0) "
+    "+ coalesce((SELECT sum(coalesce(size, estimated_size)) FROM file_versions "
+    "WHERE owner_id = :owner), 0), "
+    "(SELECT count(*) FROM files WHERE owner_id = :owner)"
+)
+
+
+async def stored_bytes(db: AsyncSession, db_file: FileModel) -> int:
+    """Сколько байт квоты занимает файл со всеми версиями."""
+    if db_file.storage_path:
+        return billed_size(db_file)
+    with span("db"):
+        return await db.scalar(
+            select(
+                func.coalesce(
+                    func.sum(
+                        func.coalesce(FileVersion.size, FileVersion.estimated_size)
+                    ),
+                    0,
+                )
+            ).where(
+                FileVersion.owner_id == db_file.owner_id,
+                FileVersion.file_id == db_file.id,
+            )
+        )
+
+
+# --- Строка использования ----------------------------------------------------
+
+
+async def _lock_usage(db: AsyncSession, owner_id: int) -> UserUsage:
+    """Строка использования под FOR UPDATE; при первом обращении считаем
+    использование по файлам (один раз на пользователя)."""
+    query = select(UserUsage).where(UserUsage.user_id == owner_id).with_for_update()
+    with span("db"):
+        usage = (await db.execute(query)).scalars().first()
+        if usage is None:
+            await db.execute(
+                text(
+                    "INSERT INTO user_usage (user_id, bytes, objects) "
+                    f"SELECT :owner, u.bytes, u.objects FROM ({_ACTUAL_USAGE}) "
+                    "AS u(bytes, objects) ON CONFLICT (user_id) DO NOTHING"
+                ),
+                {"owner": owner_id},
+            )
+            usage = (await db.execute(query)).scalars().one()
+    return usage
+
+
+async def _read_usage(db: AsyncSession, owner_id: int) -> UserUsage:
+    """Строка использования без блокировки: чтение не ждет загрузок этого
+    пользователя. Блокируем только первое обращение, когда строку создаем."""
+    query = select(UserUsage).where(UserUsage.user_id == owner_id)
+    with span("db"):
+        usage = (await db.execute(query)).scalars().first()
+    if usage is None:
+        usage = await _lock_usage(db, owner_id)
+    return usage
+
+
+async def reserve(owner_id: int, bytes_: int, objects: int) -> Reservation:
+    """Резервируем место под загрузку или 413, если квота будет превышена.
+
+    Резерв идет в своей короткой транзакции на отдельном соединении, поэтому
+    вызывающий не должен в этот момент держать соединение с блокировками:
+    резервируем до первого обращения запроса к БД."""
+    async with async_session() as db:
+        async with db.begin():
+            usage = await _lock_usage(db, owner_id)
+            with span("db"):
+                result = await db.execute(
+                    select(
+                        func.coalesce(func.sum(UsageReservation.bytes), 0),
+                        func.coalesce(func.sum(UsageReservation.objects), 0),
+                    ).where(
+                        UsageReservation.user_id == owner_id,
+                        UsageReservation.expires_at > func.now(),
+                    )
+                )
+                reserved_bytes, reserved_objects = result.one()
+            quota_bytes, quota_objects = _limits(usage)
+            if usage.bytes + reserved_bytes + bytes_ > quota_bytes:
+                raise HTTPException(
+                    status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                    detail="Превышена квота хранилища",
+                )
+            if usage.objects + reserved_objects + objects > quota_objects:
+                raise HTTPException(
+                    status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                    detail="Превышена квота на число файлов",
+                )
+            reservation = UsageReservation(
+                user_id=owner_id,
+                bytes=bytes_,
+                objects=objects,
+                expires_at=datetime.now(timezone.utc)
+                + timedelta(seconds=settings.QUOTA_RESERVATION_SECONDS),
+            )
+            db.add(reservation)
+            with span("db"):
+                await db.flush()
+            return Reservation(reservation.id, bytes_, objects)
+
+
+async def release(reservations: Sequence[Reservation]) -> None:
+    """Снимаем резервы несостоявшейся загрузки (идемпотентно)."""
+    if not reservations:
+        return
+    async with async_session() as db:
+        async with db.begin():
+            with span("db"):
+                await db.execute(
+                    delete(UsageReservation).where(
+                        UsageReservation.id.in_([r.id for r in reservations])
+                    )
+                )
+
+
+async def apply_usage(
+    db: AsyncSession,
+    owner_id: int,
+    bytes_: int,
+    objects: int,
+    reservations: Sequence[Reservation] = (),
+) -> None:
+    """Меняем использование в транзакции вызывающего и гасим резервы;
+    вызывать непосредственно перед коммитом."""
+    if reservations:
+        with span("db"):
+            await db.execute(
+                delete(UsageReservation).where(
+                    UsageReservation.id.in_([r.id for r in reservations])
+                )
+            )
+    if not bytes_ and not objects:
+        return
+    with span("db"):
+        result = await db.execute(
+            update(UserUsage)
+            .where(UserUsage.user_id == owner_id)
+            .values(
+                bytes=func.greatest(UserUsage.bytes + bytes_, 0),
+                objects=func.greatest(UserUsage.objects + objects, 0),
+            )
+        )
+    if result.rowcount == 0:
+        # Строки еще нет: создаем ее сразу с учетом уже записанных файлов
+        await _lock_usage(db, owner_id)
+
+
+# --- Пересчет ----------------------------------------------------------------
+
+
+async def recount_user(owner_id: int) -> Optional[tuple]:
+    """Сверяем счетчики с files/file_versions; возвращаем (было, стало),
+    если было расхождение."""
+    async with async_session() as db:
+        async with db.begin():
+            usage = await _lock_usage(db, owner_id)
+            with span("db"):
+                await _backfill_sizes(db, owner_id)
+                result = await db.execute(text(_ACTUAL_USAGE), {"owner": owner_id})
+                actual_bytes, actual_objects = result.one()
+                actual = (int(actual_bytes), actual_objects)
+            stored = (usage.bytes, usage.objects)
+            if stored == actual:
+                return None
+            usage.bytes, usage.objects = actual
+            return stored, actual
+
+
+async def recount(owner_id: Optional[int] = None) -> dict:
+    """Проход пересчета по всем пользователям (или одному)."""
+    stats = {"users": 0, "corrected": 0, "skipped": False}
+    async with get_engine().connect() as lock_conn:
+        locked = await lock_conn.scalar(
+            text("SELECT pg_try_advisory_lock(:key)"), {"key": RECOUNT_LOCK_KEY}
+        )
+        await lock_conn.commit()
+        if not locked:
+            stats["skipped"] = True
+            return stats
+        try:
+            async with async_session() as db:
+                await db.execute(
+                    delete(UsageReservation).where(
+                        UsageReservation.expires_at < func.now()
+                    )
+                )
+                await db.commit()
+                if owner_id is not None:
+                    owner_ids = [owner_id]
+                else:
+                    owner_ids = list((await db.execute(select(User.id))).scalars())
+            for user_id in owner_ids:
+                stats["users"] += 1
+                try:
+                    drift = await recount_user(user_id)
+                except Exception:  # noqa: BLE001
+                    logger.exception("Failed to recount usage of user %s", user_id)
+                    continue
+                if drift is not None:
+                    stats["corrected"] += 1
+                    logger.warning(
+                        "Usage of user %s drifted: %s -> %s", user_id, *drift
+                    )
+        finally:
+            await lock_conn.execute(
+                text("SELECT pg_advisory_unlock(:key)"), {"key": RECOUNT_LOCK_KEY}
+            )
+            await lock_conn.commit()
+    return stats
+
+
+async def recount_loop() -> None:
+    """Фоновый пересчет, запускается при старте приложения."""
+    while True:
+        await asyncio.sleep(settings.QUOTA_RECOUNT_INTERVAL_SECONDS)
+        try:
+            await recount()
+        except Exception:  # noqa: BLE001
+            logger.exception("Usage recount failed")
+
+
+# --- Эндпоинт ----------------------------------------------------------------
+
+
+@router.get("/usage", response_model=StorageUsage)
+async def get_usage(user: User = Depends(get_current_user)):
+    async with async_session() as db:
+        async with db.begin():
+            usage = await _read_usage(db, user.id)
+            with span("db"):
+                result = await db.execute(
+                    select(func.coalesce(func.sum(UsageReservation.bytes), 0)).where(
+                        UsageReservation.user_id == user.id,
+                        UsageReservation.expires_at > func.now(),
+                    )
+                )
+                reserved = result.scalar_one()
+    quota_bytes, quota_objects = _limits(usage)
+    return StorageUsage(
+        bytes=usage.bytes,
+        objects=usage.objects,
+        reserved_bytes=reserved,
+        quota_bytes=quota_bytes,
+        quota_objects=quota_objects,
+    )
+
+
+async def _set_quota(
+    owner_id: int, quota_bytes: Optional[int], quota_objects: Optional[int]
+) -> None:
+    async with async_session() as db:
+        async with db.begin():
+            usage = await _lock_usage(db, owner_id)
+            usage.quota_bytes = quota_bytes
+            usage.quota_objects = quota_objects
+
+
+async def _main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Cypher Cloud storage quotas")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run = sub.add_parser("recount", help="сверить счетчики использования")
+    run.add_argument("--user", type=int, default=None)
+    quota = sub.add_parser("set", help="квота пользователя (без значения — по умолчанию)")
+    quota.add_argument("--user", type=int, required=True)
+    quota.add_argument("--bytes", type=int, default=None)
+    quota.add_argument("--objects", type=int, default=None)
+    args = parser.parse_args(argv)
+    try:
+        if args.command == "recount":
+            print(await recount(args.user))
+        else:
+            await _set_quota(args.user, args.bytes, args.objects)
+    finally:
+        await dispose_engines()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    asyncio.run(_main())
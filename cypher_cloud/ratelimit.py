@@ -0,0 +1,216 @@
+"""Ограничение частоты дорогих запросов: token bucket по IP и аккаунту.
+
+У каждого класса маршрутов (`login`, `register`, `mail`, `passkey`,
+`transfer`) свой лимит `RATE_LIMIT_<КЛАСС>_PER_MINUTE`: ведро вмещает столько
+запросов и наполняется с той же скоростью за минуту (0 — без лимита).
+Эндпоинт вызывает `enforce` до bcrypt, SMTP или проверки WebAuthn; запрос
+должен пройти и ведро своего IP, и ведро аккаунта (email или id
+пользователя). Иначе — 429 с `Retry-After`.
+
+Ведра хранятся в памяти процесса (`RATE_LIMIT_BACKEND=memory`, у каждого
+воркера свои) или в UNLOGGED-таблице `rate_limits` (`postgres`, общие для
+всех воркеров; одна короткая транзакция на проверку). Если Postgres
+недоступен, запрос пропускается.
+"""
+
+import hashlib
+import logging
+import math
+import time
+from collections import Counter, OrderedDict
+from typing import NamedTuple, Optional, Tuple
+
+from fastapi import HTTPException, Request, status
+from sqlalchemy import text
+
+from cypher_cloud import metrics
+from cypher_cloud.config import settings
+from cypher_cloud.database import async_session
+from cypher_cloud.profiling import span
+
+logger = logging.getLogger(__name__)
+
+# Полное ведро ничем не отличается от отсутствующего: строки, не
+# тронутые дольше минуты наполнения (с запасом), удаляются
+BUCKET_IDLE_SECONDS = 600
+
+# (класс, результат) -> число запросов;
+# результат: allowed | limited_ip | limited_account
+_decisions: Counter = Counter()
+
+
+class Limit(NamedTuple):
+    capacity: float
+    rate: float  # токенов в секунду
+
+
+def get_limit(route_class: str) -> Optional[Limit]:
+    per_minute = getattr(settings, f"RATE_LIMIT_{route_class.upper()}_PER_MINUTE")
+    if per_minute <= 0:
+        return None
+    return Limit(per_minute, per_minute / 60)
+
+
+class MemoryBackend:
+    """Ведра процесса; самые давние вытесняются после `max_keys`."""
+
+    def __init__(self, max_keys: int) -> None:
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    async def take(self, key: str, limit: Limit) -> float:
+        """Берем токен; 0 — разрешено, иначе через сколько секунд повторить."""
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (limit.capacity, now))
+        tokens = min(limit.capacity, tokens + (now - updated) * limit.rate)
+        retry_after = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            retry_after = (1 - tokens) / limit.rate
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return retry_after
+
+
+_TAKE = (
+    "INSERT INTO rate_limits AS r (key, tokens, updated_at) "
+    "VALUES (:key, :capacity - 1, now()) "
+    "ON CONFLICT (key) DO UPDATE SET "
+    "tokens = LEAST(:capacity, r.tokens "
+    "+ EXTRACT(EPOCH FROM now() - r.updated_at) * :rate) - 1, "
+    "updated_at = now() "
+    "WHERE LEAST(:capacity, r.tokens "
+    "+ EXTRACT(EPOCH FROM now() - r.updated_at) * :rate) >= 1 "
+    "RETURNING tokens"
+)
+
+_AVAILABLE = (
+    "SELECT LEAST(:capacity, tokens "
+    "+ EXTRACT(EPOCH FROM now() - updated_at) * :rate) FROM rate_limits "
+    "WHERE key = :key"
+)
+
+
+class PostgresBackend:
+    """Ведра в общей таблице: лимит один на все воркеры."""
+
+    def __init__(self) -> None:
+        self._cleaned_at = time.monotonic()
+
+    def __len__(self) -> int:
+        return 0
+
+    async def take(self, key: str, limit: Limit) -> float:
+        params = {"key": key, "capacity": limit.capacity, "rate": limit.rate}
+        try:
+            with span("db"):
+                async with async_session() as db:
+                    async with db.begin():
+                        taken = await db.execute(text(_TAKE), params)
+                        if taken.first() is not None:
+                            retry_after = 0.0
+                        else:
+                            available = await db.scalar(text(_AVAILABLE), params)
+                            retry_after = (1 - float(available or 0)) / limit.rate
+                    if time.monotonic() - self._cleaned_at > BUCKET_IDLE_SECONDS:
+                        self._cleaned_at = time.monotonic()
+                        async with db.begin():
+                            await db.execute(
+                                text(
+                                    "DELETE FROM rate_limits WHERE updated_at < "
+                                    "now() - make_interval(secs => :idle)"
+                                ),
+                                {"idle": BUCKET_IDLE_SECONDS},
+                            )
+        except Exception as exc:  # noqa: BLE001
+            # Лимитер не должен класть вход целиком
+            logger.warning("Rate limit check failed for %s: %s", key, exc)
+            return 0.0
+        return retry_after
+
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        if settings.RATE_LIMIT_BACKEND == "postgres":
+            _backend = PostgresBackend()
+        else:
+            _backend = MemoryBackend(settings.RATE_LIMIT_MAX_KEYS)
+    return _backend
+
+
+def client_ip(request: Request) -> str:
+    """IP клиента; за `RATE_LIMIT_TRUSTED_PROXIES` прокси — из X-Forwarded-For."""
+    hops = settings.RATE_LIMIT_TRUSTED_PROXIES
+    if hops > 0:
+        forwarded = [
+            part.strip()
+            for part in request.headers.get("x-forwarded-for", "").split(",")
+            if part.strip()
+        ]
+        if forwarded:
+            return forwarded[-min(hops, len(forwarded))]
+    return request.client.host if request.client else "unknown"
+
+
+def _account_key(account: str) -> str:
+    # Email в таблицу не попадает
+    return hashlib.sha256(account.strip().lower().encode()).hexdigest()[:32]
+
+
+async def enforce(
+    request: Request,
+    route_class: str,
+    account: Optional[object] = None,
+    by_ip: bool = True,
+) -> None:
+    """Списываем запрос с ведер IP и аккаунта; 429, если одно из них пусто."""
+    limit = get_limit(route_class)
+    if limit is None:
+        return
+    backend = get_backend()
+    buckets = []
+    if by_ip:
+        buckets.append(("ip", f"{route_class}:ip:{client_ip(request)}"))
+    if account is not None:
+        account_key = _account_key(str(account))
+        buckets.append(("account", f"{route_class}:account:{account_key}"))
+    for scope, key in buckets:
+        retry_after = await backend.take(key, limit)
+        if retry_after > 0:
+            _decisions[(route_class, f"limited_{scope}")] += 1
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many requests",
+                headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+            )
+    _decisions[(route_class, "allowed")] += 1
+
+
+@metrics.register
+async def _collect():
+    return [
+        metrics.Metric(
+            "cypher_rate_limit_requests_total",
+            "Requests checked by the rate limiter, by route class and outcome.",
+            "counter",
+            [
+                ({"class": route_class, "outcome": outcome}, count)
+                for (route_class, outcome), count in sorted(_decisions.items())
+            ],
+        ),
+        metrics.Metric(
+            "cypher_rate_limit_buckets",
+            "Token buckets held in this process (memory backend).",
+            "gauge",
+            [({}, len(get_backend()))],
+        ),
+    ]
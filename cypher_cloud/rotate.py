@@ -0,0 +1,730 @@
+"""Ротация ключей: перешифровка всего хранилища новыми ключами.
+
+Ключ каждого объекта — сам ключ Fernet, он лежит в Vault без обертки, а
+шифротекст — один токен Fernet. Поэтому «перевернуть» ключ без перешифровки
+нельзя: для каждого объекта создается новый ключ по новому пути в Vault
+(`<путь>.r<задание>`), содержимое перешифровывается в новый файл, и строка в
+БД одной транзакцией переключается на новые путь и ключ. Фазы по очереди:
+
+- `files`, `file_versions` — цельный шифротекст файла или версии;
+- `blobs` — общий шифротекст дедупликации вместе со всеми ссылками на него;
+- `chunked_files` — все чанки файла с версиями и общий ключ чанков;
+- `segments` — запечатанные сегменты мелких файлов (заодно компактируются).
+
+Переключение идет под той же блокировкой, что и изменения файла
+(`lock_file`, строка Blob или сегмента), и только если строка все еще
+указывает на перешифрованное содержимое; иначе результат выбрасывается, а
+объект считается пропущенным (`skipped`). Прежние файл и ключ попадают в
+`retired_objects` и удаляются через `ROTATION_GRACE_SECONDS`, так что
+скачивание, начатое до переключения, дочитает старую копию. Новые файл и
+ключ записываются в `retired_objects` до записи и вычеркиваются при
+коммите: если процесс упадет посередине, они тоже будут удалены.
+
+Объекты обрабатываются пачками по `ROTATION_BATCH_SIZE`, не больше
+`ROTATION_CONCURRENCY` одновременно, чтение ограничено
+`ROTATION_BYTES_PER_SECOND`. После каждой пачки позиция сохраняется в
+`key_rotations`; прерванное задание продолжается с нее.
+
+    python -m cypher_cloud.rotate start
+    python -m cypher_cloud.rotate resume
+    python -m cypher_cloud.rotate status
+    python -m cypher_cloud.rotate purge
+"""
+
+import argparse
+import asyncio
+import hashlib
+import hmac
+import logging
+import os
+import re
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Awaitable, Callable, List, NamedTuple, Optional, Tuple
+
+from cryptography.fernet import Fernet
+from sqlalchemy import delete, func, text
+from sqlalchemy.future import select
+
+from cypher_cloud.config import settings
+from cypher_cloud.database import async_session, dispose_engines, get_engine
+from cypher_cloud.models import KeyRotation, RetiredObject, Segment
+from cypher_cloud.packing import (
+    COMPACT_LOCK_KEY,
+    live_entries,
+    reencrypt_entries,
+    remap_entries,
+    segment_key,
+)
+from cypher_cloud.storage import (
+    ByteBudget,
+    new_storage_path,
+    remove_stored,
+    sync_writes,
+    write_file,
+)
+from cypher_cloud.vault_client import delete_file_key, fetch_file_key, store_file_key
+from cypher_cloud.versions import lock_file
+
+logger = logging.getLogger(__name__)
+
+# Одно задание на все процессы
+ROTATE_LOCK_KEY = 0x726F7461  # "rota"
+ROTATION_MAX_ERRORS = 100
+
+
+class RotationConflict(Exception):
+    """Объект изменился (удален, перенесен) во время перешифровки."""
+
+
+def rotated_key_path(path: str, job_id: int) -> str:
+    return f"{re.sub(r'[.]r[0-9]+$', '', path)}.r{job_id}"
+
+
+def _reencrypt_file(path: str, old_key: bytes, new_key: bytes) -> bytes:
+    with open(path, "rb") as f_in:
+        token = f_in.read()
+    return Fernet(new_key).encrypt(Fernet(old_key).decrypt(token))
+
+
+def _reencrypt_chunk(path: str, old_key: bytes, new_key: bytes) -> Tuple[bytes, str]:
+    """Чанк плюс его `content_hash`: HMAC считается на ключе чанков файла."""
+    with open(path, "rb") as f_in:
+        content = Fernet(old_key).decrypt(f_in.read())
+    hash_ = hmac.new(
+        new_key, b"chunk:" + hashlib.sha256(content).digest(), hashlib.sha256
+    ).hexdigest()
+    return Fernet(new_key).encrypt(content), hash_
+
+
+class _Staged:
+    """Новые шифротекст и ключ, записанные до коммита ротации."""
+
+    def __init__(self, paths: List[str], key_path: str) -> None:
+        self.paths = paths
+        self.key_path = key_path
+        self._intent_ids: List[int] = []
+
+    async def begin(self) -> None:
+        async with async_session() as db:
+            async with db.begin():
+                rows = _retired_rows(self.paths, self.key_path)
+                db.add_all(rows)
+                await db.flush()
+                self._intent_ids = [row.id for row in rows]
+
+    async def commit(self, db, old_paths: List[str], old_key_path: str) -> None:
+        """В транзакции переключения: новые объекты больше не временные,
+        прежние уходят в удаление после grace-периода."""
+        await db.execute(
+            delete(RetiredObject).where(RetiredObject.id.in_(self._intent_ids))
+        )
+        db.add_all(_retired_rows(old_paths, old_key_path))
+
+    async def abort(self) -> None:
+        remove_stored(self.paths)
+        await delete_file_key(self.key_path)
+        async with async_session() as db:
+            async with db.begin():
+                await db.execute(
+                    delete(RetiredObject).where(RetiredObject.id.in_(self._intent_ids))
+                )
+
+
+def _retired_rows(paths: List[str], key_path: Optional[str]) -> List[RetiredObject]:
+    rows = [RetiredObject(storage_path=path) for path in paths]
+    if key_path:
+        if rows:
+            rows[0].vault_key_path = key_path
+        else:
+            rows.append(RetiredObject(vault_key_path=key_path))
+    return rows
+
+
+# --- Объекты -----------------------------------------------------------------
+
+
+async def _rotate_single(table: str, job_id: int, row, budget: ByteBudget) -> int:
+    """Цельный шифротекст файла или версии."""
+    old_key = (await fetch_file_key(row.vault_key_path)).encode()
+    new_key = Fernet.generate_key()
+    new_path = str(new_storage_path(row.owner_id, Path(row.storage_path).suffix))
+    new_key_path = rotated_key_path(row.vault_key_path, job_id)
+    size = os.path.getsize(row.storage_path)
+    await budget.acquire(size)
+
+    staged = _Staged([new_path], new_key_path)
+    await staged.begin()
+    try:
+        token = await asyncio.to_thread(
+            _reencrypt_file, row.storage_path, old_key, new_key
+        )
+        digest = await write_file(Path(new_path), token)
+        await store_file_key(new_key_path, new_key.decode())
+        async with async_session() as db:
+            async with db.begin():
+                await lock_file(db, row.owner_id, row.file_id)
+                result = await db.execute(
+                    text(
+                        f"UPDATE {table} SET storage_path = :new_path, "
+                        "vault_key_path = :new_key_path, ciphertext_sha256 = :digest "
+                        "WHERE owner_id = :owner AND id = :id "
+                        "AND storage_path = :old_path "
+                        "AND vault_key_path = :old_key_path"
+                    ),
+                    {
+                        "new_path": new_path,
+                        "new_key_path": new_key_path,
+                        "digest": digest,
+                        "owner": row.owner_id,
+                        "id": row.id,
+                        "old_path": row.storage_path,
+                        "old_key_path": row.vault_key_path,
+                    },
+                )
+                if result.rowcount != 1:
+                    raise RotationConflict()
+                await staged.commit(db, [row.storage_path], row.vault_key_path)
+    except BaseException:
+        await staged.abort()
+        raise
+    return size
+
+
+async def _rotate_file(job_id: int, row, budget: ByteBudget) -> int:
+    return await _rotate_single("files", job_id, row, budget)
+
+
+async def _rotate_version(job_id: int, row, budget: ByteBudget) -> int:
+    return await _rotate_single("file_versions", job_id, row, budget)
+
+
+async def _rotate_blob(job_id: int, row, budget: ByteBudget) -> int:
+    """Общий шифротекст: вместе с Blob переключаем все файлы и версии,
+    которые копируют его путь и ключ."""
+    old_key = (await fetch_file_key(row.vault_key_path)).encode()
+    new_key = Fernet.generate_key()
+    new_path = str(new_storage_path(row.owner_id, Path(row.storage_path).suffix))
+    new_key_path = rotated_key_path(row.vault_key_path, job_id)
+    size = os.path.getsize(row.storage_path)
+    await budget.acquire(size)
+
+    staged = _Staged([new_path], new_key_path)
+    await staged.begin()
+    try:
+        token = await asyncio.to_thread(
+            _reencrypt_file, row.storage_path, old_key, new_key
+        )
+        digest = await write_file(Path(new_path), token)
+        await store_file_key(new_key_path, new_key.decode())
+        params = {
+            "new_path": new_path,
+            "new_key_path": new_key_path,
+            "id": row.id,
+            "old_path": row.storage_path,
+            "old_key_path": row.vault_key_path,
+        }
+        async with async_session() as db:
+            async with db.begin():
+                # Строка Blob под блокировкой: новые ссылки (acquire_blob)
+                # дождутся коммита и получат уже новые путь и ключ
+                result = await db.execute(
+                    text(
+                        "UPDATE blobs SET storage_path = :new_path, "
+                        "vault_key_path = :new_key_path, ciphertext_sha256 = :digest "
+                        "WHERE id = :id AND storage_path = :old_path "
+                        "AND vault_key_path = :old_key_path"
+                    ),
+                    {**params, "digest": digest},
+                )
+                if result.rowcount != 1:
+                    raise RotationConflict()
+                # files раньше file_versions, как в remap_entries
+                for table in ("files", "file_versions"):
+                    await db.execute(
+                        text(
+                            f"UPDATE {table} SET storage_path = :new_path, "
+                            "vault_key_path = :new_key_path "
+                            "WHERE blob_id = :id AND storage_path = :old_path"
+                        ),
+                        params,
+                    )
+                await staged.commit(db, [row.storage_path], row.vault_key_path)
+    except BaseException:
+        await staged.abort()
+        raise
+    return size
+
+
+async def _rotate_chunked(job_id: int, row, budget: ByteBudget) -> int:
+    """Все чанки версий файла и их общий ключ. `content_hash` чанков зависит
+    от ключа, поэтому пересчитывается, иначе новые версии не найдут чанки."""
+    async with async_session() as db:
+        result = await db.execute(
+            text(
+                "SELECT id, storage_path FROM file_chunks "
+                "WHERE owner_id = :owner AND file_id = :id ORDER BY id"
+            ),
+            {"owner": row.owner_id, "id": row.id},
+        )
+        chunks = [(chunk.id, chunk.storage_path) for chunk in result]
+    old_key = (await fetch_file_key(row.vault_key_path)).encode()
+    new_key = Fernet.generate_key()
+    new_paths = [str(new_storage_path(row.owner_id, ".chunk")) for _ in chunks]
+    new_key_path = rotated_key_path(row.vault_key_path, job_id)
+
+    staged = _Staged(new_paths, new_key_path)
+    await staged.begin()
+    size = 0
+    try:
+        digests, hashes = [], []
+        for (_, path), new_path in zip(chunks, new_paths):
+            chunk_size = os.path.getsize(path)
+            await budget.acquire(chunk_size)
+            token, hash_ = await asyncio.to_thread(
+                _reencrypt_chunk, path, old_key, new_key
+            )
+            digests.append(await write_file(Path(new_path), token, durable=False))
+            hashes.append(hash_)
+            size += chunk_size
+        await sync_writes()
+        await store_file_key(new_key_path, new_key.decode())
+        async with async_session() as db:
+            async with db.begin():
+                db_file = await lock_file(db, row.owner_id, row.id)
+                if (
+                    db_file is None
+                    or db_file.storage_path
+                    or db_file.vault_key_path != row.vault_key_path
+                ):
+                    raise RotationConflict()
+                result = await db.execute(
+                    text(
+                        "SELECT id, storage_path FROM file_chunks "
+                        "WHERE owner_id = :owner AND file_id = :id ORDER BY id"
+                    ),
+                    {"owner": row.owner_id, "id": row.id},
+                )
+                # Версии файла меняются только под lock_file, но между
+                # чтением и блокировкой могли появиться или уйти чанки
+                if [(chunk.id, chunk.storage_path) for chunk in result] != chunks:
+                    raise RotationConflict()
+                if chunks:
+                    await db.execute(
+                        text(
+                            "UPDATE file_chunks c SET storage_path = m.path, "
+                            "ciphertext_sha256 = m.digest, content_hash = m.hash "
+                            "FROM unnest(CAST(:ids AS integer[]), "
+                            "CAST(:paths AS varchar[]), CAST(:digests AS varchar[]), "
+                            "CAST(:hashes AS varchar[])) "
+                            "AS m(id, path, digest, hash) WHERE c.id = m.id"
+                        ),
+                        {
+                            "ids": [chunk_id for chunk_id, _ in chunks],
+                            "paths": new_paths,
+                            "digests": digests,
+                            "hashes": hashes,
+                        },
+                    )
+                params = {
+                    "owner": row.owner_id,
+                    "id": row.id,
+                    "old_key_path": row.vault_key_path,
+                    "new_key_path": new_key_path,
+                }
+                await db.execute(
+                    text(
+                        "UPDATE files SET vault_key_path = :new_key_path "
+                        "WHERE owner_id = :owner AND id = :id"
+                    ),
+                    params,
+                )
+                await db.execute(
+                    text(
+                        "UPDATE file_versions SET vault_key_path = :new_key_path "
+                        "WHERE owner_id = :owner AND file_id = :id "
+                        "AND chunk_ids IS NOT NULL AND vault_key_path = :old_key_path"
+                    ),
+                    params,
+                )
+                await staged.commit(
+                    db, [path for _, path in chunks], row.vault_key_path
+                )
+    except BaseException:
+        await staged.abort()
+        raise
+    return size
+
+
+async def _rotate_segment(job_id: int, row, budget: ByteBudget) -> int:
+    """Сегмент переписывается без мертвых записей, каждая запись — новым
+    ключом. Компактор на это время остановлен (фаза держит его блокировку)."""
+    # Загрузки, зарезервировавшие место до запечатывания, дописывают запись
+    # не дольше grace-периода компактора
+    ready_at = row.sealed_at + timedelta(seconds=settings.COMPACT_GRACE_SECONDS)
+    delay = (ready_at - datetime.now(timezone.utc)).total_seconds()
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+    entries = await live_entries(row.id)
+    if not entries:
+        raise RotationConflict()  # пустой сегмент удалит компактор
+    old_key = await segment_key(row.vault_key_path)
+    new_key = Fernet.generate_key()
+    new_path = str(new_storage_path(row.owner_id, ".seg"))
+    new_key_path = rotated_key_path(row.vault_key_path, job_id)
+    size = sum(length for _, length in entries)
+    await budget.acquire(size)
+
+    staged = _Staged([new_path], new_key_path)
+    await staged.begin()
+    try:
+        offsets, digests = await asyncio.to_thread(
+            reencrypt_entries, row.storage_path, new_path, entries, old_key, new_key
+        )
+        await store_file_key(new_key_path, new_key.decode())
+        async with async_session() as db:
+            async with db.begin():
+                segment = await db.get(Segment, row.id, with_for_update=True)
+                if (
+                    segment is None
+                    or segment.storage_path != row.storage_path
+                    or segment.vault_key_path != row.vault_key_path
+                ):
+                    raise RotationConflict()
+                await remap_entries(
+                    db,
+                    row.id,
+                    new_path,
+                    [offset for offset, _ in entries],
+                    offsets,
+                    vault_key_path=new_key_path,
+                    digests=digests,
+                )
+                segment.storage_path = new_path
+                segment.vault_key_path = new_key_path
+                segment.size = size
+                await staged.commit(db, [row.storage_path], row.vault_key_path)
+    except BaseException:
+        await staged.abort()
+        raise
+    return size
+
+
+# --- Фазы --------------------------------------------------------------------
+
+
+class Phase(NamedTuple):
+    name: str
+    # Следующая пачка после курсора (:owner, :id); :suffix отсекает объекты,
+    # уже получившие ключ этого задания
+    query: str
+    rotate: Callable[[int, object, ByteBudget], Awaitable[int]]
+
+
+PHASES = [
+    Phase(
+        "files",
+        "SELECT owner_id, id, id AS file_id, storage_path, vault_key_path FROM files "
+        "WHERE (owner_id, id) > (:owner, :id) AND storage_path <> '' "
+        "AND blob_id IS NULL AND segment_id IS NULL "
+        "AND vault_key_path NOT LIKE :suffix "
+        "ORDER BY owner_id, id LIMIT :limit",
+        _rotate_file,
+    ),
+    Phase(
+        "file_versions",
+        "SELECT owner_id, id, file_id, storage_path, vault_key_path "
+        "FROM file_versions WHERE id > :id AND storage_path IS NOT NULL "
+        "AND blob_id IS NULL AND segment_id IS NULL "
+        "AND vault_key_path NOT LIKE :suffix ORDER BY id LIMIT :limit",
+        _rotate_version,
+    ),
+    Phase(
+        "blobs",
+        "SELECT owner_id, id, storage_path, vault_key_path FROM blobs "
+        "WHERE id > :id AND vault_key_path <> '' "
+        "AND vault_key_path NOT LIKE :suffix ORDER BY id LIMIT :limit",
+        _rotate_blob,
+    ),
+    Phase(
+        "chunked_files",
+        "SELECT owner_id, id, vault_key_path FROM files "
+        "WHERE (owner_id, id) > (:owner, :id) AND storage_path = '' "
+        "AND vault_key_path NOT LIKE :suffix "
+        "ORDER BY owner_id, id LIMIT :limit",
+        _rotate_chunked,
+    ),
+    Phase(
+        "segments",
+        # Сегменты, открытые после начала фазы, уже на новых ключах
+        "SELECT owner_id, id, storage_path, vault_key_path, sealed_at FROM segments "
+        "WHERE id > :id AND id <= :bound AND sealed_at IS NOT NULL "
+        "AND vault_key_path NOT LIKE :suffix ORDER BY id LIMIT :limit",
+        _rotate_segment,
+    ),
+]
+
+
+async def _guarded(
+    phase: Phase, job_id: int, row, budget: ByteBudget, semaphore: asyncio.Semaphore
+) -> Tuple[str, int, Optional[str]]:
+    async with semaphore:
+        try:
+            return "rotated", await phase.rotate(job_id, row, budget), None
+        except RotationConflict:
+            return "skipped", 0, None
+        except Exception as exc:  # noqa: BLE001
+            logger.exception("Failed to rotate %s %s", phase.name, row.id)
+            return "failed", 0, str(exc) or type(exc).__name__
+
+
+async def _start_segments_phase(cursor: dict) -> dict:
+    """Запечатываем открытые сегменты: новые записи пойдут в новые сегменты
+    с новыми ключами."""
+    if "bound" in cursor:
+        return cursor
+    async with async_session() as db:
+        async with db.begin():
+            bound = await db.scalar(select(func.coalesce(func.max(Segment.id), 0)))
+            await db.execute(
+                text(
+                    "UPDATE segments SET sealed_at = now() "
+                    "WHERE sealed_at IS NULL AND id <= :bound"
+                ),
+                {"bound": bound},
+            )
+    return {**cursor, "bound": bound}
+
+
+async def _checkpoint(
+    job_id: int,
+    phase: str,
+    cursor: dict,
+    outcomes: List[Tuple[str, int, Optional[str]]],
+    errors: List[dict],
+) -> None:
+    async with async_session() as db:
+        async with db.begin():
+            job = await db.get(KeyRotation, job_id, with_for_update=True)
+            job.phase = phase
+            job.cursor = cursor
+            job.rotated += sum(1 for outcome, _, _ in outcomes if outcome == "rotated")
+            job.skipped += sum(1 for outcome, _, _ in outcomes if outcome == "skipped")
+            job.failed += sum(1 for outcome, _, _ in outcomes if outcome == "failed")
+            job.bytes += sum(size for _, size, _ in outcomes)
+            if errors and len(job.errors) < ROTATION_MAX_ERRORS:
+                job.errors = (job.errors + errors)[:ROTATION_MAX_ERRORS]
+            job.updated_at = func.now()
+
+
+async def _run_phase(job: KeyRotation, phase: Phase, cursor: dict, budget, semaphore):
+    suffix = f"%.r{job.id}"
+    while True:
+        async with async_session() as db:
+            result = await db.execute(
+                text(phase.query),
+                {
+                    "owner": cursor.get("owner", 0),
+                    "id": cursor.get("id", 0),
+                    "bound": cursor.get("bound", 0),
+                    "suffix": suffix,
+                    "limit": settings.ROTATION_BATCH_SIZE,
+                },
+            )
+            rows = result.all()
+        if not rows:
+            return
+        outcomes = await asyncio.gather(
+            *(_guarded(phase, job.id, row, budget, semaphore) for row in rows)
+        )
+        errors = [
+            {"phase": phase.name, "id": row.id, "error": error}
+            for row, (outcome, _, error) in zip(rows, outcomes)
+            if outcome == "failed"
+        ]
+        cursor = {**cursor, "owner": rows[-1].owner_id, "id": rows[-1].id}
+        await _checkpoint(job.id, phase.name, cursor, outcomes, errors)
+        # Вне пачки нет незавершенных переключений — можно чистить
+        await purge_retired()
+
+
+async def run(job_id: int) -> None:
+    """Выполняем (или продолжаем) задание ротации."""
+    async with get_engine().connect() as lock_conn:
+        locked = await lock_conn.scalar(
+            text("SELECT pg_try_advisory_lock(:key)"), {"key": ROTATE_LOCK_KEY}
+        )
+        await lock_conn.commit()
+        if not locked:
+            raise RuntimeError("Ротация ключей уже выполняется")
+        try:
+            async with async_session() as db:
+                job = await db.get(KeyRotation, job_id)
+            if job is None or job.status != "running":
+                return
+            await purge_retired()
+            budget = ByteBudget(settings.ROTATION_BYTES_PER_SECOND)
+            semaphore = asyncio.Semaphore(settings.ROTATION_CONCURRENCY)
+            names = [phase.name for phase in PHASES]
+            for phase in PHASES[names.index(job.phase) :]:
+                cursor = job.cursor if phase.name == job.phase else {}
+                logger.info("Key rotation %s: phase %s", job_id, phase.name)
+                if phase.name == "segments":
+                    # Компактор переписывает те же сегменты — ждем его прохода
+                    await lock_conn.execute(
+                        text("SELECT pg_advisory_lock(:key)"), {"key": COMPACT_LOCK_KEY}
+                    )
+                    await lock_conn.commit()
+                    try:
+                        cursor = await _start_segments_phase(cursor)
+                        await _checkpoint(job_id, phase.name, cursor, [], [])
+                        await _run_phase(job, phase, cursor, budget, semaphore)
+                    finally:
+                        await lock_conn.execute(
+                            text("SELECT pg_advisory_unlock(:key)"),
+                            {"key": COMPACT_LOCK_KEY},
+                        )
+                        await lock_conn.commit()
+                else:
+                    await _run_phase(job, phase, cursor, budget, semaphore)
+            async with async_session() as db:
+                async with db.begin():
+                    job = await db.get(KeyRotation, job_id, with_for_update=True)
+                    job.status = "completed"
+                    job.finished_at = func.now()
+                    job.updated_at = func.now()
+            # Дожидаемся grace-периода последних переключений и убираем за собой
+            await asyncio.sleep(settings.ROTATION_GRACE_SECONDS)
+            await purge_retired()
+        finally:
+            await lock_conn.execute(
+                text("SELECT pg_advisory_unlock(:key)"), {"key": ROTATE_LOCK_KEY}
+            )
+            await lock_conn.commit()
+
+
+async def purge_retired() -> int:
+    """Удаляем прежние шифротекст и ключи, чей grace-период истек."""
+    cutoff = datetime.now(timezone.utc) - timedelta(
+        seconds=settings.ROTATION_GRACE_SECONDS
+    )
+    removed = 0
+    while True:
+        async with async_session() as db:
+            async with db.begin():
+                result = await db.execute(
+                    select(RetiredObject)
+                    .where(RetiredObject.retired_at < cutoff)
+                    .order_by(RetiredObject.id)
+                    .limit(500)
+                    .with_for_update(skip_locked=True)
+                )
+                retired = list(result.scalars().all())
+                if not retired:
+                    return removed
+                # Сначала сами объекты: если упадем, строки останутся и
+                # удаление повторится (оно идемпотентно)
+                remove_stored([row.storage_path for row in retired])
+                for row in retired:
+                    await delete_file_key(row.vault_key_path)
+                await db.execute(
+                    delete(RetiredObject).where(
+                        RetiredObject.id.in_([row.id for row in retired])
+                    )
+                )
+                removed += len(retired)
+
+
+# --- CLI ---------------------------------------------------------------------
+
+
+async def _active_job() -> Optional[KeyRotation]:
+    async with async_session() as db:
+        result = await db.execute(
+            select(KeyRotation)
+            .where(KeyRotation.status == "running")
+            .order_by(KeyRotation.id.desc())
+            .limit(1)
+        )
+        return result.scalars().first()
+
+
+async def start() -> int:
+    if await _active_job() is not None:
+        raise RuntimeError(
+            "Есть незавершенное задание: python -m cypher_cloud.rotate resume"
+        )
+    async with async_session() as db:
+        async with db.begin():
+            job = KeyRotation(phase=PHASES[0].name, cursor={}, errors=[])
+            db.add(job)
+            await db.flush()
+            job_id = job.id
+    await run(job_id)
+    return job_id
+
+
+def _describe(job: KeyRotation) -> str:
+    return (
+        f"rotation {job.id}: {job.status}, phase {job.phase} at {job.cursor}, "
+        f"rotated={job.rotated} skipped={job.skipped} failed={job.failed} "
+        f"bytes={job.bytes} started={job.started_at} finished={job.finished_at}"
+    )
+
+
+async def _main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Cypher Cloud key rotation")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("start", help="новое задание: перешифровать все хранилище")
+    resume = sub.add_parser("resume", help="продолжить прерванное задание")
+    resume.add_argument("--job", type=int, default=None)
+    status = sub.add_parser("status", help="состояние задания")
+    status.add_argument("--job", type=int, default=None)
+    sub.add_parser("purge", help="удалить прежние объекты с истекшим grace-периодом")
+    args = parser.parse_args(argv)
+    try:
+        if args.command == "start":
+            job_id = await start()
+        elif args.command == "resume":
+            job = await _active_job() if args.job is None else None
+            job_id = job.id if job is not None else args.job
+            if job_id is None:
+                raise SystemExit("Нет незавершенного задания")
+            await run(job_id)
+        elif args.command == "purge":
+            # Пока идет задание, в retired_objects лежат и незакоммиченные
+            # новые объекты — их чистит само задание между пачками
+            async with get_engine().connect() as conn:
+                if not await conn.scalar(
+                    text("SELECT pg_try_advisory_lock(:key)"), {"key": ROTATE_LOCK_KEY}
+                ):
+                    raise SystemExit("Ротация ключей выполняется")
+                try:
+                    print(await purge_retired())
+                finally:
+                    await conn.execute(
+                        text("SELECT pg_advisory_unlock(:key)"),
+                        {"key": ROTATE_LOCK_KEY},
+                    )
+            return
+        else:
+            job_id = args.job
+        async with async_session() as db:
+            if job_id is None:
+                result = await db.execute(
+                    select(KeyRotation).order_by(KeyRotation.id.desc()).limit(1)
+                )
+                job = result.scalars().first()
+            else:
+                job = await db.get(KeyRotation, job_id)
+        print(_describe(job) if job is not None else "Заданий нет")
+        for error in job.errors if job is not None else []:
+            print(f"  {error['phase']} {error['id']}: {error['error']}")
+    finally:
+        await dispose_engines()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    asyncio.run(_main())
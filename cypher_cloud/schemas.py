@@ -1,8 +1,9 @@
 # schemas.py
 
+from datetime import datetime
 from typing import List, Optional
 
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, Field
 
 # --- Auth ---
 
@@ -65,6 +66,7 @@ class UserResponse(BaseModel):
     id: int
     email: EmailStr
     is_active: bool
+    dedup_enabled: bool = False
 
     class Config:
         from_attributes = True
@@ -98,6 +100,146 @@ class PasskeyLoginVerifyRequest(BaseModel):
 class FileItem(BaseModel):
     id: int
     filename: str
+    folder_id: int | None = None
+    size: int | None = None
+
+    class Config:
+        from_attributes = True
+
+
+class FileSearchItem(BaseModel):
+    id: int
+    filename: str
+    score: float
+
+
+class FileSearchResponse(BaseModel):
+    items: List[FileSearchItem]
+    limit: int
+    offset: int
+    has_more: bool
+
+
+class StorageUsage(BaseModel):
+    bytes: int
+    objects: int
+    reserved_bytes: int  # идущие загрузки
+    quota_bytes: int
+    quota_objects: int
+
+
+class DedupSettings(BaseModel):
+    enabled: bool
+
+
+class FileVersionItem(BaseModel):
+    version: int
+    size: int | None = None
+    created_at: datetime | None = None
+    current: bool
+
+
+class FileVersionUploadResult(BaseModel):
+    version: int
+    size: int
+    chunks: int
+    new_chunks: int  # сколько чанков зашифровано и записано на диск
+    new_bytes: int
+
+
+class ImportJobStatus(BaseModel):
+    id: str
+    status: str
+    format: str
+    total: int | None = None
+    processed: int
+    succeeded: int
+    failed: int
+    bytes: int
+    errors: List[dict]
+    error: str | None = None
+    created_at: datetime
+    updated_at: datetime
+    finished_at: datetime | None = None
 
     class Config:
         from_attributes = True
+
+
+class FileChangeItem(BaseModel):
+    seq: int
+    kind: str  # upload | delete | rename | move | version | folder_*
+    file_id: int | None = None
+    filename: str | None = None
+    version: int | None = None
+    folder_id: int | None = None
+    created_at: datetime
+
+    class Config:
+        from_attributes = True
+
+
+class FileChangesResponse(BaseModel):
+    changes: List[FileChangeItem]
+    cursor: int  # передать как since в следующем запросе
+    has_more: bool
+
+
+class FileUpdate(BaseModel):
+    """Переименование и/или перенос; `folder_id: null` — в корень."""
+
+    filename: str | None = Field(None, min_length=1, max_length=255)
+    folder_id: int | None = None
+
+
+# --- Folders ---
+
+
+class FolderCreate(BaseModel):
+    name: str = Field(..., min_length=1, max_length=255, pattern=r"^[^/]+$")
+    parent_id: int | None = None
+
+
+class FolderUpdate(BaseModel):
+    """Переименование и/или перенос; `parent_id: null` — в корень."""
+
+    name: str | None = Field(None, min_length=1, max_length=255, pattern=r"^[^/]+$")
+    parent_id: int | None = None
+
+
+class FolderItem(BaseModel):
+    id: int
+    name: str
+    parent_id: int | None = None
+
+    class Config:
+        from_attributes = True
+
+
+class FolderListing(BaseModel):
+    folder: FolderItem | None = None  # None — корень
+    breadcrumbs: List[FolderItem]  # предки от корня
+    folders: List[FolderItem]
+    files: List[FileItem]
+
+
+# --- Share links ---
+
+
+class ShareCreate(BaseModel):
+    expires_in: int | None = Field(None, ge=60)  # сек; по умолчанию SHARE_DEFAULT_TTL_SECONDS
+    version: int | None = Field(None, ge=1)  # закрепить версию; иначе — текущая
+    # Разрешенный диапазон байт [range_start, range_end)
+    range_start: int | None = Field(None, ge=0)
+    range_end: int | None = Field(None, ge=1)
+
+
+class ShareLink(BaseModel):
+    token: str
+    url: str
+    jti: str
+    expires_at: datetime
+
+
+class ShareRevoke(BaseModel):
+    token: str
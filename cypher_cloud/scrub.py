@@ -0,0 +1,492 @@
+"""Фоновая проверка целостности шифротекста (scrubber).
+
+При записи сохраняется SHA-256 шифротекста (`ciphertext_sha256` в `files`,
+`file_versions`, `blobs`, `file_chunks`; у мелких файлов — их записи в
+сегменте). Проверка читает объект с диска и сравнивает дайджест, поэтому ей
+не нужны ни Vault, ни расшифровка. У объектов, загруженных раньше, дайджеста
+нет: для них проверяется форма токена Fernet (алфавит base64, версия, длина,
+кратная блоку AES). Если форма правильная, проверка сохраняет дайджест, и
+следующие проходы сравнивают уже его.
+
+Обход идет по каждой таблице в порядке ключа, пачками по `SCRUB_BATCH_SIZE`.
+Позиция сохраняется в `scrub_progress` вместе с результатами пачки, поэтому
+после перезапуска проход продолжается с того же места. Чтение ограничено
+`SCRUB_BYTES_PER_SECOND`. Хеширование — единственная заметная нагрузка на
+CPU, так что тот же лимит ограничивает и ее, и полный проход по десяткам
+терабайт растягивается на дни. Новый проход таблицы начинается через
+`SCRUB_INTERVAL_SECONDS` после начала предыдущего.
+
+Поврежденные (`corrupt`) и пропавшие (`missing`) объекты записываются в
+`scrub_findings` и отдаются в `/metrics`. Запись удаляется, когда объект
+проходит проверку или когда он удален к концу прохода.
+
+    python -m cypher_cloud.scrub run [--kind files] [--limit N]
+    python -m cypher_cloud.scrub status
+"""
+
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import delete, func, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.future import select
+
+from cypher_cloud import metrics
+from cypher_cloud.config import settings
+from cypher_cloud.database import (
+    async_session,
+    dispose_engines,
+    get_engine,
+    read_session,
+)
+from cypher_cloud.models import ScrubFinding, ScrubProgress
+from cypher_cloud.storage import ByteBudget
+
+logger = logging.getLogger(__name__)
+
+# Один обход на все воркеры
+SCRUB_LOCK_KEY = 0x73637262  # "scrb"
+READ_BLOCK_SIZE = 1024 * 1024
+
+_BASE64_ALPHABET = (
+    b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_"
+)
+# версия + время + IV (25 байт) и HMAC (32)
+_FERNET_OVERHEAD = 57
+
+
+class _Kind(NamedTuple):
+    name: str
+    table: str
+    # Выборка очередной пачки после курсора (:owner, :id)
+    query: str
+
+
+_COLUMNS = "id, owner_id, storage_path, {offset}, {length}, ciphertext_sha256"
+
+KINDS = [
+    _Kind(
+        "files",
+        "files",
+        # Ключ (owner_id, id) — его индекс есть и у партиционированной files;
+        # общий шифротекст дедупликации проверяется через blobs
+        f"SELECT {_COLUMNS.format(offset='segment_offset', length='segment_length')} "
+        "FROM files WHERE (owner_id, id) > (:owner, :id) "
+        "AND storage_path <> '' AND blob_id IS NULL "
+        "ORDER BY owner_id, id LIMIT :limit",
+    ),
+    _Kind(
+        "file_versions",
+        "file_versions",
+        f"SELECT {_COLUMNS.format(offset='segment_offset', length='segment_length')} "
+        "FROM file_versions WHERE id > :id "
+        "AND storage_path IS NOT NULL AND blob_id IS NULL "
+        "ORDER BY id LIMIT :limit",
+    ),
+    _Kind(
+        "blobs",
+        "blobs",
+        f"SELECT {_COLUMNS.format(offset='NULL', length='NULL')} "
+        "FROM blobs WHERE id > :id ORDER BY id LIMIT :limit",
+    ),
+    _Kind(
+        "file_chunks",
+        "file_chunks",
+        f"SELECT {_COLUMNS.format(offset='NULL', length='NULL')} "
+        "FROM file_chunks WHERE id > :id ORDER BY id LIMIT :limit",
+    ),
+]
+KINDS_BY_NAME = {kind.name: kind for kind in KINDS}
+
+
+class StoredObject(NamedTuple):
+    id: int
+    owner_id: int
+    storage_path: str
+    # Запись внутри сегмента; для цельного файла — None
+    offset: Optional[int]
+    length: Optional[int]
+    ciphertext_sha256: Optional[str]
+
+
+class Verdict(NamedTuple):
+    status: str  # ok | corrupt | missing
+    detail: Optional[str]
+    size: int
+    # Дайджест прочитанного, если у объекта его еще не было
+    digest: Optional[str] = None
+
+
+def _token_shape_error(
+    size: int, head: bytes, tail: bytes, alphabet_ok: bool
+) -> Optional[str]:
+    """Проверка формы токена Fernet без ключа: ловит обрезку и мусор."""
+    if not alphabet_ok:
+        return "not a base64 token"
+    padding = len(tail) - len(tail.rstrip(b"="))
+    if size % 4 or padding > 2:
+        return f"bad token length {size}"
+    decoded = size // 4 * 3 - padding
+    if decoded < _FERNET_OVERHEAD + 16 or (decoded - _FERNET_OVERHEAD) % 16:
+        return f"bad token length {size}"
+    if not head.startswith(b"g"):  # первый байт 0x80 — версия формата
+        return "bad token version"
+    return None
+
+
+def check_object(obj: StoredObject, budget: ByteBudget) -> Verdict:
+    """Читаем объект блоками и сравниваем SHA-256 (или форму токена)."""
+    try:
+        fd = os.open(obj.storage_path, os.O_RDONLY)
+    except FileNotFoundError:
+        return Verdict("missing", "file not found", 0)
+    try:
+        file_size = os.fstat(fd).st_size
+        start = obj.offset or 0
+        size = obj.length if obj.offset is not None else file_size
+        if start + size > file_size:
+            return Verdict("corrupt", f"truncated: {file_size} < {start + size}", 0)
+        digest = hashlib.sha256()
+        head = tail = b""
+        alphabet_ok = True
+        position, remaining = start, size
+        while remaining:
+            budget.consume(min(READ_BLOCK_SIZE, remaining))
+            block = os.pread(fd, min(READ_BLOCK_SIZE, remaining), position)
+            if not block:
+                return Verdict("corrupt", f"short read at {position}", size)
+            digest.update(block)
+            if obj.ciphertext_sha256 is None:
+                head = head or block[:4]
+                tail = (tail + block)[-4:]
+                alphabet_ok = alphabet_ok and not block.rstrip(b"=").translate(
+                    None, _BASE64_ALPHABET
+                )
+            position += len(block)
+            remaining -= len(block)
+    except OSError as exc:
+        return Verdict("corrupt", f"read error: {exc}", 0)
+    finally:
+        os.close(fd)
+
+    hexdigest = digest.hexdigest()
+    if obj.ciphertext_sha256 is not None:
+        if hexdigest != obj.ciphertext_sha256:
+            return Verdict("corrupt", "digest mismatch", size)
+        return Verdict("ok", None, size)
+    error = _token_shape_error(size, head, tail, alphabet_ok)
+    if error is not None:
+        return Verdict("corrupt", error, size)
+    return Verdict("ok", None, size, hexdigest)
+
+
+# --- Обход -------------------------------------------------------------------
+
+
+def _same_object(kind: _Kind) -> str:
+    """Условие, что строка все еще указывает на проверенный шифротекст
+    (не удалена, не перенесена компактором)."""
+    condition = "id = :id AND owner_id = :owner AND storage_path = :path"
+    if kind.table in ("files", "file_versions"):
+        condition += " AND segment_offset IS NOT DISTINCT FROM :offset"
+    return condition
+
+
+async def _still_current(db, kind: _Kind, obj: StoredObject) -> bool:
+    return bool(
+        await db.scalar(
+            text(f"SELECT count(*) FROM {kind.table} WHERE {_same_object(kind)}"),
+            _params(obj),
+        )
+    )
+
+
+def _params(obj: StoredObject) -> dict:
+    return {
+        "id": obj.id,
+        "owner": obj.owner_id,
+        "path": obj.storage_path,
+        "offset": obj.offset,
+    }
+
+
+async def _load_progress(db, kind: _Kind) -> ScrubProgress:
+    progress = await db.get(ScrubProgress, kind.name, with_for_update=True)
+    if progress is None:
+        await db.execute(
+            insert(ScrubProgress)
+            .values(
+                kind=kind.name,
+                last_owner_id=0,
+                last_id=0,
+                passes=0,
+                checked_objects=0,
+                checked_bytes=0,
+            )
+            .on_conflict_do_nothing()
+        )
+        progress = await db.get(ScrubProgress, kind.name, with_for_update=True)
+    return progress
+
+
+def _due(progress: ScrubProgress, now: datetime) -> bool:
+    if progress.pass_started_at is None or progress.pass_finished_at is None:
+        return True
+    if progress.pass_finished_at < progress.pass_started_at:
+        return True  # проход прерван — продолжаем
+    interval = timedelta(seconds=settings.SCRUB_INTERVAL_SECONDS)
+    return progress.pass_started_at + interval <= now
+
+
+async def _record(
+    db, kind: _Kind, checked: List[Tuple[StoredObject, Verdict]]
+) -> None:
+    ok_ids = [obj.id for obj, verdict in checked if verdict.status == "ok"]
+    if ok_ids:
+        await db.execute(
+            delete(ScrubFinding).where(
+                ScrubFinding.kind == kind.name, ScrubFinding.object_id.in_(ok_ids)
+            )
+        )
+    for obj, verdict in checked:
+        if verdict.digest is not None:
+            await db.execute(
+                text(
+                    f"UPDATE {kind.table} SET ciphertext_sha256 = :digest "
+                    f"WHERE {_same_object(kind)} AND ciphertext_sha256 IS NULL"
+                ),
+                {**_params(obj), "digest": verdict.digest},
+            )
+        if verdict.status == "ok":
+            continue
+        if not await _still_current(db, kind, obj):
+            continue  # объект удалили или перенесли, пока мы его читали
+        logger.error(
+            "Scrub: %s %s is %s (%s): %s",
+            kind.name,
+            obj.id,
+            verdict.status,
+            obj.storage_path,
+            verdict.detail,
+        )
+        values = {
+            "storage_path": obj.storage_path,
+            "status": verdict.status,
+            "detail": verdict.detail,
+            "last_seen_at": func.now(),
+        }
+        await db.execute(
+            insert(ScrubFinding)
+            .values(kind=kind.name, object_id=obj.id, owner_id=obj.owner_id, **values)
+            .on_conflict_do_update(index_elements=["kind", "object_id"], set_=values)
+        )
+
+
+async def scrub_kind(
+    kind: _Kind, budget: ByteBudget, limit: Optional[int] = None, force: bool = False
+) -> dict:
+    """Продолжаем (или начинаем, если пора) проход по одной таблице."""
+    stats = {"objects": 0, "bytes": 0, "corrupt": 0, "missing": 0, "finished": False}
+    while limit is None or stats["objects"] < limit:
+        batch_size = settings.SCRUB_BATCH_SIZE
+        if limit is not None:
+            batch_size = min(batch_size, limit - stats["objects"])
+        async with async_session() as db:
+            async with db.begin():
+                progress = await _load_progress(db, kind)
+                now = datetime.now(timezone.utc)
+                if progress.last_id == 0 and progress.last_owner_id == 0:
+                    if not force and not _due(progress, now):
+                        return stats
+                    progress.pass_started_at = now
+                    progress.checked_objects = 0
+                    progress.checked_bytes = 0
+                force = False
+                cursor = {"owner": progress.last_owner_id, "id": progress.last_id}
+        async with async_session() as db:
+            result = await db.execute(text(kind.query), {**cursor, "limit": batch_size})
+            objects = [StoredObject(*row) for row in result]
+
+        checked = []
+        for obj in objects:
+            verdict = await asyncio.to_thread(check_object, obj, budget)
+            checked.append((obj, verdict))
+            stats["objects"] += 1
+            stats["bytes"] += verdict.size
+            if verdict.status != "ok":
+                stats[verdict.status] += 1
+
+        async with async_session() as db:
+            async with db.begin():
+                progress = await _load_progress(db, kind)
+                await _record(db, kind, checked)
+                progress.checked_objects += len(checked)
+                progress.checked_bytes += sum(verdict.size for _, verdict in checked)
+                if len(objects) < batch_size:
+                    # Конец таблицы: записи, не подтвержденные за проход, сняты
+                    await db.execute(
+                        delete(ScrubFinding).where(
+                            ScrubFinding.kind == kind.name,
+                            ScrubFinding.last_seen_at < progress.pass_started_at,
+                        )
+                    )
+                    progress.last_owner_id = 0
+                    progress.last_id = 0
+                    progress.passes += 1
+                    progress.pass_finished_at = func.now()
+                    stats["finished"] = True
+                    return stats
+                last = objects[-1]
+                progress.last_owner_id = last.owner_id if kind.name == "files" else 0
+                progress.last_id = last.id
+    return stats
+
+
+async def scrub(
+    kinds: Optional[List[str]] = None, limit: Optional[int] = None, force: bool = False
+) -> dict:
+    """Проход по всем (или выбранным) таблицам, которым пора. Если обход уже
+    идет в другом воркере — пропускаем."""
+    stats = {"skipped": False}
+    async with get_engine().connect() as lock_conn:
+        locked = await lock_conn.scalar(
+            text("SELECT pg_try_advisory_lock(:key)"), {"key": SCRUB_LOCK_KEY}
+        )
+        await lock_conn.commit()
+        if not locked:
+            stats["skipped"] = True
+            return stats
+        try:
+            budget = ByteBudget(settings.SCRUB_BYTES_PER_SECOND)
+            for name in kinds or KINDS_BY_NAME:
+                kind = KINDS_BY_NAME[name]
+                stats[name] = await scrub_kind(kind, budget, limit, force)
+        finally:
+            await lock_conn.execute(
+                text("SELECT pg_advisory_unlock(:key)"), {"key": SCRUB_LOCK_KEY}
+            )
+            await lock_conn.commit()
+    return stats
+
+
+async def scrub_loop() -> None:
+    """Фоновый обход, запускается при старте приложения."""
+    while True:
+        try:
+            await scrub()
+        except Exception:  # noqa: BLE001
+            logger.exception("Scrub failed")
+        # Незаконченный проход продолжится после паузы (например, в другом
+        # воркере, если этот перезапустили)
+        await asyncio.sleep(60)
+
+
+# --- Метрики и статус --------------------------------------------------------
+
+
+async def _state() -> Tuple[List[ScrubProgress], List[Tuple[str, str, int]]]:
+    async with read_session() as db:
+        result = await db.execute(select(ScrubProgress).order_by(ScrubProgress.kind))
+        progress = list(result.scalars().all())
+        result = await db.execute(
+            select(ScrubFinding.kind, ScrubFinding.status, func.count()).group_by(
+                ScrubFinding.kind, ScrubFinding.status
+            )
+        )
+        findings = [(row[0], row[1], row[2]) for row in result]
+    return progress, findings
+
+
+@metrics.register
+async def _collect() -> List[metrics.Metric]:
+    progress, findings = await _state()
+    counts = {
+        (kind, status_): 0
+        for kind in KINDS_BY_NAME
+        for status_ in ("corrupt", "missing")
+    }
+    counts.update({(kind, status_): count for kind, status_, count in findings})
+    return [
+        metrics.Metric(
+            "cypher_scrub_objects",
+            "Stored objects that failed the last integrity check",
+            "gauge",
+            [
+                ({"kind": kind, "status": status_}, count)
+                for (kind, status_), count in counts.items()
+            ],
+        ),
+        metrics.Metric(
+            "cypher_scrub_passes_total",
+            "Completed scrub passes",
+            "counter",
+            [({"kind": row.kind}, row.passes) for row in progress],
+        ),
+        metrics.Metric(
+            "cypher_scrub_pass_checked_bytes",
+            "Bytes verified in the current scrub pass",
+            "gauge",
+            [({"kind": row.kind}, row.checked_bytes) for row in progress],
+        ),
+        metrics.Metric(
+            "cypher_scrub_pass_checked_objects",
+            "Objects verified in the current scrub pass",
+            "gauge",
+            [({"kind": row.kind}, row.checked_objects) for row in progress],
+        ),
+        metrics.Metric(
+            "cypher_scrub_last_pass_finished_timestamp_seconds",
+            "Time the last complete scrub pass finished",
+            "gauge",
+            [
+                ({"kind": row.kind}, row.pass_finished_at.timestamp())
+                for row in progress
+                if row.pass_finished_at is not None
+            ],
+        ),
+    ]
+
+
+async def _print_status() -> None:
+    progress, findings = await _state()
+    for row in progress:
+        print(
+            f"{row.kind}: passes={row.passes} position=({row.last_owner_id}, "
+            f"{row.last_id}) checked={row.checked_objects} objects/"
+            f"{row.checked_bytes} bytes started={row.pass_started_at} "
+            f"finished={row.pass_finished_at}"
+        )
+    for kind, status_, count in findings:
+        print(f"{kind} {status_}: {count}")
+
+
+async def _main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Cypher Cloud integrity scrubber")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run = sub.add_parser("run", help="продолжить или начать проход")
+    run.add_argument("--kind", choices=list(KINDS_BY_NAME), action="append")
+    run.add_argument("--limit", type=int, default=None, help="объектов на таблицу")
+    run.add_argument(
+        "--force",
+        action="store_true",
+        help="начать новый проход, не дожидаясь интервала",
+    )
+    sub.add_parser("status", help="позиция обхода и найденные проблемы")
+    args = parser.parse_args(argv)
+    try:
+        if args.command == "run":
+            print(await scrub(args.kind, args.limit, args.force))
+        else:
+            await _print_status()
+    finally:
+        await dispose_engines()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    asyncio.run(_main())
@@ -0,0 +1,585 @@
+"""Публичные ссылки на файлы без обращения к БД при проверке.
+
+Ссылка — JWT (HS256) с id файла, владельцем, сроком действия и, при
+необходимости, версией и разрешенным диапазоном байт. Подпись — ключом из
+набора в Vault (`share/keys`), id ключа лежит в заголовке `kid`. Текущий ключ
+заменяется раз в `SHARE_KEY_ROTATION_SECONDS` (первым это делает любой
+воркер, запись через check-and-set); прежние ключи хранятся, пока не истекут
+подписанные ими ссылки. Набор ключей кэшируется в процессе.
+
+Отзыв — через компактный deny-list `share_revocations`: отдельные ссылки (по
+`jti`) и все ссылки на файл, выданные до момента отзыва. Воркер перечитывает
+список раз в `SHARE_DENYLIST_REFRESH_SECONDS`, поэтому отзыв на других
+воркерах срабатывает с этой задержкой. Строки живут, пока не истекут сами
+отозванные ссылки.
+
+Досрочная смена ключа (все ссылки, подписанные прежними ключами, остаются
+действительными до своего срока):
+
+    python -m cypher_cloud.sharing rotate-key
+
+Так `/share/{token}` проверяет ссылку без запросов к БД. Где лежит
+содержимое файла и его ключ, берется из кэша на `SHARE_CACHE_SECONDS`, а при
+промахе — одним запросом к `files` (по индексу владельца, users не
+читается) и Vault. Из-за кэша переименование или новая версия видны по
+ссылке с той же задержкой.
+"""
+
+import argparse
+import asyncio
+import re
+import secrets
+import time
+import urllib.parse
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, status
+from fastapi.responses import StreamingResponse
+from jose import JWTError, jwt
+from sqlalchemy import delete, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from starlette.background import BackgroundTask
+
+from cypher_cloud.auth import get_current_user
+from cypher_cloud.config import settings
+from cypher_cloud.database import get_db, read_session
+from cypher_cloud.models import File as FileModel
+from cypher_cloud.models import ShareRevocation, User
+from cypher_cloud.packing import segment_key
+from cypher_cloud.profiling import span
+from cypher_cloud.ratelimit import enforce
+from cypher_cloud.schemas import ShareCreate, ShareLink, ShareRevoke
+from cypher_cloud.storage import Block, stream_decrypted
+from cypher_cloud.vault_client import fetch_file_key, fetch_secret, store_secret
+from cypher_cloud.versions import Content, resolve_content
+
+router = APIRouter()
+public_router = APIRouter()
+
+SHARE_KEYS_PATH = "share/keys"
+SHARE_ALGORITHM = "HS256"
+# Неизвестный kid перечитывает набор ключей не чаще раза в N секунд
+UNKNOWN_KID_RELOAD_SECONDS = 10
+
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+# --- Набор ключей подписи ----------------------------------------------------
+
+
+class KeyRing(NamedTuple):
+    current: str
+    keys: Dict[str, str]  # kid -> секрет
+    loaded_at: float
+
+
+_ring: Optional[KeyRing] = None
+_ring_lock = asyncio.Lock()
+
+
+def _rotated(data: Optional[dict], now: float) -> dict:
+    """Новый текущий ключ; прежние остаются, пока живут их ссылки."""
+    keys = dict((data or {}).get("keys", {}))
+    if data:
+        keys[data["current"]] = {**keys[data["current"]], "retired": now}
+    keys = {
+        kid: key
+        for kid, key in keys.items()
+        if key.get("retired", now) > now - settings.SHARE_MAX_TTL_SECONDS
+    }
+    kid = secrets.token_hex(4)
+    keys[kid] = {"secret": secrets.token_urlsafe(32), "created": now}
+    return {"current": kid, "keys": keys}
+
+
+def _needs_rotation(data: Optional[dict], now: float) -> bool:
+    if not data:
+        return True
+    created = data["keys"][data["current"]]["created"]
+    return now - created > settings.SHARE_KEY_ROTATION_SECONDS
+
+
+async def rotate_keys(force: bool = False) -> KeyRing:
+    """Перечитываем набор ключей из Vault, при необходимости меняем текущий."""
+    global _ring
+    now = time.time()
+    data, version = await fetch_secret(SHARE_KEYS_PATH)
+    if force or _needs_rotation(data, now):
+        # Если запись не прошла, ключ только что сменил другой воркер
+        await store_secret(SHARE_KEYS_PATH, _rotated(data, now), cas=version)
+        data, _ = await fetch_secret(SHARE_KEYS_PATH)
+    _ring = KeyRing(
+        data["current"],
+        {kid: key["secret"] for kid, key in data["keys"].items()},
+        time.monotonic(),
+    )
+    return _ring
+
+
+async def _key_ring(kid: Optional[str] = None) -> KeyRing:
+    ring = _ring
+    age = time.monotonic() - ring.loaded_at if ring else None
+    if (
+        ring is not None
+        and age < settings.SHARE_KEY_REFRESH_SECONDS
+        and (kid is None or kid in ring.keys or age < UNKNOWN_KID_RELOAD_SECONDS)
+    ):
+        return ring
+    async with _ring_lock:
+        if _ring is not ring:
+            return _ring
+        return await rotate_keys()
+
+
+# --- Deny-list ---------------------------------------------------------------
+
+
+class DenyList(NamedTuple):
+    jtis: Set[str]
+    files: Dict[int, float]  # file_id -> отозваны ссылки, выданные не позже
+    loaded_at: float
+
+
+_deny: Optional[DenyList] = None
+_deny_lock = asyncio.Lock()
+
+
+async def _load_denylist() -> DenyList:
+    global _deny
+    async with read_session() as db:
+        with span("db"):
+            result = await db.execute(
+                select(
+                    ShareRevocation.jti,
+                    ShareRevocation.file_id,
+                    func.extract("epoch", ShareRevocation.revoked_at),
+                ).where(ShareRevocation.expires_at > func.now())
+            )
+            rows = result.all()
+    jtis: Set[str] = set()
+    files: Dict[int, float] = {}
+    for jti, file_id, revoked_at in rows:
+        if jti is not None:
+            jtis.add(jti)
+        else:
+            files[file_id] = max(files.get(file_id, 0.0), float(revoked_at))
+    _deny = DenyList(jtis, files, time.monotonic())
+    return _deny
+
+
+async def _denylist() -> DenyList:
+    deny = _deny
+    if deny is not None and (
+        time.monotonic() - deny.loaded_at < settings.SHARE_DENYLIST_REFRESH_SECONDS
+    ):
+        return deny
+    async with _deny_lock:
+        if _deny is not deny:
+            return _deny
+        return await _load_denylist()
+
+
+def _is_revoked(deny: DenyList, claims: dict) -> bool:
+    if claims["jti"] in deny.jtis:
+        return True
+    revoked_at = deny.files.get(claims["fid"])
+    return revoked_at is not None and claims["iat"] <= revoked_at
+
+
+# --- Токены ------------------------------------------------------------------
+
+
+async def issue_token(
+    owner_id: int,
+    file_id: int,
+    expires_in: int,
+    version: Optional[int] = None,
+    byte_range: Optional[Tuple[int, int]] = None,
+) -> Tuple[str, dict]:
+    ring = await _key_ring()
+    now = int(time.time())
+    claims = {
+        "typ": "share",
+        "jti": uuid.uuid4().hex,
+        "sub": str(owner_id),
+        "fid": file_id,
+        "iat": now,
+        "exp": now + expires_in,
+    }
+    if version is not None:
+        claims["ver"] = version
+    if byte_range is not None:
+        claims["rng"] = list(byte_range)
+    token = jwt.encode(
+        claims,
+        ring.keys[ring.current],
+        algorithm=SHARE_ALGORITHM,
+        headers={"kid": ring.current},
+    )
+    return token, claims
+
+
+async def verify_token(token: str) -> Optional[dict]:
+    """Проверка подписи, срока и deny-list; без запросов к БД (кроме
+    периодического обновления deny-list)."""
+    try:
+        kid = jwt.get_unverified_header(token).get("kid")
+        ring = await _key_ring(kid)
+        if kid not in ring.keys:
+            return None
+        with span("auth"):
+            claims = jwt.decode(token, ring.keys[kid], algorithms=[SHARE_ALGORITHM])
+    except JWTError:
+        return None
+    if claims.get("typ") != "share":
+        return None
+    if _is_revoked(await _denylist(), claims):
+        return None
+    return claims
+
+
+# --- Кэш содержимого ---------------------------------------------------------
+
+
+class SharedContent(NamedTuple):
+    filename: str
+    content: Content
+    key: bytes
+    expires_at: float
+
+
+_contents: "OrderedDict[Tuple[int, int, Optional[int]], SharedContent]" = OrderedDict()
+
+
+async def _load_content(
+    owner_id: int, file_id: int, version: Optional[int]
+) -> Optional[SharedContent]:
+    async with read_session() as db:
+        with span("db"):
+            result = await db.execute(
+                select(FileModel).where(
+                    FileModel.owner_id == owner_id, FileModel.id == file_id
+                )
+            )
+            db_file = result.scalars().first()
+        if db_file is None:
+            return None
+        content = await resolve_content(db, db_file, version)
+    if content is None:
+        return None
+    if content.segment_offset is not None:
+        key = await segment_key(content.vault_key_path)
+    else:
+        key = (await fetch_file_key(content.vault_key_path)).encode()
+    return SharedContent(
+        db_file.filename, content, key, time.monotonic() + settings.SHARE_CACHE_SECONDS
+    )
+
+
+async def _shared_content(
+    owner_id: int, file_id: int, version: Optional[int]
+) -> Optional[SharedContent]:
+    cache_key = (owner_id, file_id, version)
+    shared = _contents.get(cache_key)
+    if shared is not None and shared.expires_at > time.monotonic():
+        _contents.move_to_end(cache_key)
+        return shared
+    shared = await _load_content(owner_id, file_id, version)
+    if shared is None:
+        _contents.pop(cache_key, None)
+        return None
+    _contents[cache_key] = shared
+    if len(_contents) > settings.SHARE_CACHE_SIZE:
+        _contents.popitem(last=False)
+    return shared
+
+
+def _select_chunks(
+    paths: List[str], sizes: List[int], start: int, end: int
+) -> Tuple[List[Block], int]:
+    """Чанки, пересекающие [start, end), и сколько байт пропустить в первом."""
+    blocks: List[Block] = []
+    skip = 0
+    offset = 0
+    for path, size in zip(paths, sizes):
+        if offset >= end:
+            break
+        if offset + size > start:
+            if not blocks:
+                skip = start - offset
+            blocks.append(Block(path))
+        offset += size
+    return blocks, skip
+
+
+async def _trim(
+    body: AsyncIterator[memoryview], skip: int, length: int
+) -> AsyncIterator[memoryview]:
+    """Поток без первых `skip` байт и не длиннее `length`: срезаются только
+    крайние куски, остальные отдаются как есть."""
+    try:
+        async for view in body:
+            if length <= 0:
+                break
+            if skip >= len(view):
+                skip -= len(view)
+                continue
+            view = view[skip : skip + length]
+            skip = 0
+            length -= len(view)
+            yield view
+    finally:
+        # Лишние блоки за концом окна не дочитываются
+        await body.aclose()
+
+
+class _Opened(NamedTuple):
+    body: AsyncIterator[memoryview]
+    size: int  # размер окна ссылки, от него считается Range
+    requested: Optional[Tuple[int, int]]
+
+
+async def _open(
+    shared: SharedContent, window: Optional[List[int]], range_: Optional[str]
+) -> _Opened:
+    """Открытый текст окна ссылки или Range клиента внутри него. Из чанковой
+    версии читаются только чанки, пересекающие нужные байты; цельный
+    шифротекст — один токен Fernet, он расшифровывается целиком."""
+    content = shared.content
+    decrypted = None
+    if content.chunk_paths is None:
+        block = Block(
+            content.storage_path, content.segment_offset, content.segment_length
+        )
+        decrypted = await stream_decrypted([block], shared.key)
+        size = decrypted.size
+    else:
+        size = sum(content.chunk_sizes)
+
+    # Окно, разрешенное ссылкой; Range клиента — относительно него
+    low, high = 0, size
+    if window is not None:
+        low, high = min(window[0], size), min(window[1], size)
+    try:
+        requested = _parse_range(range_, high - low)
+    except HTTPException:
+        if decrypted is not None:
+            await decrypted.body.aclose()
+        raise
+    start, end = requested or (0, high - low)
+    start, end = low + start, low + end
+
+    if decrypted is None:
+        blocks, skip = _select_chunks(
+            content.chunk_paths, content.chunk_sizes, start, end
+        )
+        decrypted = await stream_decrypted(
+            blocks, shared.key, settings.DOWNLOAD_READ_AHEAD
+        )
+    else:
+        skip = start
+    return _Opened(_trim(decrypted.body, skip, end - start), high - low, requested)
+
+
+def _parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Один диапазон `bytes=a-b` -> [start, end); None — весь ответ."""
+    if not header:
+        return None
+    match = _RANGE.match(header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first == "":
+        start, end = max(size - int(last), 0), size
+    else:
+        start = int(first)
+        end = min(int(last) + 1, size) if last else size
+    if start >= size or start >= end:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+    return start, end
+
+
+# --- Эндпоинты ---------------------------------------------------------------
+
+
+@router.post("/{file_id}/share", response_model=ShareLink)
+async def create_share_link(
+    file_id: int,
+    req: ShareCreate,
+    db: AsyncSession = Depends(get_db),
+    user: User = Depends(get_current_user),
+):
+    expires_in = req.expires_in or settings.SHARE_DEFAULT_TTL_SECONDS
+    if expires_in > settings.SHARE_MAX_TTL_SECONDS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Максимальный срок ссылки: {settings.SHARE_MAX_TTL_SECONDS} с",
+        )
+    byte_range = None
+    if req.range_start is not None or req.range_end is not None:
+        start = req.range_start or 0
+        if req.range_end is None or req.range_end <= start:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Диапазон задается как [range_start, range_end)",
+            )
+        byte_range = (start, req.range_end)
+
+    with span("db"):
+        result = await db.execute(
+            select(FileModel).where(
+                FileModel.owner_id == user.id, FileModel.id == file_id
+            )
+        )
+        db_file = result.scalars().first()
+    if not db_file:
+        raise HTTPException(404, "File not found")
+    if req.version is not None and await resolve_content(db, db_file, req.version) is None:
+        raise HTTPException(404, "Version not found")
+
+    token, claims = await issue_token(
+        user.id, file_id, expires_in, req.version, byte_range
+    )
+    return ShareLink(
+        token=token,
+        url=f"{settings.NEXT_PUBLIC_BASE_URL.rstrip('/')}/share/{token}",
+        jti=claims["jti"],
+        expires_at=datetime.fromtimestamp(claims["exp"], timezone.utc),
+    )
+
+
+async def _revoke(db: AsyncSession, revocation: ShareRevocation) -> None:
+    global _deny
+    with span("db"):
+        await db.execute(
+            delete(ShareRevocation).where(ShareRevocation.expires_at < func.now())
+        )
+        db.add(revocation)
+        await db.commit()
+    # На этом воркере — сразу, на остальных — при следующем обновлении
+    _deny = None
+
+
+@router.post("/share/revoke")
+async def revoke_share_link(
+    req: ShareRevoke,
+    db: AsyncSession = Depends(get_db),
+    user: User = Depends(get_current_user),
+):
+    claims = await verify_token(req.token)
+    if claims is None:
+        # Недействительная или уже отозванная ссылка
+        return {"status": "ok"}
+    if claims["sub"] != str(user.id):
+        raise HTTPException(404, "Share link not found")
+    await _revoke(
+        db,
+        ShareRevocation(
+            owner_id=user.id,
+            jti=claims["jti"],
+            expires_at=datetime.fromtimestamp(claims["exp"], timezone.utc),
+        ),
+    )
+    return {"status": "ok"}
+
+
+@router.delete("/{file_id}/share")
+async def revoke_file_share_links(
+    file_id: int,
+    db: AsyncSession = Depends(get_db),
+    user: User = Depends(get_current_user),
+):
+    """Отзываем все ссылки на файл, выданные до этого момента."""
+    with span("db"):
+        exists = await db.scalar(
+            select(FileModel.id).where(
+                FileModel.owner_id == user.id, FileModel.id == file_id
+            )
+        )
+    if not exists:
+        raise HTTPException(404, "File not found")
+    now = datetime.now(timezone.utc)
+    await _revoke(
+        db,
+        ShareRevocation(
+            owner_id=user.id,
+            file_id=file_id,
+            # Время приложения: с ним сравнивается iat ссылок
+            revoked_at=now,
+            expires_at=now + timedelta(seconds=settings.SHARE_MAX_TTL_SECONDS),
+        ),
+    )
+    return {"status": "ok"}
+
+
+@public_router.get("/{token}")
+async def download_shared_file(
+    token: str,
+    request: Request,
+    range_: Optional[str] = Header(None, alias="Range"),
+):
+    # Ссылка публичная: аккаунта нет, лимит — по IP
+    await enforce(request, "transfer")
+    claims = await verify_token(token)
+    if claims is None:
+        raise HTTPException(404, "Ссылка недействительна или истекла")
+    owner_id, file_id = int(claims["sub"]), claims["fid"]
+    version = claims.get("ver")
+    window = claims.get("rng")
+
+    shared = await _shared_content(owner_id, file_id, version)
+    if shared is None:
+        raise HTTPException(404, "File not found")
+    try:
+        opened = await _open(shared, window, range_)
+    except FileNotFoundError:
+        # Содержимое заменили или удалили, пока запись лежала в кэше
+        _contents.pop((owner_id, file_id, version), None)
+        shared = await _shared_content(owner_id, file_id, version)
+        if shared is None:
+            raise HTTPException(404, "File not found")
+        opened = await _open(shared, window, range_)
+
+    safe_filename = urllib.parse.quote(shared.filename)
+    headers = {
+        "Content-Disposition": f"attachment; filename*=UTF-8''{safe_filename}",
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "private, no-cache",
+    }
+    status_code = status.HTTP_200_OK
+    length = opened.size
+    if opened.requested is not None:
+        start, end = opened.requested
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{opened.size}"
+        status_code = status.HTTP_206_PARTIAL_CONTENT
+        length = end - start
+    headers["Content-Length"] = str(length)
+    # Starlette при обрыве клиента не закрывает генератор тела — закрываем
+    # его фоновой задачей ответа, она выполняется и после обрыва
+    return StreamingResponse(
+        opened.body,
+        status_code=status_code,
+        media_type="application/octet-stream",
+        headers=headers,
+        background=BackgroundTask(opened.body.aclose),
+    )
+
+
+async def _main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Cypher Cloud share links")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("rotate-key", help="сменить ключ подписи досрочно")
+    parser.parse_args(argv)
+    ring = await rotate_keys(force=True)
+    print(f"current key: {ring.current}, keys: {len(ring.keys)}")
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -0,0 +1,404 @@
+"""Шифротекст на локальном диске (каталог FILES_DIR).
+
+Файл пишется во временный рядом с итоговым (с предвыделением места через
+`posix_fallocate`) и атомарно переименовывается, поэтому под итоговым
+именем никогда не бывает недописанного файла. Строка в БД коммитится только
+после того, как запись стала durable, — в зависимости от
+`STORAGE_DURABILITY`:
+
+- `none` — без fsync (данные в page cache, после падения ОС файл может
+  оказаться пустым или обрезанным);
+- `batch` — групповой коммит: параллельные загрузки ждут один общий
+  `syncfs` файловой системы FILES_DIR вместо fsync на каждый файл;
+- `always` — fsync файла и каталога на каждую запись.
+"""
+
+import asyncio
+import ctypes
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import AsyncIterator, Iterable, List, NamedTuple, Optional, Sequence
+
+import aiofiles
+from cryptography.fernet import Fernet
+
+from cypher_cloud.config import settings
+from cypher_cloud.profiling import span
+
+logger = logging.getLogger(__name__)
+
+FILES_DIR = "files"
+
+OFFLOAD_CRYPTO_SIZE = 256 * 1024
+
+# Кусок открытого текста на одну запись в сокет
+SEND_BLOCK_SIZE = 1024 * 1024
+
+# Временный файл старше этого точно брошен: запись идет секунды
+STALE_TMP_SECONDS = 3600
+
+
+def _load_syncfs():
+    try:
+        return ctypes.CDLL(None, use_errno=True).syncfs
+    except (OSError, AttributeError):
+        return None
+
+
+_syncfs = _load_syncfs()
+
+
+def _sync_filesystem() -> None:
+    """Сбрасываем на диск все грязные данные и метаданные ФС каталога FILES_DIR."""
+    if _syncfs is None:
+        os.sync()
+        return
+    fd = os.open(FILES_DIR, os.O_RDONLY)
+    try:
+        if _syncfs(fd) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+    finally:
+        os.close(fd)
+
+
+def fsync_directory(path: str) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class FsyncBatcher:
+    """Групповой коммит: все, кто вызвал `sync()` во время идущего сброса,
+    ждут следующего — одного на всех."""
+
+    def __init__(self, delay: float = 0.0) -> None:
+        self.delay = delay
+        self._next: Optional[asyncio.Future] = None
+        self._running = False
+        self.flushes = 0
+
+    async def sync(self) -> None:
+        if self._next is None:
+            self._next = asyncio.get_running_loop().create_future()
+            if not self._running:
+                self._running = True
+                asyncio.create_task(self._run())
+        # shield: отмена одного ожидающего не отменяет общий сброс
+        await asyncio.shield(self._next)
+
+    async def _run(self) -> None:
+        try:
+            while self._next is not None:
+                if self.delay:
+                    await asyncio.sleep(self.delay)  # даем набраться пачке
+                waiters, self._next = self._next, None
+                try:
+                    await asyncio.to_thread(_sync_filesystem)
+                    self.flushes += 1
+                except BaseException as exc:  # noqa: BLE001
+                    logger.exception("Failed to sync %s", FILES_DIR)
+                    waiters.set_exception(exc)
+                else:
+                    waiters.set_result(None)
+        finally:
+            self._running = False
+
+
+_batcher: Optional[FsyncBatcher] = None
+
+
+def get_batcher() -> FsyncBatcher:
+    global _batcher
+    if _batcher is None:
+        _batcher = FsyncBatcher(settings.FSYNC_BATCH_DELAY_MS / 1000)
+    return _batcher
+
+
+async def sync_writes() -> None:
+    """Дожидаемся durability записей, сделанных с `durable=False`."""
+    if settings.STORAGE_DURABILITY == "batch":
+        with span("io"):
+            await get_batcher().sync()
+
+
+def _write_file(path: str, data: bytes) -> str:
+    tmp_path = f"{path}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    try:
+        try:
+            os.posix_fallocate(fd, 0, len(data))
+        except (AttributeError, OSError):
+            pass  # ФС без fallocate (tmpfs старых ядер, NFS) — пишем как есть
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view) :]
+        if settings.STORAGE_DURABILITY == "always":
+            os.fsync(fd)
+        os.close(fd)
+        fd = -1
+        os.rename(tmp_path, path)
+    except BaseException:
+        if fd != -1:
+            os.close(fd)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    if settings.STORAGE_DURABILITY == "always":
+        fsync_directory(os.path.dirname(path) or ".")
+    return hashlib.sha256(data).hexdigest()
+
+
+async def write_file(path: Path, data: bytes, durable: bool = True) -> str:
+    """Атомарная запись файла; возвращаем SHA-256 записанного (для scrub.py).
+    С `durable=False` вызывающий сам ждет `sync_writes()` перед коммитом —
+    так файлы одного запроса ждут один сброс."""
+    with span("io"):
+        digest = await asyncio.to_thread(_write_file, str(path), data)
+    if durable:
+        await sync_writes()
+    return digest
+
+
+class ByteBudget:
+    """Ограничение скорости фонового чтения (проверка, ротация ключей):
+    `consume` — из рабочего потока, `acquire` — из event loop."""
+
+    def __init__(self, bytes_per_second: int) -> None:
+        self.bytes_per_second = bytes_per_second
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def _delay(self, size: int) -> float:
+        if self.bytes_per_second <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now)
+            self._next = start + size / self.bytes_per_second
+        return start - now
+
+    def consume(self, size: int) -> None:
+        delay = self._delay(size)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire(self, size: int) -> None:
+        delay = self._delay(size)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def prepare_storage() -> None:
+    """Создаем FILES_DIR; вызывается при старте приложения, а не при импорте."""
+    os.makedirs(FILES_DIR, exist_ok=True)
+
+
+def remove_stale_tmp(max_age: float = STALE_TMP_SECONDS) -> int:
+    """Удаляем `*.tmp`, оставшиеся от записей, прерванных падением процесса.
+    Свежие не трогаем: их может прямо сейчас дописывать другой воркер."""
+    removed = 0
+    deadline = time.time() - max_age
+    with os.scandir(FILES_DIR) as entries:
+        for entry in entries:
+            if not entry.name.endswith(".tmp"):
+                continue
+            try:
+                if entry.stat().st_mtime < deadline:
+                    os.remove(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                pass  # запись успела завершиться переименованием
+            except OSError as exc:
+                logger.warning("Failed to remove %s: %s", entry.path, exc)
+    if removed:
+        logger.warning("Removed %d stale temporary files from %s", removed, FILES_DIR)
+    return removed
+
+
+def new_storage_path(user_id: int, suffix: str) -> Path:
+    """Безопасное имя файла на диске, не зависящее от присланного имени."""
+    timestamp = int(time.time())
+    return Path(FILES_DIR) / f"{user_id}_{timestamp}_{uuid.uuid4().hex[:8]}{suffix}"
+
+
+async def encrypt(key: bytes, content: bytes) -> bytes:
+    """Крупные файлы шифруем вне event loop (OpenSSL отпускает GIL)."""
+    with span("crypto"):
+        if len(content) < OFFLOAD_CRYPTO_SIZE:
+            return Fernet(key).encrypt(content)
+        return await asyncio.to_thread(Fernet(key).encrypt, content)
+
+
+async def write_encrypted(
+    storage_path: Path, key: bytes, content: bytes, durable: bool = True
+) -> str:
+    """Возвращаем SHA-256 шифротекста."""
+    encrypted_content = await encrypt(key, content)
+    return await write_file(storage_path, encrypted_content, durable)
+
+
+async def read_decrypted(
+    storage_path: str,
+    key: bytes,
+    offset: Optional[int] = None,
+    length: Optional[int] = None,
+) -> bytes:
+    """Читаем и расшифровываем файл целиком или запись внутри сегмента."""
+    with span("io"):
+        async with aiofiles.open(storage_path, "rb") as f_in:
+            if offset is None:
+                encrypted_content = await f_in.read()
+            else:
+                await f_in.seek(offset)
+                encrypted_content = await f_in.read(length)
+    with span("crypto"):
+        return Fernet(key).decrypt(encrypted_content)
+
+
+class Block(NamedTuple):
+    """Один токен Fernet: файл целиком, чанк или запись внутри сегмента."""
+
+    storage_path: str
+    offset: Optional[int] = None
+    length: Optional[int] = None
+
+
+def _read_block(block: Block) -> bytes:
+    fd = os.open(block.storage_path, os.O_RDONLY)
+    try:
+        offset = block.offset or 0
+        length = block.length
+        if length is None:
+            length = os.fstat(fd).st_size - offset
+        try:
+            # Окно readahead ядра для файла удваивается
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_SEQUENTIAL)
+        except (AttributeError, OSError):
+            pass
+        parts: List[bytes] = []
+        while length > 0:
+            # pread отдает не больше ~2 ГиБ за вызов
+            part = os.pread(fd, length, offset)
+            if not part:
+                break
+            parts.append(part)
+            offset += len(part)
+            length -= len(part)
+    finally:
+        os.close(fd)
+    return parts[0] if len(parts) == 1 else b"".join(parts)
+
+
+_DONE = object()
+
+
+class _DecryptPipeline:
+    """Чтение и расшифровка идут в своих задачах (работа — в потоках) и
+    опережают отдачу не больше чем на `read_ahead` блоков на каждой стадии.
+    Поток ответа тогда упирается в самую медленную стадию, а не в их сумму.
+    Ошибка стадии передается дальше по очереди и поднимается у читателя."""
+
+    def __init__(self, blocks: Sequence[Block], key: bytes, read_ahead: int) -> None:
+        self._blocks = blocks
+        self._fernet = Fernet(key)
+        self._tokens: asyncio.Queue = asyncio.Queue(max(1, read_ahead))
+        self._plain: asyncio.Queue = asyncio.Queue(max(1, read_ahead))
+        self._tasks = [
+            asyncio.create_task(self._read()),
+            asyncio.create_task(self._decrypt()),
+        ]
+
+    async def _read(self) -> None:
+        try:
+            for block in self._blocks:
+                with span("io"):
+                    token = await asyncio.to_thread(_read_block, block)
+                await self._tokens.put(token)
+        except Exception as exc:  # noqa: BLE001
+            await self._tokens.put(exc)
+            return
+        await self._tokens.put(_DONE)
+
+    async def _decrypt(self) -> None:
+        while True:
+            token = await self._tokens.get()
+            if token is _DONE or isinstance(token, Exception):
+                await self._plain.put(token)
+                return
+            try:
+                with span("crypto"):
+                    if len(token) < OFFLOAD_CRYPTO_SIZE:
+                        data = self._fernet.decrypt(token)
+                    else:
+                        data = await asyncio.to_thread(self._fernet.decrypt, token)
+            except Exception as exc:  # noqa: BLE001
+                await self._plain.put(exc)
+                return
+            await self._plain.put(data)
+
+    async def next(self) -> Optional[bytes]:
+        """Следующий расшифрованный блок; None — блоки кончились."""
+        item = await self._plain.get()
+        if item is _DONE:
+            return None
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    async def aclose(self) -> None:
+        """Останавливает обе стадии и дожидается их: после обрыва клиента
+        задачи не должны дочитывать и расшифровывать блоки в пустоту."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.wait(self._tasks)
+
+
+class Decrypted(NamedTuple):
+    body: AsyncIterator[memoryview]
+    # Точный размер открытого текста, если он уже известен (один блок)
+    size: Optional[int]
+
+
+async def _drain(
+    pipeline: _DecryptPipeline, data: Optional[bytes]
+) -> AsyncIterator[memoryview]:
+    try:
+        while data is not None:
+            # Срезы memoryview не копируют открытый текст
+            view = memoryview(data)
+            for start in range(0, len(view), SEND_BLOCK_SIZE):
+                yield view[start : start + SEND_BLOCK_SIZE]
+            data = await pipeline.next()
+    finally:
+        await pipeline.aclose()
+
+
+async def stream_decrypted(
+    blocks: Sequence[Block], key: bytes, read_ahead: int = 1
+) -> Decrypted:
+    """Открытый текст блоков по порядку через конвейер чтение -> расшифровка
+    -> отдача. Первый блок дожидаемся здесь: ошибка чтения или ключа видна
+    до заголовков ответа, а не как оборванная отдача."""
+    pipeline = _DecryptPipeline(blocks, key, read_ahead)
+    try:
+        first = await pipeline.next()
+    except BaseException:
+        await pipeline.aclose()
+        raise
+    size = len(first) if len(blocks) == 1 and first is not None else None
+    return Decrypted(_drain(pipeline, first), size)
+
+
+def remove_stored(paths: Iterable[str]) -> None:
+    with span("io"):
+        for path in paths:
+            if path and os.path.exists(path):
+                os.remove(path)
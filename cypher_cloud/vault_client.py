@@ -1,40 +1,305 @@
+"""Клиент Vault KV v2 с таймаутом, очередью и предохранителем.
+
+Запросы выполняются в собственном пуле из `VAULT_MAX_CONCURRENCY` потоков,
+поэтому зависший Vault не занимает потоки event loop по умолчанию. Ждать
+свободного потока могут не больше `VAULT_MAX_WAITING` запросов, остальные
+сразу получают 503. Запрос дольше `VAULT_TIMEOUT_SECONDS`, обрыв соединения
+и ответы 5xx/429 считаются отказами. После `VAULT_BREAKER_FAILURES` отказов
+подряд предохранитель размыкается: `VAULT_BREAKER_RESET_SECONDS` все вызовы
+сразу получают 503 с `Retry-After`. Затем проходит один пробный запрос:
+успех замыкает предохранитель, отказ снова его размыкает.
+"""
+
 import asyncio
 import logging
-from typing import Optional
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, Optional, Tuple, TypeVar
 
-import hvac
+from fastapi import HTTPException, status
 
+from cypher_cloud import metrics
 from cypher_cloud.config import settings
+from cypher_cloud.profiling import span
+
+# hvac импортируется вместе с первым клиентом: импорт занимает ~0.2 с
+if TYPE_CHECKING:
+    import hvac
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+_client: Optional["hvac.Client"] = None
+_client_lock = threading.Lock()
+
 
-def _create_client() -> hvac.Client:
-    client = hvac.Client(url=settings.vault_addr, token=settings.vault_token)
+def _create_client() -> "hvac.Client":
+    import hvac
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    # Пул keep-alive соединений по числу потоков Vault: по умолчанию в нем
+    # 10 соединений, лишние потоки открывали бы и закрывали свои
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=settings.VAULT_MAX_CONCURRENCY)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    client = hvac.Client(
+        url=settings.vault_addr,
+        token=settings.vault_token,
+        timeout=settings.VAULT_TIMEOUT_SECONDS,
+        session=session,
+    )
     if not client.is_authenticated():
         raise RuntimeError("Failed to authenticate with Vault")
     return client
 
 
+def _get_client() -> "hvac.Client":
+    """Один клиент на процесс: его requests.Session держит keep-alive
+    соединения, так что ключ — это один HTTP-запрос, без нового соединения
+    и проверки токена."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = _create_client()
+        return _client
+
+
+class VaultUnavailable(HTTPException):
+    """Vault не отвечает или предохранитель разомкнут: 503 с Retry-After."""
+
+    def __init__(self, retry_after: float) -> None:
+        super().__init__(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Хранилище ключей временно недоступно",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
+
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+
+class CircuitBreaker:
+    """Состояние предохранителя; вызывается только из event loop."""
+
+    def __init__(self, failures: int, reset_seconds: float) -> None:
+        self.failures = failures
+        self.reset_seconds = reset_seconds
+        self.state = CLOSED
+        self._failed = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    def retry_after(self) -> float:
+        return self._opened_at + self.reset_seconds - time.monotonic()
+
+    def before(self) -> None:
+        """Пропускаем вызов или сразу отказываем."""
+        if self.state == OPEN:
+            if self.retry_after() > 0:
+                raise VaultUnavailable(self.retry_after())
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            if self._probing:
+                raise VaultUnavailable(1)
+            self._probing = True
+
+    def success(self) -> None:
+        if self.state != CLOSED:
+            logger.info("Vault is reachable again, closing circuit breaker")
+        self.state = CLOSED
+        self._failed = 0
+        self._probing = False
+
+    def failure(self) -> None:
+        self._failed += 1
+        self._probing = False
+        if self.state == HALF_OPEN or self._failed >= self.failures:
+            if self.state != OPEN:
+                logger.warning(
+                    "Vault failed %d times in a row, opening circuit breaker "
+                    "for %.0f s",
+                    self._failed,
+                    self.reset_seconds,
+                )
+            self.state = OPEN
+            self._opened_at = time.monotonic()
+
+    def abandon(self) -> None:
+        """Вызов отменен до результата: пробу может сделать следующий."""
+        self._probing = False
+
+
+_breaker: Optional[CircuitBreaker] = None
+_executor: Optional[ThreadPoolExecutor] = None
+# Семафор потоков — свой для каждого event loop (TestClient, CLI)
+_slots: Optional[Tuple[asyncio.AbstractEventLoop, asyncio.Semaphore]] = None
+_waiting = 0
+_busy = 0
+# результат -> число вызовов: ok | error | failure | rejected
+_outcomes = {"ok": 0, "error": 0, "failure": 0, "rejected": 0}
+
+
+def _get_slots() -> asyncio.Semaphore:
+    global _slots
+    loop = asyncio.get_running_loop()
+    if _slots is None or _slots[0] is not loop:
+        _slots = (loop, asyncio.Semaphore(settings.VAULT_MAX_CONCURRENCY))
+    return _slots[1]
+
+
+def _get_breaker() -> CircuitBreaker:
+    global _breaker
+    if _breaker is None:
+        _breaker = CircuitBreaker(
+            settings.VAULT_BREAKER_FAILURES, settings.VAULT_BREAKER_RESET_SECONDS
+        )
+    return _breaker
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            settings.VAULT_MAX_CONCURRENCY, thread_name_prefix="vault"
+        )
+    return _executor
+
+
+def _is_outage(exc: BaseException) -> bool:
+    """Отказ Vault, а не ответ о конкретном секрете (404, 400 при CAS)."""
+    import requests
+    from hvac.exceptions import (
+        BadGateway,
+        InternalServerError,
+        RateLimitExceeded,
+        UnexpectedError,
+        VaultDown,
+    )
+
+    return isinstance(
+        exc,
+        (
+            asyncio.TimeoutError,
+            requests.RequestException,
+            BadGateway,
+            InternalServerError,
+            RateLimitExceeded,
+            UnexpectedError,
+            VaultDown,
+        ),
+    )
+
+
+def _release_slot(slots: asyncio.Semaphore) -> None:
+    global _busy
+    _busy -= 1
+    slots.release()
+
+
+def _release_from_thread(loop: asyncio.AbstractEventLoop, slots: asyncio.Semaphore):
+    try:
+        loop.call_soon_threadsafe(_release_slot, slots)
+    except RuntimeError:
+        pass  # loop уже закрыт (остановка процесса)
+
+
+async def _call(fn: Callable[[], T]) -> T:
+    """Выполняем `fn` в пуле Vault под таймаутом и предохранителем."""
+    global _waiting, _busy
+    breaker = _get_breaker()
+    try:
+        breaker.before()
+    except VaultUnavailable:
+        _outcomes["rejected"] += 1
+        raise
+    try:
+        slots = _get_slots()
+        if slots.locked():
+            if _waiting >= settings.VAULT_MAX_WAITING:
+                raise VaultUnavailable(1)
+            _waiting += 1
+            try:
+                await asyncio.wait_for(
+                    slots.acquire(), settings.VAULT_TIMEOUT_SECONDS
+                )
+            except asyncio.TimeoutError:
+                raise VaultUnavailable(1) from None
+            finally:
+                _waiting -= 1
+        else:
+            await slots.acquire()
+        if breaker.state == OPEN:
+            # Пока ждали потока, отказали другие запросы
+            slots.release()
+            raise VaultUnavailable(breaker.retry_after())
+    except VaultUnavailable:
+        breaker.abandon()
+        _outcomes["rejected"] += 1
+        raise
+    except BaseException:
+        breaker.abandon()
+        raise
+
+    loop = asyncio.get_running_loop()
+    _busy += 1
+    # Поток освобождается, только когда запрос действительно завершился,
+    # даже если вызывающий уже ушел по таймауту
+    future = _get_executor().submit(fn)
+    future.add_done_callback(lambda _: _release_from_thread(loop, slots))
+    try:
+        with span("vault"):
+            result = await asyncio.wait_for(
+                asyncio.wrap_future(future), settings.VAULT_TIMEOUT_SECONDS
+            )
+    except asyncio.CancelledError:
+        breaker.abandon()
+        raise
+    except Exception as exc:
+        if _is_outage(exc):
+            breaker.failure()
+            _outcomes["failure"] += 1
+            logger.warning("Vault request failed: %r", exc)
+            raise VaultUnavailable(
+                breaker.retry_after() if breaker.state == OPEN else 1
+            ) from exc
+        # Vault ответил, просто не тем, что нужно вызывающему
+        breaker.success()
+        _outcomes["error"] += 1
+        raise
+    breaker.success()
+    _outcomes["ok"] += 1
+    return result
+
+
+async def warm_up() -> None:
+    """Аутентифицируемся и открываем соединение с Vault заранее."""
+    await _call(_get_client)
+
+
 async def store_file_key(path: str, key: str) -> None:
     """Сохраняем ключ шифрования файла в Vault."""
 
     def _store() -> None:
-        client = _create_client()
+        client = _get_client()
         client.secrets.kv.v2.create_or_update_secret(
             mount_point=settings.vault_kv_mount,
             path=path,
             secret={"key": key},
         )
 
-    await asyncio.to_thread(_store)
+    await _call(_store)
 
 
 async def fetch_file_key(path: str) -> str:
     """Читаем ключ шифрования файла из Vault."""
 
     def _read() -> str:
-        client = _create_client()
+        client = _get_client()
         secret = client.secrets.kv.v2.read_secret_version(
             mount_point=settings.vault_kv_mount, path=path
         )
@@ -44,7 +309,7 @@ async def fetch_file_key(path: str) -> str:
             raise RuntimeError(f"No key found in Vault at path {path}")
         return key
 
-    return await asyncio.to_thread(_read)
+    return await _call(_read)
 
 
 async def delete_file_key(path: Optional[str]) -> None:
@@ -53,12 +318,126 @@ async def delete_file_key(path: Optional[str]) -> None:
         return
 
     def _delete() -> None:
-        client = _create_client()
+        client = _get_client()
+        client.secrets.kv.v2.delete_metadata_and_all_versions(
+            mount_point=settings.vault_kv_mount, path=path
+        )
+
+    try:
+        await _call(_delete)
+    except Exception as exc:  # noqa: BLE001
+        logger.warning("Failed to delete Vault secret %s: %s", path, exc)
+
+
+async def store_key_once(path: str, key: str) -> str:
+    """Сохраняем ключ, только если по пути его еще нет (check-and-set),
+    и возвращаем тот, что в итоге лежит в Vault."""
+
+    from hvac.exceptions import InvalidPath, InvalidRequest
+
+    def _read(client: "hvac.Client") -> Optional[str]:
         try:
-            client.secrets.kv.v2.delete_metadata_and_all_versions(
-                mount_point=settings.vault_kv_mount, path=path
+            secret = client.secrets.kv.v2.read_secret_version(
+                mount_point=settings.vault_kv_mount,
+                path=path,
+                raise_on_deleted_version=True,
             )
-        except Exception as exc:  # noqa: BLE001
-            logger.warning("Failed to delete Vault secret %s: %s", path, exc)
+        except InvalidPath:
+            return None
+        return secret["data"]["data"].get("key")
+
+    def _store_once() -> str:
+        client = _get_client()
+        existing = _read(client)
+        if existing:
+            return existing
+        try:
+            client.secrets.kv.v2.create_or_update_secret(
+                mount_point=settings.vault_kv_mount,
+                path=path,
+                secret={"key": key},
+                cas=0,
+            )
+            return key
+        except InvalidRequest:
+            # Параллельный запрос успел записать свой ключ первым
+            existing = _read(client)
+            if not existing:
+                raise
+            return existing
+
+    return await _call(_store_once)
+
+
+async def fetch_secret(path: str) -> Tuple[Optional[dict], int]:
+    """Секрет целиком и номер его версии (0 — секрета еще нет)."""
+
+    from hvac.exceptions import InvalidPath
+
+    def _read() -> Tuple[Optional[dict], int]:
+        client = _get_client()
+        try:
+            secret = client.secrets.kv.v2.read_secret_version(
+                mount_point=settings.vault_kv_mount,
+                path=path,
+                raise_on_deleted_version=True,
+            )
+        except InvalidPath:
+            return None, 0
+        return secret["data"]["data"], secret["data"]["metadata"]["version"]
+
+    return await _call(_read)
+
+
+async def store_secret(path: str, data: dict, cas: int) -> bool:
+    """Пишем секрет, только если его версия все еще `cas`; False — кто-то
+    успел записать раньше."""
+
+    from hvac.exceptions import InvalidRequest
+
+    def _store() -> bool:
+        client = _get_client()
+        try:
+            client.secrets.kv.v2.create_or_update_secret(
+                mount_point=settings.vault_kv_mount, path=path, secret=data, cas=cas
+            )
+        except InvalidRequest:
+            return False
+        return True
+
+    return await _call(_store)
+
 
-    await asyncio.to_thread(_delete)
+@metrics.register
+async def _collect():
+    return [
+        metrics.Metric(
+            "cypher_vault_breaker_state",
+            "Vault circuit breaker state (1 for the current state).",
+            "gauge",
+            [
+                ({"state": state}, int(_get_breaker().state == state))
+                for state in (CLOSED, HALF_OPEN, OPEN)
+            ],
+        ),
+        metrics.Metric(
+            "cypher_vault_requests_total",
+            "Vault calls by outcome: ok, error (Vault answered), failure "
+            "(timeout, connection error, 5xx/429), rejected (breaker open or "
+            "queue full).",
+            "counter",
+            [({"outcome": outcome}, count) for outcome, count in _outcomes.items()],
+        ),
+        metrics.Metric(
+            "cypher_vault_requests_in_flight",
+            "Vault requests running in the Vault thread pool.",
+            "gauge",
+            [({}, _busy)],
+        ),
+        metrics.Metric(
+            "cypher_vault_requests_waiting",
+            "Vault requests waiting for a free thread.",
+            "gauge",
+            [({}, _waiting)],
+        ),
+    ]
@@ -0,0 +1,404 @@
+"""Версии файлов с общими между версиями чанками.
+
+Новая версия режется на чанки по содержимому (см. chunking.py). Чанк,
+который уже есть у какой-либо версии того же файла, не шифруется и не
+пишется заново — у него только растет `ref_count`. Поэтому запись на диск
+и рост хранилища пропорциональны размеру правки, а не размеру файла.
+
+Все чанки файла шифруются одним ключом из Vault
+(`files/{owner_id}/{file_id}/chunks`). Идентификатор чанка — HMAC на этом
+ключе от SHA-256 содержимого, так что в БД не попадают дайджесты открытого
+текста. Содержимое, загруженное до первой новой версии, переносится в
+историю как есть (цельный шифротекст со своим ключом или Blob).
+"""
+
+import hashlib
+import hmac
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional
+
+from cryptography.fernet import Fernet
+from sqlalchemy import func, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from cypher_cloud.chunking import chunk_boundaries
+from cypher_cloud.config import settings
+from cypher_cloud.dedup import release_blob
+from cypher_cloud.models import Blob, FileChunk, FileVersion
+from cypher_cloud.models import File as FileModel
+from cypher_cloud.profiling import span
+from cypher_cloud.storage import (
+    new_storage_path,
+    remove_stored,
+    sync_writes,
+    write_encrypted,
+)
+from cypher_cloud.vault_client import fetch_file_key, store_key_once
+
+
+class Orphans(NamedTuple):
+    """Что удалить с диска и из Vault после коммита."""
+
+    storage_paths: List[str]
+    vault_key_paths: List[str]
+
+
+class VersionStats(NamedTuple):
+    version: int
+    size: int
+    chunks: int
+    new_chunks: int
+    new_bytes: int
+
+
+class Content(NamedTuple):
+    vault_key_path: str
+    # Либо цельный шифротекст (возможно, запись внутри сегмента), либо чанки
+    storage_path: Optional[str]
+    chunk_paths: Optional[List[str]]
+    size: Optional[int]
+    segment_offset: Optional[int] = None
+    segment_length: Optional[int] = None
+    # Когда содержимое стало таким, каким его отдаем: для текущей версии —
+    # files.modified_at, для прошлой — время ее создания
+    modified_at: Optional[datetime] = None
+    # Размеры открытого текста чанков (в порядке chunk_paths)
+    chunk_sizes: Optional[List[int]] = None
+
+
+async def lock_file(db: AsyncSession, owner_id: int, file_id: int) -> Optional[FileModel]:
+    """Файл под FOR UPDATE: версии одного файла меняются последовательно."""
+    with span("db"):
+        result = await db.execute(
+            select(FileModel)
+            .where(FileModel.owner_id == owner_id, FileModel.id == file_id)
+            .with_for_update()
+        )
+        return result.scalars().first()
+
+
+async def _move_to_history(db: AsyncSession, db_file: FileModel) -> str:
+    """Переносим содержимое неверсионированного файла в file_versions и
+    заводим ключ для чанков."""
+    size = db_file.size
+    if size is None and db_file.blob_id is not None:
+        with span("db"):
+            size = await db.scalar(select(Blob.size).where(Blob.id == db_file.blob_id))
+    db.add(
+        FileVersion(
+            owner_id=db_file.owner_id,
+            file_id=db_file.id,
+            version=db_file.version,
+            size=size,
+            estimated_size=db_file.estimated_size,
+            vault_key_path=db_file.vault_key_path,
+            storage_path=db_file.storage_path,
+            blob_id=db_file.blob_id,
+            segment_id=db_file.segment_id,
+            segment_offset=db_file.segment_offset,
+            segment_length=db_file.segment_length,
+            ciphertext_sha256=db_file.ciphertext_sha256,
+            # Версия сохраняет свое время: ETag и Last-Modified не меняются
+            created_at=db_file.modified_at or func.now(),
+        )
+    )
+    chunks_key_path = f"files/{db_file.owner_id}/{db_file.id}/chunks"
+    key = await store_key_once(chunks_key_path, Fernet.generate_key().decode())
+    db_file.storage_path = ""
+    db_file.estimated_size = None
+    db_file.vault_key_path = chunks_key_path
+    db_file.blob_id = None
+    db_file.segment_id = None
+    db_file.segment_offset = None
+    db_file.segment_length = None
+    db_file.ciphertext_sha256 = None
+    return key
+
+
+async def add_version(
+    db: AsyncSession, db_file: FileModel, content: bytes
+) -> VersionStats:
+    """Сохраняем новую версию и делаем ее текущей. Файл должен быть
+    заблокирован через `lock_file`; коммит — за вызывающим."""
+    if db_file.storage_path:
+        key = (await _move_to_history(db, db_file)).encode()
+    else:
+        key = (await fetch_file_key(db_file.vault_key_path)).encode()
+
+    with span("crypto"):
+        bounds = list(
+            chunk_boundaries(
+                content,
+                settings.CHUNK_MIN_SIZE,
+                settings.CHUNK_AVG_SIZE,
+                settings.CHUNK_MAX_SIZE,
+            )
+        )
+        view = memoryview(content)
+        hashes = [
+            hmac.new(
+                key, b"chunk:" + hashlib.sha256(view[start:end]).digest(), hashlib.sha256
+            ).hexdigest()
+            for start, end in bounds
+        ]
+    counts = Counter(hashes)
+
+    with span("db"):
+        result = await db.execute(
+            select(FileChunk.id, FileChunk.content_hash).where(
+                FileChunk.owner_id == db_file.owner_id,
+                FileChunk.file_id == db_file.id,
+                FileChunk.content_hash.in_(list(counts)),
+            )
+        )
+        chunk_ids = {row.content_hash: row.id for row in result}
+        if chunk_ids:
+            await db.execute(
+                text(
+                    "UPDATE file_chunks c SET ref_count = c.ref_count + d.n "
+                    "FROM unnest(CAST(:ids AS integer[]), CAST(:ns AS integer[])) "
+                    "AS d(id, n) WHERE c.id = d.id"
+                ),
+                {
+                    "ids": list(chunk_ids.values()),
+                    "ns": [counts[h] for h in chunk_ids],
+                },
+            )
+
+    new_chunks: Dict[str, FileChunk] = {}
+    written: List[str] = []
+    new_bytes = 0
+    try:
+        for (start, end), hash_ in zip(bounds, hashes):
+            if hash_ in chunk_ids or hash_ in new_chunks:
+                continue
+            storage_path = new_storage_path(db_file.owner_id, ".chunk")
+            digest = await write_encrypted(
+                storage_path, key, content[start:end], False
+            )
+            written.append(str(storage_path))
+            new_bytes += end - start
+            new_chunks[hash_] = FileChunk(
+                owner_id=db_file.owner_id,
+                file_id=db_file.id,
+                content_hash=hash_,
+                storage_path=str(storage_path),
+                size=end - start,
+                ref_count=counts[hash_],
+                ciphertext_sha256=digest,
+            )
+        if written:
+            await sync_writes()  # все новые чанки версии — одним сбросом
+        db.add_all(new_chunks.values())
+        with span("db"):
+            await db.flush()
+            chunk_ids.update((h, c.id) for h, c in new_chunks.items())
+            number = (
+                await db.scalar(
+                    select(func.max(FileVersion.version)).where(
+                        FileVersion.owner_id == db_file.owner_id,
+                        FileVersion.file_id == db_file.id,
+                    )
+                )
+                or db_file.version
+            ) + 1
+            db.add(
+                FileVersion(
+                    owner_id=db_file.owner_id,
+                    file_id=db_file.id,
+                    version=number,
+                    size=len(content),
+                    vault_key_path=db_file.vault_key_path,
+                    chunk_ids=[chunk_ids[h] for h in hashes],
+                )
+            )
+            db_file.version = number
+            db_file.size = len(content)
+            db_file.modified_at = func.now()
+            await db.flush()
+    except BaseException:
+        remove_stored(written)
+        raise
+
+    return VersionStats(number, len(content), len(hashes), len(new_chunks), new_bytes)
+
+
+async def get_version(
+    db: AsyncSession, db_file: FileModel, number: int
+) -> Optional[FileVersion]:
+    with span("db"):
+        result = await db.execute(
+            select(FileVersion).where(
+                FileVersion.owner_id == db_file.owner_id,
+                FileVersion.file_id == db_file.id,
+                FileVersion.version == number,
+            )
+        )
+        return result.scalars().first()
+
+
+async def list_versions(db: AsyncSession, db_file: FileModel) -> List[FileVersion]:
+    with span("db"):
+        result = await db.execute(
+            select(FileVersion)
+            .where(
+                FileVersion.owner_id == db_file.owner_id,
+                FileVersion.file_id == db_file.id,
+            )
+            .order_by(FileVersion.version.desc())
+        )
+        return list(result.scalars().all())
+
+
+async def resolve_content(
+    db: AsyncSession, db_file: FileModel, number: Optional[int] = None
+) -> Optional[Content]:
+    """Где лежит содержимое версии (по умолчанию текущей)."""
+    if number is None:
+        number = db_file.version
+    if db_file.storage_path:
+        if number != db_file.version:
+            return None
+        return Content(
+            db_file.vault_key_path,
+            db_file.storage_path,
+            None,
+            None,
+            db_file.segment_offset,
+            db_file.segment_length,
+            db_file.modified_at,
+        )
+
+    version = await get_version(db, db_file, number)
+    if version is None:
+        return None
+    modified_at = (
+        db_file.modified_at if number == db_file.version else version.created_at
+    )
+    if version.chunk_ids is None:
+        return Content(
+            version.vault_key_path,
+            version.storage_path,
+            None,
+            version.size,
+            version.segment_offset,
+            version.segment_length,
+            modified_at,
+        )
+    with span("db"):
+        result = await db.execute(
+            select(FileChunk.id, FileChunk.storage_path, FileChunk.size).where(
+                FileChunk.id.in_(set(version.chunk_ids))
+            )
+        )
+        chunks = {row.id: row for row in result}
+    return Content(
+        version.vault_key_path,
+        None,
+        [chunks[chunk_id].storage_path for chunk_id in version.chunk_ids],
+        version.size,
+        modified_at=modified_at,
+        chunk_sizes=[chunks[chunk_id].size for chunk_id in version.chunk_ids],
+    )
+
+
+async def _release_chunks(db: AsyncSession, chunk_ids: List[int]) -> List[str]:
+    counts = Counter(chunk_ids)
+    with span("db"):
+        result = await db.execute(
+            text(
+                "UPDATE file_chunks c SET ref_count = c.ref_count - d.n "
+                "FROM unnest(CAST(:ids AS integer[]), CAST(:ns AS integer[])) "
+                "AS d(id, n) WHERE c.id = d.id "
+                "RETURNING c.id, c.ref_count, c.storage_path"
+            ),
+            {"ids": list(counts), "ns": list(counts.values())},
+        )
+        dead = [(row.id, row.storage_path) for row in result if row.ref_count <= 0]
+        if dead:
+            await db.execute(
+                text("DELETE FROM file_chunks WHERE id = ANY(CAST(:ids AS integer[]))"),
+                {"ids": [chunk_id for chunk_id, _ in dead]},
+            )
+    return [path for _, path in dead]
+
+
+async def delete_version(db: AsyncSession, version: FileVersion) -> Orphans:
+    """Удаляем нетекущую версию; общие чанки остаются, пока на них ссылаются."""
+    orphans = Orphans([], [])
+    chunk_ids, blob_id = version.chunk_ids, version.blob_id
+    # Место записи в сегменте освободит компактор
+    if chunk_ids is None and blob_id is None and version.segment_id is None:
+        orphans.storage_paths.append(version.storage_path)
+        orphans.vault_key_paths.append(version.vault_key_path)
+    with span("db"):
+        await db.delete(version)
+        await db.flush()
+    if chunk_ids is not None:
+        orphans.storage_paths.extend(await _release_chunks(db, chunk_ids))
+    elif blob_id is not None:
+        blob = await release_blob(db, blob_id)
+        if blob is not None:
+            orphans.storage_paths.append(blob.storage_path)
+            orphans.vault_key_paths.append(blob.vault_key_path)
+    return orphans
+
+
+async def delete_file_content(db: AsyncSession, db_file: FileModel) -> Orphans:
+    """Удаляем файл со всеми версиями (строки версий и чанков удаляет
+    ON DELETE CASCADE)."""
+    orphans = Orphans([], [])
+    if db_file.storage_path:
+        contents = [
+            (
+                db_file.storage_path,
+                db_file.vault_key_path,
+                db_file.blob_id,
+                db_file.segment_id,
+            )
+        ]
+    else:
+        with span("db"):
+            result = await db.execute(
+                select(
+                    FileVersion.storage_path,
+                    FileVersion.vault_key_path,
+                    FileVersion.blob_id,
+                    FileVersion.segment_id,
+                ).where(
+                    FileVersion.owner_id == db_file.owner_id,
+                    FileVersion.file_id == db_file.id,
+                    FileVersion.chunk_ids.is_(None),
+                )
+            )
+            contents = [tuple(row) for row in result]
+            chunks = await db.execute(
+                select(FileChunk.storage_path).where(
+                    FileChunk.owner_id == db_file.owner_id,
+                    FileChunk.file_id == db_file.id,
+                )
+            )
+            orphans.storage_paths.extend(chunks.scalars())
+        orphans.vault_key_paths.append(db_file.vault_key_path)
+
+    blob_ids = []
+    for storage_path, vault_key_path, blob_id, segment_id in contents:
+        if segment_id is not None:
+            continue
+        if blob_id is None:
+            orphans.storage_paths.append(storage_path)
+            orphans.vault_key_paths.append(vault_key_path)
+        else:
+            blob_ids.append(blob_id)
+
+    with span("db"):
+        await db.delete(db_file)
+        await db.flush()
+    for blob_id in blob_ids:
+        blob = await release_blob(db, blob_id)
+        if blob is not None:
+            orphans.storage_paths.append(blob.storage_path)
+            orphans.vault_key_paths.append(blob.vault_key_path)
+    return orphans
@@ -0,0 +1,31 @@
+"""Окружение для тестов: обязательные поля Settings без .env и живых сервисов.
+
+Тесты не подключаются к Postgres и Vault: все, что ходит в БД или Vault,
+подменяется через monkeypatch.
+"""
+
+import os
+
+_ENV = {
+    "db_host": "127.0.0.1",
+    "db_port": "5432",
+    "db_user": "cypher",
+    "db_password": "cypher",
+    "db_name": "cypher",
+    "site_url": "http://localhost:3000",
+    "NEXT_PUBLIC_BASE_URL": "http://localhost:3000/api/v1",
+    "SECRET_KEY": "test-secret",
+    "ALGORITHM": "HS256",
+    "ISSUER_NAME": "test",
+    "ACCESS_TOKEN_EXPIRE_SECONDS": "3600",
+    "MAIL_USERNAME": "test@example.com",
+    "MAIL_PASSWORD": "test",
+    "MAIL_FROM": "test@example.com",
+    "MAIL_SERVER": "localhost",
+    "MAIL_PORT": "25",
+    "VAULT_ADDR": "http://127.0.0.1:8200",
+    "VAULT_TOKEN": "test-token",
+}
+
+for name, value in _ENV.items():
+    os.environ.setdefault(name, value)
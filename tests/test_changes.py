@@ -0,0 +1,141 @@
+import asyncio
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+from cypher_cloud import changes
+from cypher_cloud.config import get_settings
+from cypher_cloud.models import FileChange
+
+USER = SimpleNamespace(id=7)
+
+
+class _Journal:
+    """Журнал одного пользователя в памяти вместо file_changes и users."""
+
+    def __init__(self, seq: int = 0, floor: int = 0) -> None:
+        self.events = [_event(n) for n in range(floor + 1, seq + 1)]
+        self.floor = floor
+
+    @property
+    def seq(self) -> int:
+        return self.events[-1].seq if self.events else self.floor
+
+    def append(self) -> None:
+        self.events.append(_event(self.seq + 1))
+
+    async def current(self, owner_id):
+        return self.seq, self.floor
+
+    async def fetch(self, owner_id, since, limit):
+        found = [event for event in self.events if event.seq > since][:limit]
+        return found, self.seq, self.floor
+
+
+def _event(seq: int) -> FileChange:
+    return FileChange(
+        owner_id=USER.id,
+        seq=seq,
+        kind="upload",
+        file_id=seq,
+        filename=f"f{seq}",
+        created_at=datetime.now(timezone.utc),
+    )
+
+
+@pytest.fixture
+def journal(monkeypatch):
+    journal = _Journal(seq=5)
+    monkeypatch.setattr(changes, "_current", journal.current)
+    monkeypatch.setattr(changes, "_fetch", journal.fetch)
+    monkeypatch.setattr(changes, "_ensure_listener", lambda: None)
+    monkeypatch.setattr(changes, "_waiters", {})
+    return journal
+
+
+def _list(**query):
+    query = {"since": None, "limit": 500, "wait": 0, **query}
+    return asyncio.run(changes.list_changes(user=USER, **query))
+
+
+def test_without_cursor_returns_current_position(journal):
+    response = _list()
+    assert (response.changes, response.cursor, response.has_more) == ([], 5, False)
+
+
+def test_cursor_pages_through_journal(journal):
+    response = _list(since=0, limit=2)
+    assert [item.seq for item in response.changes] == [1, 2]
+    assert (response.cursor, response.has_more) == (2, True)
+    response = _list(since=response.cursor, limit=10)
+    assert [item.seq for item in response.changes] == [3, 4, 5]
+    assert (response.cursor, response.has_more) == (5, False)
+    response = _list(since=5)
+    assert (response.changes, response.cursor) == ([], 5)
+
+
+@pytest.mark.parametrize("since", [1, 6])
+def test_stale_or_future_cursor_is_gone(journal, since):
+    # События до 3 удалены prune; курсор 6 журнал еще не выдавал
+    journal.floor = 3
+    with pytest.raises(HTTPException) as exc_info:
+        _list(since=since)
+    assert exc_info.value.status_code == 410
+
+
+def test_cursor_at_floor_is_valid(journal):
+    journal.floor = 3
+    response = _list(since=3)
+    assert [item.seq for item in response.changes] == [4, 5]
+
+
+def test_long_poll_wakes_on_notify(journal, monkeypatch):
+    monkeypatch.setattr(get_settings(), "CHANGES_POLL_SECONDS", 30)
+
+    async def run():
+        async def commit_later():
+            await asyncio.sleep(0.05)
+            journal.append()
+            changes._notify(None, 0, changes.CHANNEL, str(USER.id))
+
+        task = asyncio.create_task(commit_later())
+        response = await asyncio.wait_for(
+            changes.list_changes(since=5, limit=500, wait=30, user=USER), 5
+        )
+        await task
+        return response
+
+    response = asyncio.run(run())
+    assert [item.seq for item in response.changes] == [6]
+    assert response.cursor == 6
+
+
+def test_stream_resets_stale_cursor(journal):
+    journal.floor = 3
+
+    async def run():
+        return [part async for part in changes._stream(USER.id, 1)]
+
+    assert asyncio.run(run()) == ["retry: 3000\n\n", "event: reset\ndata: {}\n\n"]
+
+
+def test_record_changes_numbers_events_consecutively():
+    class Session:
+        def __init__(self) -> None:
+            self.rows = None
+
+        async def scalar(self, statement, params):
+            # change_seq был 7, три события: 8, 9, 10
+            return 7 + params["n"]
+
+        async def execute(self, statement, params=None):
+            if isinstance(params, list):
+                self.rows = params
+
+    db = Session()
+    batch = [changes.Change("upload", i, f"f{i}") for i in range(3)]
+    assert asyncio.run(changes.record_changes(db, USER.id, batch)) == 10
+    assert [row["seq"] for row in db.rows] == [8, 9, 10]
+    assert asyncio.run(changes.record_changes(db, USER.id, [])) == 0
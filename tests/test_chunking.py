@@ -0,0 +1,58 @@
+import os
+import random
+
+from cypher_cloud.chunking import chunk_boundaries
+
+MIN, AVG, MAX = 2048, 8192, 32768
+
+
+def _chunks(data: bytes):
+    return list(chunk_boundaries(data, MIN, AVG, MAX))
+
+
+def test_chunks_cover_data_without_gaps():
+    data = os.urandom(500_000)
+    chunks = _chunks(data)
+    assert chunks[0][0] == 0
+    assert chunks[-1][1] == len(data)
+    for (_, end), (start, _) in zip(chunks, chunks[1:]):
+        assert end == start
+
+
+def test_chunk_sizes_within_limits():
+    chunks = _chunks(os.urandom(500_000))
+    for start, end in chunks[:-1]:
+        assert MIN <= end - start <= MAX
+    # Последний чанк — остаток, он может быть короче минимума
+    assert 0 < chunks[-1][1] - chunks[-1][0] <= MAX
+
+
+def test_small_and_empty_data():
+    assert _chunks(b"") == []
+    assert _chunks(b"x" * MIN) == [(0, MIN)]
+
+
+def test_uniform_data_is_cut_at_max_size():
+    data = b"\0" * (MAX * 3 + 100)
+    assert _chunks(data) == [
+        (0, MAX),
+        (MAX, 2 * MAX),
+        (2 * MAX, 3 * MAX),
+        (3 * MAX, 3 * MAX + 100),
+    ]
+
+
+def test_boundaries_are_deterministic():
+    data = random.Random(1).randbytes(200_000)
+    assert _chunks(data) == _chunks(bytes(data))
+
+
+def test_insert_shifts_only_nearby_boundaries():
+    rng = random.Random(2)
+    data = rng.randbytes(400_000)
+    edited = data[:200_000] + b"inserted" + data[200_000:]
+    before = {data[start:end] for start, end in _chunks(data)}
+    after = [edited[start:end] for start, end in _chunks(edited)]
+    changed = [chunk for chunk in after if chunk not in before]
+    assert 1 <= len(changed) <= 2
+    assert sum(len(chunk) for chunk in changed) <= 2 * MAX
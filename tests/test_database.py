@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+
+from cypher_cloud import database
+from cypher_cloud.config import get_settings
+
+
+class _Connection:
+    def __init__(self, fails: bool) -> None:
+        self.fails = fails
+        self.started = self.closed = False
+
+    async def start(self):
+        if self.fails:
+            raise ConnectionRefusedError("too many clients")
+        self.started = True
+        return self
+
+    async def execute(self, statement) -> None:
+        assert self.started
+
+    async def close(self) -> None:
+        # Как у AsyncConnection: неначатое соединение закрыть нельзя
+        assert self.started, "AsyncContextNotStarted"
+        self.closed = True
+
+
+class _Engine:
+    def __init__(self, failing: int) -> None:
+        self.failing = failing
+        self.connections = []
+
+    def connect(self) -> _Connection:
+        conn = _Connection(len(self.connections) < self.failing)
+        self.connections.append(conn)
+        return conn
+
+
+def _warm_up(monkeypatch, engine: _Engine) -> None:
+    monkeypatch.setattr(get_settings(), "DB_POOL_SIZE", 4)
+    monkeypatch.setattr(database, "get_engine", lambda: engine)
+    monkeypatch.setattr(database, "get_read_engine", lambda: engine)
+    asyncio.run(database.warm_up())
+
+
+def test_warm_up_opens_and_returns_pool_size_connections(monkeypatch):
+    engine = _Engine(failing=0)
+    _warm_up(monkeypatch, engine)
+    assert len(engine.connections) == 4
+    assert all(conn.closed for conn in engine.connections)
+
+
+def test_warm_up_closes_only_started_connections(monkeypatch):
+    engine = _Engine(failing=2)
+    with pytest.raises(ConnectionRefusedError):
+        _warm_up(monkeypatch, engine)
+    assert [conn.closed for conn in engine.connections] == [False, False, True, True]
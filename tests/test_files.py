@@ -0,0 +1,281 @@
+import asyncio
+import hashlib
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from cypher_cloud import files
+from cypher_cloud.dedup import BlobRef, content_key
+from cypher_cloud.quotas import Reservation
+from cypher_cloud.versions import VersionStats
+
+SECRET = b"s" * 32
+CONTENT = b"same bytes in every upload"
+MODIFIED = datetime(2026, 3, 1, 12, 30, 15, 250000, tzinfo=timezone.utc)
+
+
+def _request(**headers: str) -> Request:
+    return Request(
+        {
+            "type": "http",
+            "method": "GET",
+            "path": "/files/download/1",
+            "headers": [
+                (name.replace("_", "-").encode(), value.encode())
+                for name, value in headers.items()
+            ],
+        }
+    )
+
+
+# --- ETag и 304 -------------------------------------------------------------
+
+
+def test_cache_headers_depend_on_version_and_time():
+    headers = files._cache_headers(1, 2, MODIFIED)
+    assert headers["ETag"].startswith('"') and headers["ETag"].endswith('"')
+    assert headers["Last-Modified"] == "Sun, 01 Mar 2026 12:30:15 GMT"
+    assert files._cache_headers(1, 2, MODIFIED) == headers
+    assert files._cache_headers(1, 3, MODIFIED)["ETag"] != headers["ETag"]
+    later = MODIFIED + timedelta(seconds=1)
+    assert files._cache_headers(1, 2, later)["ETag"] != headers["ETag"]
+    assert "Last-Modified" not in files._cache_headers(1, 2, None)
+
+
+def test_if_none_match():
+    headers = files._cache_headers(1, 2, MODIFIED)
+    etag = headers["ETag"]
+    assert files._not_modified(_request(if_none_match=etag), headers, MODIFIED)
+    assert files._not_modified(_request(if_none_match=f"W/{etag}"), headers, MODIFIED)
+    assert files._not_modified(
+        _request(if_none_match=f'"other", {etag}'), headers, MODIFIED
+    )
+    assert files._not_modified(_request(if_none_match="*"), headers, MODIFIED)
+    assert not files._not_modified(
+        _request(if_none_match='"other"'), headers, MODIFIED
+    )
+
+
+def test_if_none_match_takes_precedence_over_if_modified_since():
+    headers = files._cache_headers(1, 2, MODIFIED)
+    request = _request(
+        if_none_match='"other"', if_modified_since=headers["Last-Modified"]
+    )
+    assert not files._not_modified(request, headers, MODIFIED)
+
+
+def test_if_modified_since():
+    headers = files._cache_headers(1, 2, MODIFIED)
+    same = headers["Last-Modified"]
+    before = "Sun, 01 Mar 2026 12:30:14 GMT"
+    assert files._not_modified(_request(if_modified_since=same), headers, MODIFIED)
+    assert not files._not_modified(
+        _request(if_modified_since=before), headers, MODIFIED
+    )
+    assert not files._not_modified(
+        _request(if_modified_since="not a date"), headers, MODIFIED
+    )
+    assert not files._not_modified(_request(if_modified_since=same), headers, None)
+    assert not files._not_modified(_request(), headers, MODIFIED)
+
+
+# --- Дедупликация -----------------------------------------------------------
+
+
+class _FakeDb:
+    def __init__(self) -> None:
+        self.added = []
+
+    def add(self, obj) -> None:
+        self.added.append(obj)
+
+    async def flush(self) -> None:
+        pass
+
+
+@pytest.fixture
+def dedup(monkeypatch, tmp_path):
+    """Подменяем БД, Vault и запись на диск; `state` задает ответы
+    acquire_blob/insert_blob и собирает вызовы."""
+    state = SimpleNamespace(
+        acquired=[], inserted=[], writes=[], insert_calls=[], stored_keys={}
+    )
+
+    async def get_user_secret(user_id):
+        return SECRET
+
+    async def acquire_blob(db, owner_id, hash_):
+        return state.acquired.pop(0)
+
+    async def insert_blob(db, owner_id, hash_, path, size, ciphertext_sha256):
+        state.insert_calls.append((path, size, ciphertext_sha256))
+        return state.inserted.pop(0)
+
+    def new_storage_path(user_id, suffix):
+        return tmp_path / f"{len(state.writes)}{suffix}"
+
+    async def write_encrypted(path, key, content, durable=True):
+        path.write_bytes(b"ciphertext")
+        state.writes.append((path, key))
+        return f"sha-{len(state.writes)}"
+
+    async def store_file_key(vault_path, key):
+        state.stored_keys[vault_path] = key
+
+    async def set_blob_key_path(db, blob_id, vault_path):
+        pass
+
+    for name, fn in [
+        ("get_user_secret", get_user_secret),
+        ("acquire_blob", acquire_blob),
+        ("insert_blob", insert_blob),
+        ("new_storage_path", new_storage_path),
+        ("write_encrypted", write_encrypted),
+        ("store_file_key", store_file_key),
+        ("set_blob_key_path", set_blob_key_path),
+    ]:
+        monkeypatch.setattr(files, name, fn)
+    return state
+
+
+def _store(db=None):
+    user = SimpleNamespace(id=7)
+    return asyncio.run(
+        files._store_deduplicated(
+            db or _FakeDb(), user, "a.txt", CONTENT, None, True
+        )
+    )
+
+
+def test_existing_blob_is_reused(dedup):
+    dedup.acquired = [BlobRef(5, "files/5.txt", "blobs/7/5")]
+    new_file = _store()
+    assert (new_file.blob_id, new_file.storage_path) == (5, "files/5.txt")
+    assert new_file.size == len(CONTENT)
+    assert dedup.writes == []
+
+
+def test_lost_race_uses_winner_and_removes_own_copy(dedup):
+    dedup.acquired = [None, BlobRef(5, "files/5.txt", "blobs/7/5")]
+    dedup.inserted = [None]
+    new_file = _store()
+    assert new_file.blob_id == 5
+    assert not dedup.writes[0][0].exists()
+    assert dedup.stored_keys == {}
+
+
+def test_retry_keeps_plaintext_digest(dedup):
+    # Победитель гонки успел удалить Blob: пишем заново, ключ тот же
+    dedup.acquired = [None, None]
+    dedup.inserted = [None, 9]
+    new_file = _store()
+    expected_key = content_key(SECRET, hashlib.sha256(CONTENT).digest())
+    assert [key for _, key in dedup.writes] == [expected_key, expected_key]
+    assert dedup.insert_calls[-1][1:] == (len(CONTENT), "sha-2")
+    assert dedup.stored_keys == {"blobs/7/9": expected_key.decode()}
+    assert (new_file.blob_id, new_file.vault_key_path) == (9, "blobs/7/9")
+
+
+def test_gives_up_after_retries(dedup):
+    dedup.acquired = [None] * (files.DEDUP_RETRIES + 1)
+    dedup.inserted = [None] * files.DEDUP_RETRIES
+    with pytest.raises(RuntimeError):
+        _store()
+    assert len(dedup.writes) == files.DEDUP_RETRIES
+
+
+# --- Квота при загрузке версии ----------------------------------------------
+
+
+class _FakeUpload:
+    async def read(self) -> bytes:
+        return CONTENT
+
+
+class _TxDb:
+    def __init__(self, events) -> None:
+        self.events = events
+
+    async def commit(self) -> None:
+        self.events.append("commit")
+
+    async def rollback(self) -> None:
+        self.events.append("rollback")
+
+
+@pytest.fixture
+def quota_flow(monkeypatch):
+    """Журнал вызовов квоты и работы с db при загрузке версии."""
+    state = SimpleNamespace(events=[], file=SimpleNamespace(filename="a.txt"))
+    reservation = Reservation(1, len(CONTENT), 0)
+
+    async def enforce(*args, **kwargs):
+        pass
+
+    async def reserve(owner_id, bytes_, objects):
+        state.events.append(("reserve", bytes_, objects))
+        return reservation
+
+    async def release(reservations):
+        state.events.append(("release", list(reservations)))
+
+    async def lock_file(db, owner_id, file_id):
+        state.events.append("lock_file")
+        return state.file
+
+    async def add_version(db, db_file, content):
+        state.events.append("add_version")
+        return VersionStats(2, len(content), 1, 1, len(content))
+
+    async def apply_usage(db, owner_id, bytes_, objects, reservations=()):
+        state.events.append(("apply_usage", bytes_, objects, list(reservations)))
+
+    async def record_changes(db, owner_id, changes):
+        pass
+
+    for name, fn in [
+        ("enforce", enforce),
+        ("reserve", reserve),
+        ("release", release),
+        ("lock_file", lock_file),
+        ("add_version", add_version),
+        ("apply_usage", apply_usage),
+        ("record_changes", record_changes),
+    ]:
+        monkeypatch.setattr(files, name, fn)
+    state.reservation = reservation
+    return state
+
+
+def _upload_version(state):
+    return asyncio.run(
+        files.upload_file_version(
+            1, None, _FakeUpload(), _TxDb(state.events), SimpleNamespace(id=7)
+        )
+    )
+
+
+def test_version_upload_reserves_before_locking(quota_flow):
+    result = _upload_version(quota_flow)
+    assert result.version == 2
+    assert quota_flow.events == [
+        ("reserve", len(CONTENT), 0),
+        "lock_file",
+        "add_version",
+        ("apply_usage", len(CONTENT), 0, [quota_flow.reservation]),
+        "commit",
+    ]
+
+
+def test_version_upload_releases_on_missing_file(quota_flow):
+    quota_flow.file = None
+    with pytest.raises(HTTPException) as exc_info:
+        _upload_version(quota_flow)
+    assert exc_info.value.status_code == 404
+    assert quota_flow.events[-2:] == [
+        "rollback",
+        ("release", [quota_flow.reservation]),
+    ]
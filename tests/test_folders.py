@@ -0,0 +1,127 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+from cypher_cloud import folders
+from cypher_cloud.models import Folder
+from cypher_cloud.schemas import FolderUpdate
+
+USER = SimpleNamespace(id=7)
+
+
+class _Tree:
+    """Папки одного пользователя в памяти. UPDATE путей по префиксу
+    применяется к ним с теми же параметрами, что уходят в БД."""
+
+    def __init__(self) -> None:
+        self.folders = {}
+        self.changes = []
+        self.commits = 0
+
+    def add(self, folder_id, parent_id=None) -> Folder:
+        parent = self.folders.get(parent_id)
+        folder = Folder(
+            id=folder_id,
+            owner_id=USER.id,
+            parent_id=parent_id,
+            name=f"d{folder_id}",
+            path=folders._child_path(parent, folder_id),
+        )
+        self.folders[folder_id] = folder
+        return folder
+
+    def paths(self) -> dict:
+        return {folder_id: folder.path for folder_id, folder in self.folders.items()}
+
+    async def execute(self, statement, params) -> None:
+        assert "path LIKE :old || '%'" in str(statement)
+        for folder in self.folders.values():
+            if folder.owner_id == params["owner"] and folder.path.startswith(
+                params["old"]
+            ):
+                folder.path = params["new"] + folder.path[params["old_length"] :]
+
+    async def commit(self) -> None:
+        self.commits += 1
+
+
+@pytest.fixture
+def tree(monkeypatch):
+    tree = _Tree()
+
+    async def get_folder(db, owner_id, folder_id):
+        return tree.folders.get(folder_id)
+
+    async def record_changes(db, owner_id, changes):
+        tree.changes.extend(changes)
+
+    async def noop(*args):
+        pass
+
+    monkeypatch.setattr(folders, "get_folder", get_folder)
+    monkeypatch.setattr(folders, "record_changes", record_changes)
+    monkeypatch.setattr(folders, "_lock_tree", noop)
+    monkeypatch.setattr(folders, "_flush_unique", noop)
+    # /1/, /1/2/, /1/2/3/, /10/ — префикс /1/ не должен задеть /10/
+    tree.add(1)
+    tree.add(2, 1)
+    tree.add(3, 2)
+    tree.add(10)
+    return tree
+
+
+def _update(tree, folder_id, **fields):
+    req = FolderUpdate(**fields)
+    return asyncio.run(folders.update_folder(folder_id, req, db=tree, user=USER))
+
+
+def test_child_path():
+    assert folders._child_path(None, 5) == "/5/"
+    assert folders._child_path(SimpleNamespace(path="/1/5/"), 9) == "/1/5/9/"
+
+
+def test_move_rewrites_subtree_by_prefix(tree):
+    folder = _update(tree, 2, parent_id=10)
+    assert (folder.parent_id, folder.path) == (10, "/10/2/")
+    assert tree.paths() == {1: "/1/", 2: "/10/2/", 3: "/10/2/3/", 10: "/10/"}
+    assert [change.kind for change in tree.changes] == ["folder_update"]
+    assert tree.commits == 1
+
+
+def test_move_to_root(tree):
+    _update(tree, 3, parent_id=None)
+    assert tree.paths() == {1: "/1/", 2: "/1/2/", 3: "/3/", 10: "/10/"}
+    assert tree.folders[3].parent_id is None
+
+
+def test_move_does_not_touch_folders_with_longer_id_prefix(tree):
+    _update(tree, 1, parent_id=10)
+    assert tree.paths() == {1: "/10/1/", 2: "/10/1/2/", 3: "/10/1/2/3/", 10: "/10/"}
+
+
+@pytest.mark.parametrize("target", [1, 3])
+def test_move_into_itself_or_descendant_is_rejected(tree, target):
+    with pytest.raises(HTTPException) as exc_info:
+        _update(tree, 1, parent_id=target)
+    assert exc_info.value.status_code == 400
+    assert tree.paths()[1] == "/1/"
+    assert tree.commits == 0
+
+
+def test_move_to_missing_folder(tree):
+    with pytest.raises(HTTPException) as exc_info:
+        _update(tree, 2, parent_id=99)
+    assert exc_info.value.status_code == 404
+
+
+def test_rename_keeps_paths(tree):
+    folder = _update(tree, 2, name="docs")
+    assert (folder.name, folder.path) == ("docs", "/1/2/")
+    assert tree.paths()[3] == "/1/2/3/"
+
+
+def test_noop_update_does_not_commit(tree):
+    _update(tree, 2, parent_id=1, name="d2")
+    assert tree.commits == 0 and tree.changes == []
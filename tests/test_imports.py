@@ -0,0 +1,182 @@
+import asyncio
+import zipfile
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+from cypher_cloud import imports
+from cypher_cloud.config import get_settings
+
+MEMBERS = 40
+
+
+class _Nested:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class _FakeSession:
+    def __init__(self, state) -> None:
+        self.state = state
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    def begin_nested(self) -> _Nested:
+        return _Nested()
+
+    async def execute(self, *args, **kwargs) -> None:
+        pass
+
+    async def commit(self) -> None:
+        if self.state.commit_failures:
+            self.state.commit_failures -= 1
+            raise RuntimeError("connection lost")
+        self.state.commits += 1
+        if self.state.pending is not None:
+            self.state.reported.append(self.state.pending)
+            self.state.pending = None
+
+    async def rollback(self) -> None:
+        self.state.pending = None
+
+
+@pytest.fixture
+def job(monkeypatch, tmp_path):
+    """Импорт без БД: `state` задает отказы и собирает статусы и отчеты."""
+    monkeypatch.setattr(get_settings(), "IMPORT_WORKERS", 2)
+    monkeypatch.setattr(get_settings(), "IMPORT_BATCH_SIZE", 5)
+    state = SimpleNamespace(
+        statuses=[],
+        reported=[],  # отчеты закоммиченных пачек
+        pending=None,
+        released=0,
+        commits=0,
+        commit_failures=0,
+        reserve_error=None,
+        store_error=None,
+    )
+
+    async def set_status(job_id, status_, **values):
+        state.statuses.append((status_, values))
+
+    async def reserve(owner_id, bytes_, objects):
+        if state.reserve_error is not None:
+            raise state.reserve_error
+        return imports.Reservation(1, bytes_, objects)
+
+    async def release(reservations):
+        state.released += len(reservations)
+
+    async def store_file(db, user, name, content, durable=True):
+        if state.store_error is not None:
+            raise state.store_error
+        return SimpleNamespace(id=1, filename=name, version=1)
+
+    async def report(db, user, job_id, batch):
+        state.pending = dict(batch.counters, errors=list(batch.errors))
+
+    async def noop(*args, **kwargs):
+        pass
+
+    for name, fn in [
+        ("_set_status", set_status),
+        ("reserve", reserve),
+        ("release", release),
+        ("store_file", store_file),
+        ("_report", report),
+        ("sync_writes", noop),
+        ("async_session", lambda: _FakeSession(state)),
+    ]:
+        monkeypatch.setattr(imports, name, fn)
+
+    path = tmp_path / "archive.zip"
+    with zipfile.ZipFile(path, "w") as archive:
+        for i in range(MEMBERS):
+            archive.writestr(f"f{i}.txt", b"x" * (i + 1))
+    state.path = path
+    return state
+
+
+def _run(state) -> None:
+    user = SimpleNamespace(id=7)
+    # Зависший импорт — это падение теста, а не вечное ожидание
+    asyncio.run(
+        asyncio.wait_for(imports.run_import(user, "job", state.path, "zip"), 10)
+    )
+
+
+def _totals(state) -> dict:
+    return {
+        key: sum(report[key] for report in state.reported)
+        for key in ("processed", "succeeded", "failed")
+    }
+
+
+def test_completed_import(job):
+    _run(job)
+    status_, values = job.statuses[-1]
+    assert (status_, values["total"], values["error"]) == ("completed", MEMBERS, None)
+    assert _totals(job) == {"processed": MEMBERS, "succeeded": MEMBERS, "failed": 0}
+    assert not job.path.exists()
+
+
+def test_failed_batch_commit_counts_files_as_failed(job):
+    job.commit_failures = 1
+    _run(job)
+    assert job.statuses[-1][0] == "completed"
+    assert _totals(job) == {
+        "processed": MEMBERS,
+        "succeeded": MEMBERS - 5,
+        "failed": 5,
+    }
+    assert job.released == 5
+
+
+def test_worker_failure_stops_the_import(job):
+    # Не удается записать даже прогресс: обработчик падает
+    job.commit_failures = 1000
+    _run(job)
+    status_, values = job.statuses[-1]
+    assert status_ == "failed"
+    assert values["error"] == "Внутренняя ошибка при импорте"
+    assert not job.path.exists()
+
+
+def test_member_errors_do_not_stop_the_import(job):
+    job.reserve_error = RuntimeError("pool timeout")
+    _run(job)
+    assert job.statuses[-1][0] == "completed"
+    assert _totals(job) == {"processed": MEMBERS, "succeeded": 0, "failed": MEMBERS}
+
+
+def test_quota_errors_are_reported_per_member(job):
+    job.reserve_error = HTTPException(413, "Превышена квота хранилища")
+    _run(job)
+    errors = [error for report in job.reported for error in report["errors"]]
+    assert len(errors) == MEMBERS
+    assert errors[0]["error"] == "Превышена квота хранилища"
+
+
+def test_broken_archive_fails_the_job(job):
+    job.path.write_bytes(b"PK\x03\x04 broken")
+    _run(job)
+    status_, values = job.statuses[-1]
+    assert status_ == "failed"
+    assert values["error"]
+    assert not job.path.exists()
+
+
+def test_store_error_releases_the_reservation(job):
+    job.store_error = OSError("disk full")
+    _run(job)
+    assert job.statuses[-1][0] == "completed"
+    assert _totals(job)["failed"] == MEMBERS
+    assert job.released == MEMBERS
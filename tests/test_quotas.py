@@ -0,0 +1,16 @@
+from cryptography.fernet import Fernet
+
+from cypher_cloud.quotas import fernet_plaintext_size
+
+
+def test_estimate_is_upper_bound_within_aes_block():
+    fernet = Fernet(Fernet.generate_key())
+    for size in [*range(0, 100), 1000, 4095, 4096, 65536, 1_000_001]:
+        token = fernet.encrypt(b"x" * size)
+        estimate = fernet_plaintext_size(len(token))
+        assert size <= estimate < size + 16
+
+
+def test_estimate_never_below_one_block():
+    assert fernet_plaintext_size(0) == 15
+    assert fernet_plaintext_size(10) == 15
@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+
+from cypher_cloud import ratelimit
+from cypher_cloud.ratelimit import Limit, MemoryBackend
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ratelimit.time, "monotonic", lambda: now[0])
+    return now
+
+
+def _take(backend: MemoryBackend, key: str, limit: Limit) -> float:
+    return asyncio.run(backend.take(key, limit))
+
+
+def test_burst_up_to_capacity(clock):
+    backend = MemoryBackend(100)
+    limit = Limit(capacity=3, rate=1)
+    assert [_take(backend, "a", limit) for _ in range(3)] == [0, 0, 0]
+    assert _take(backend, "a", limit) == pytest.approx(1)
+
+
+def test_refill_at_rate(clock):
+    backend = MemoryBackend(100)
+    limit = Limit(capacity=2, rate=0.5)
+    _take(backend, "a", limit)
+    _take(backend, "a", limit)
+    assert _take(backend, "a", limit) == pytest.approx(2)
+    clock[0] += 1
+    assert _take(backend, "a", limit) == pytest.approx(1)
+    clock[0] += 1
+    assert _take(backend, "a", limit) == 0
+
+
+def test_refill_capped_by_capacity(clock):
+    backend = MemoryBackend(100)
+    limit = Limit(capacity=2, rate=1)
+    _take(backend, "a", limit)
+    clock[0] += 3600
+    assert [_take(backend, "a", limit) for _ in range(2)] == [0, 0]
+    assert _take(backend, "a", limit) > 0
+
+
+def test_keys_are_independent(clock):
+    backend = MemoryBackend(100)
+    limit = Limit(capacity=1, rate=1)
+    assert _take(backend, "a", limit) == 0
+    assert _take(backend, "a", limit) > 0
+    assert _take(backend, "b", limit) == 0
+
+
+def test_oldest_key_is_evicted(clock):
+    backend = MemoryBackend(2)
+    limit = Limit(capacity=1, rate=0.001)
+    for key in ("a", "b", "c"):
+        _take(backend, key, limit)
+    assert len(backend) == 2
+    # Ведро "a" вытеснено и начинается заново, полным
+    assert _take(backend, "a", limit) == 0
+    assert _take(backend, "c", limit) > 0
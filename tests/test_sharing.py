@@ -0,0 +1,197 @@
+import asyncio
+import time
+
+import pytest
+from cryptography.fernet import Fernet
+from fastapi import HTTPException
+from jose import jwt
+
+from cypher_cloud import sharing, storage
+from cypher_cloud.versions import Content
+
+CHUNK = 100
+
+
+@pytest.fixture
+def ring(monkeypatch):
+    """Набор ключей и пустой deny-list в процессе: без Vault и БД."""
+    monkeypatch.setattr(
+        sharing, "_ring", sharing.KeyRing("k1", {"k1": "secret"}, time.monotonic())
+    )
+    monkeypatch.setattr(sharing, "_deny", sharing.DenyList(set(), {}, time.monotonic()))
+
+
+def _issue(**kwargs):
+    return asyncio.run(sharing.issue_token(7, 42, 3600, **kwargs))
+
+
+def _verify(token):
+    return asyncio.run(sharing.verify_token(token))
+
+
+def test_issued_token_verifies(ring):
+    token, claims = _issue(version=3, byte_range=(10, 20))
+    verified = _verify(token)
+    assert verified == claims
+    assert (verified["sub"], verified["fid"]) == ("7", 42)
+    assert (verified["ver"], verified["rng"]) == (3, [10, 20])
+    assert jwt.get_unverified_header(token)["kid"] == "k1"
+
+
+def test_tampered_or_foreign_tokens_are_rejected(ring):
+    token, claims = _issue()
+    assert _verify(token[:-2] + ("AA" if token[-2:] != "AA" else "BB")) is None
+    assert _verify("not a token") is None
+    # Чужой kid, подпись другим ключом, не share-токен
+    foreign = jwt.encode(claims, "secret", algorithm="HS256", headers={"kid": "k2"})
+    assert _verify(foreign) is None
+    forged = jwt.encode(claims, "other", algorithm="HS256", headers={"kid": "k1"})
+    assert _verify(forged) is None
+    access = jwt.encode(
+        {**claims, "typ": "access"}, "secret", algorithm="HS256", headers={"kid": "k1"}
+    )
+    assert _verify(access) is None
+
+
+def test_expired_token_is_rejected(ring):
+    token, _ = asyncio.run(sharing.issue_token(7, 42, -10))
+    assert _verify(token) is None
+
+
+def test_revoked_jti(ring, monkeypatch):
+    token, claims = _issue()
+    other, _ = _issue()
+    deny = sharing.DenyList({claims["jti"]}, {}, time.monotonic())
+    monkeypatch.setattr(sharing, "_deny", deny)
+    assert _verify(token) is None
+    assert _verify(other) is not None
+
+
+def test_file_revocation_covers_only_earlier_links(ring, monkeypatch):
+    token, claims = _issue()
+    deny = sharing.DenyList(set(), {42: float(claims["iat"])}, time.monotonic())
+    monkeypatch.setattr(sharing, "_deny", deny)
+    assert _verify(token) is None
+    later = {**claims, "jti": "later", "iat": claims["iat"] + 1}
+    assert not sharing._is_revoked(deny, later)
+    assert not sharing._is_revoked(deny, {**claims, "fid": 43})
+
+
+@pytest.mark.parametrize(
+    "header, expected",
+    [
+        (None, None),
+        ("", None),
+        ("bytes=0-9", (0, 10)),
+        ("bytes=10-", (10, 100)),
+        ("bytes=-10", (90, 100)),
+        ("bytes=-500", (0, 100)),
+        ("bytes=90-500", (90, 100)),
+        # Несколько диапазонов и чужие единицы не поддерживаем: весь ответ
+        ("bytes=0-1,5-6", None),
+        ("items=0-1", None),
+        ("bytes=-", None),
+    ],
+)
+def test_parse_range(header, expected):
+    assert sharing._parse_range(header, 100) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=100-", "bytes=20-10", "bytes=0-"])
+def test_unsatisfiable_range(header):
+    size = 0 if header == "bytes=0-" else 100
+    with pytest.raises(HTTPException) as exc_info:
+        sharing._parse_range(header, size)
+    assert exc_info.value.status_code == 416
+    assert exc_info.value.headers["Content-Range"] == f"bytes */{size}"
+
+
+def test_select_chunks():
+    paths, sizes = ["a", "b", "c", "d"], [CHUNK] * 4
+    blocks, skip = sharing._select_chunks(paths, sizes, 150, 250)
+    assert [block.storage_path for block in blocks] == ["b", "c"]
+    assert skip == 50
+    blocks, skip = sharing._select_chunks(paths, sizes, 0, 400)
+    assert len(blocks) == 4 and skip == 0
+    # Граница чанка: следующий не нужен
+    blocks, _ = sharing._select_chunks(paths, sizes, 0, 100)
+    assert [block.storage_path for block in blocks] == ["a"]
+    assert sharing._select_chunks(paths, sizes, 0, 0) == ([], 0)
+
+
+@pytest.fixture
+def chunked(tmp_path, monkeypatch):
+    """Чанковая версия на диске; `reads` — какие чанки прочитаны."""
+    key = Fernet.generate_key()
+    data = bytes(range(150)) * 3  # пять чанков, последний — 50 байт
+    paths, sizes = [], []
+    for i, start in enumerate(range(0, len(data), CHUNK)):
+        part = data[start : start + CHUNK]
+        path = tmp_path / f"chunk{i}"
+        path.write_bytes(Fernet(key).encrypt(part))
+        paths.append(str(path))
+        sizes.append(len(part))
+    content = Content("vault/key", None, paths, len(data), chunk_sizes=sizes)
+    reads = []
+    read_block = storage._read_block
+
+    def recording(block):
+        reads.append(paths.index(block.storage_path))
+        return read_block(block)
+
+    monkeypatch.setattr(storage, "_read_block", recording)
+    shared = sharing.SharedContent("f.bin", content, key, time.monotonic() + 60)
+    return shared, data, reads
+
+
+def _body(shared, window, range_):
+    async def collect():
+        opened = await sharing._open(shared, window, range_)
+        body = b"".join([bytes(view) async for view in opened.body])
+        return opened, body
+
+    return asyncio.run(collect())
+
+
+def test_window_and_range_read_only_needed_chunks(chunked):
+    shared, data, reads = chunked
+    # Окно [150, 450), Range внутри него — байты 100..199 окна
+    opened, body = _body(shared, [150, 450], "bytes=100-199")
+    assert (opened.size, opened.requested) == (300, (100, 200))
+    assert body == data[250:350]
+    assert reads == [2, 3]
+
+
+def test_window_past_end_of_file(chunked):
+    shared, data, reads = chunked
+    opened, body = _body(shared, [420, 10_000], None)
+    assert (opened.size, opened.requested) == (30, None)
+    assert body == data[420:]
+    assert reads == [4]
+
+
+def test_whole_chunked_file(chunked):
+    shared, data, reads = chunked
+    opened, body = _body(shared, None, None)
+    assert opened.size == len(data) and body == data
+    assert reads == [0, 1, 2, 3, 4]
+
+
+def test_single_ciphertext_window(tmp_path):
+    key = Fernet.generate_key()
+    data = b"0123456789" * 30
+    path = tmp_path / "file"
+    path.write_bytes(Fernet(key).encrypt(data))
+    content = Content("vault/key", str(path), None, None)
+    shared = sharing.SharedContent("f.bin", content, key, time.monotonic() + 60)
+    opened, body = _body(shared, [5, 105], "bytes=-10")
+    assert (opened.size, opened.requested) == (100, (90, 100))
+    assert body == data[95:105]
+
+
+def test_unsatisfiable_range_in_window(chunked):
+    shared, _, reads = chunked
+    with pytest.raises(HTTPException) as exc_info:
+        _body(shared, [0, 50], "bytes=50-")
+    assert exc_info.value.status_code == 416
+    assert reads == []
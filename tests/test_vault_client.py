@@ -0,0 +1,87 @@
+import pytest
+
+from cypher_cloud import vault_client
+from cypher_cloud.vault_client import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    VaultUnavailable,
+)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(vault_client.time, "monotonic", lambda: now[0])
+    return now
+
+
+def _open(breaker: CircuitBreaker) -> None:
+    for _ in range(breaker.failures):
+        breaker.before()
+        breaker.failure()
+
+
+def test_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker(3, 30)
+    breaker.failure()
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    breaker.failure()
+    assert breaker.state == CLOSED
+    breaker.failure()
+    assert breaker.state == OPEN
+
+
+def test_open_rejects_with_retry_after(clock):
+    breaker = CircuitBreaker(2, 30)
+    _open(breaker)
+    clock[0] += 10
+    with pytest.raises(VaultUnavailable) as exc_info:
+        breaker.before()
+    assert exc_info.value.status_code == 503
+    assert exc_info.value.headers["Retry-After"] == "20"
+
+
+def test_half_open_lets_one_probe_through(clock):
+    breaker = CircuitBreaker(2, 30)
+    _open(breaker)
+    clock[0] += 30
+    breaker.before()
+    assert breaker.state == HALF_OPEN
+    with pytest.raises(VaultUnavailable):
+        breaker.before()
+
+
+def test_successful_probe_closes(clock):
+    breaker = CircuitBreaker(2, 30)
+    _open(breaker)
+    clock[0] += 30
+    breaker.before()
+    breaker.success()
+    assert breaker.state == CLOSED
+    breaker.before()
+    breaker.failure()
+    assert breaker.state == CLOSED
+
+
+def test_failed_probe_reopens(clock):
+    breaker = CircuitBreaker(2, 30)
+    _open(breaker)
+    clock[0] += 30
+    breaker.before()
+    breaker.failure()
+    assert breaker.state == OPEN
+    assert breaker.retry_after() == 30
+
+
+def test_abandoned_probe_frees_slot(clock):
+    breaker = CircuitBreaker(2, 30)
+    _open(breaker)
+    clock[0] += 30
+    breaker.before()
+    breaker.abandon()
+    breaker.before()
+    assert breaker.state == HALF_OPEN